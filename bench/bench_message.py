@@ -0,0 +1,68 @@
+"""
+Compares the ``Message`` class against the original, list scanning one on
+typical ``Peer`` and ``SimpleProgress`` messages. Run from the repository
+root::
+
+    python bench/bench_message.py
+
+"""
+import sys
+import timeit
+
+sys.path.insert(0, '.')
+from twistedfcp.message import Message
+
+class LegacyMessage(object):
+    "The original ``Message``, which scans its arguments on every lookup."
+
+    def __getitem__(self, el):
+        for k, v in self.args:
+            if k == el: return v
+
+        raise KeyError("The key {0} is not in the message.".format(el))
+
+    def __contains__(self, el):
+        return any(k == el for k, _ in self.args)
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+PEER = [("lastGoodVersion", "Fred,0.7,1.0,1239"), ("opennet", "false"),
+        ("myName", "Some peer"), ("identity", "Ks1zOkJ0YV3HxBN6CVK2TB3qdyw"),
+        ("location", "0.5718342"), ("testnet", "false"),
+        ("version", "Fred,0.7,1.0,1240"), ("physical.udp", "1.2.3.4:5678"),
+        ("ark.pubURI", "SSK@Zp1eUQ6SgcAjnLmlLaFNe5zTh9iB8JVJ6LOqVxoHqRA"),
+        ("ark.number", "10"), ("auth.negTypes", "2;4;6;8"),
+        ("volatile.status", "CONNECTED"), ("volatile.averagePingTime", "91")]
+
+PROGRESS = [("Total", "13"), ("Required", "12"), ("Failed", "0"),
+            ("FatallyFailed", "0"), ("Succeeded", "4"),
+            ("FinalizedTotal", "true"), ("MinSuccessFetchBlocks", "12"),
+            ("Identifier", "Request123")]
+
+def legacy(name, args, keys):
+    message = LegacyMessage(name, dict(args).items())
+    if 'Identifier' in message:
+        message['Identifier']
+    for key in keys:
+        message[key]
+
+def indexed(name, args, keys):
+    message = Message(name, args, dict(args))
+    if 'Identifier' in message:
+        message['Identifier']
+    for key in keys:
+        message[key]
+
+def main(number=100000):
+    cases = [("Peer", PEER, ["identity", "volatile.status"]),
+             ("SimpleProgress", PROGRESS, ["Succeeded", "Required", "Total"])]
+    for name, args, keys in cases:
+        for f in (legacy, indexed):
+            seconds = timeit.timeit(lambda: f(name, args, keys), number=number)
+            print("{0:<16}{1:<10}{2:>12.0f} msgs/sec".format(
+                name, f.__name__, number / seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Measures how many messages per second ``MessageBasedProtocol`` parses from a
+burst of ``ListPeers`` and ``SimpleProgress`` traffic, as it would arrive in
+64 KiB reads from the socket. Run from the repository root::
+
+    python bench/bench_parser.py
+
+"""
+import sys
+import time
+
+sys.path.insert(0, '.')
+from twisted.test.proto_helpers import StringTransport
+from twistedfcp.message import Message
+from twistedfcp.util import MessageBasedProtocol, encode_message
+from bench_message import PEER, PROGRESS
+
+class CountingProtocol(MessageBasedProtocol):
+    "Counts the messages it parses."
+    count = 0
+
+    def message_received(self, message):
+        self.count += 1
+
+def burst(args, name, copies):
+    "Returns ``copies`` encoded messages, as one string."
+    return encode_message(Message(name, args)) * copies
+
+def parse(wire, chunk_size=65536):
+    "Parses ``wire`` and returns the number of messages per second."
+    protocol = CountingProtocol()
+    protocol.makeConnection(StringTransport())
+    chunks = [wire[i:i + chunk_size] for i in xrange(0, len(wire), chunk_size)]
+    start = time.time()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    return protocol.count / (time.time() - start)
+
+def main(copies=50000):
+    for name, args in (("Peer", PEER), ("SimpleProgress", PROGRESS)):
+        rate = parse(burst(args, name, copies))
+        print("{0:<16}{1:>12.0f} msgs/sec".format(name, rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Runs every benchmark, printing a table of the results and optionally saving
+them as JSON. Higher is better for every result. Run from the repository
+root::
+
+    python bench/suite.py --output results.json
+    python bench/suite.py --baseline results.json
+
+Each benchmark runs ``--repeat`` times (5 by default), and its best run is
+the result, as slower runs mostly measure interference from the rest of the
+machine. With ``--baseline``, each result is compared to the one saved in the
+given file, and the suite exits with status 1 if any of them is more than
+``--tolerance`` worse. The default of 20% is what reruns of the same tree stay
+within; the loopback benchmarks are the noisiest, so lower it only on a quiet
+machine.
+
+The suite measures:
+
+- ``parse.<name>``: messages per second parsed from a burst of ``Peer`` or
+  ``SimpleProgress`` messages.
+- ``parse_data.<size>``: megabytes per second of ``AllData`` payload parsed,
+  for several read sizes.
+- ``encode.<name>``: messages per second encoded by ``encode_message``.
+- ``sessions``: get sessions per second, started and completed on a
+  protocol whose transport is a string (no network).
+- ``routing``: progress messages per second routed to their sessions, with
+  10 ``SimpleProgress`` messages for each of 1000 sessions in flight.
+- ``loopback.sequential`` and ``loopback.pipelined``: gets per second over a
+  TCP connection to the test server, one at a time or 100 at once.
+- ``scaling.<n>``: gets per second with ``n`` gets in flight at once on one
+  connection.
+
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+sys.path.insert(0, '.')
+import twisted
+from twisted.internet import task
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet.protocol import ClientCreator
+from twisted.test.proto_helpers import StringTransport
+from twistedfcp.message import Message
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+from twistedfcp.util import encode_message
+from test.simple_server import TestServerProtocol, TestServerFactory
+from bench_message import PEER, PROGRESS
+from bench_parser import CountingProtocol, burst, parse
+
+MB = 2 ** 20
+
+def rate(count, f, *args):
+    "Returns how many times per second ``count`` calls of ``f`` ran."
+    start = time.time()
+    for _ in xrange(count):
+        f(*args)
+    return count / (time.time() - start)
+
+def parse_data(chunk_size, payload_size=MB, copies=32):
+    "Returns the megabytes per second of payload parsed in ``chunk_size`` reads."
+    message = Message("AllData", [("Identifier", "Request0")])
+    wire = (encode_message(message, payload_size) + 'x' * payload_size) * copies
+    protocol = CountingProtocol()
+    protocol.makeConnection(StringTransport())
+    chunks = [wire[i:i + chunk_size] for i in xrange(0, len(wire), chunk_size)]
+    start = time.time()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    return payload_size * copies / MB / (time.time() - start)
+
+def sessions(count):
+    "Returns how many get sessions per second run on a string transport."
+    client = FreenetClientProtocol()
+    client.clock = task.Clock()
+    client.timers = TimerWheel(clock=client.clock)
+    client.makeConnection(StringTransport())
+    client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+    start = time.time()
+    gets = [client.get_direct("KSK@{0}".format(i)) for i in xrange(count)]
+    client.clock.advance(0)
+    client.dataReceived(''.join("AllData\nIdentifier={0}\nDataLength=2\n"
+                                "Data\nok".format(identifier)
+                                for identifier in list(client.router.sessions)))
+    elapsed = time.time() - start
+    assert all(get.called for get in gets)
+    return count / elapsed
+
+def routing(sessions=1000, updates=10):
+    "Returns how many progress messages per second reach their sessions."
+    client = FreenetClientProtocol()
+    client.clock = task.Clock()
+    client.timers = TimerWheel(clock=client.clock)
+    client.makeConnection(StringTransport())
+    client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+    for i in xrange(sessions):
+        client.get_direct("KSK@{0}".format(i))
+    client.clock.advance(0)
+    progress = Message("SimpleProgress", PROGRESS)
+    wire = ''.join(encode_message(progress).replace("Request123", identifier)
+                   for identifier in list(client.router.sessions)) * updates
+    start = time.time()
+    client.dataReceived(wire)
+    return sessions * updates / (time.time() - start)
+
+class BenchServerProtocol(TestServerProtocol):
+    "Answers every get with the same small payload."
+    def ClientGet(self, message):
+        self.sendMessage(Message("AllData", [("Identifier",
+                                              message["Identifier"])]),
+                         data="benchmark data")
+
+@inlineCallbacks
+def loopback(reactor, count, in_flight):
+    """
+    Returns how many gets per second complete over a TCP connection to the
+    test server, with ``in_flight`` of them running at once.
+
+    """
+    factory = TestServerFactory()
+    factory.protocol = BenchServerProtocol
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    creator = ClientCreator(reactor, FreenetClientProtocol)
+    client = yield creator.connectTCP('127.0.0.1', port.getHost().port)
+    _ = yield client.deferred['NodeHello']
+
+    start = time.time()
+    uris = ["KSK@{0}".format(i) for i in xrange(count)]
+    for i in xrange(0, count, in_flight):
+        _ = yield gatherResults([client.get_direct(uri)
+                                 for uri in uris[i:i + in_flight]])
+    elapsed = time.time() - start
+
+    client.transport.loseConnection()
+    _ = yield port.stopListening()
+    returnValue(count / elapsed)
+
+@inlineCallbacks
+def run(reactor, options):
+    results = {}
+    def record(name, samples, unit):
+        "Records the best of the ``samples`` of a benchmark."
+        results[name] = dict(value=max(samples), samples=samples, unit=unit)
+        print("{0:<24}{1:>14.1f} {2}".format(name, max(samples), unit))
+
+    def repeated(f, *args):
+        return [f(*args) for _ in xrange(options.repeat)]
+
+    @inlineCallbacks
+    def repeated_loopback(count, in_flight):
+        samples = []
+        for _ in xrange(options.repeat):
+            value = yield loopback(reactor, count, in_flight)
+            samples.append(value)
+        returnValue(samples)
+
+    copies = 5000 if options.quick else 50000
+    for name, args in (("Peer", PEER), ("SimpleProgress", PROGRESS)):
+        record("parse." + name, repeated(lambda: parse(burst(args, name,
+                                                             copies))),
+               "msgs/sec")
+    for chunk_size in (4096, 65536, 1024 * 1024):
+        record("parse_data.{0}".format(chunk_size),
+               repeated(parse_data, chunk_size), "MB/sec")
+    for name, args in (("Peer", PEER), ("SimpleProgress", PROGRESS)):
+        message = Message(name, args)
+        record("encode." + name, repeated(rate, copies, encode_message,
+                                          message), "msgs/sec")
+    record("sessions", repeated(sessions, copies // 5), "sessions/sec")
+    record("routing", repeated(routing), "msgs/sec")
+
+    count = 500 if options.quick else 5000
+    samples = yield repeated_loopback(count // 5, 1)
+    record("loopback.sequential", samples, "gets/sec")
+    samples = yield repeated_loopback(count, 100)
+    record("loopback.pipelined", samples, "gets/sec")
+    counts = (1, 10, 100, 1000) if options.quick else (1, 10, 100, 1000, 10000)
+    for in_flight in counts:
+        samples = yield repeated_loopback(max(in_flight, count), in_flight)
+        record("scaling.{0}".format(in_flight), samples, "gets/sec")
+
+    report = dict(python=platform.python_version(), twisted=twisted.__version__,
+                  repeat=options.repeat, results=results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        if regressions(results, baseline, options.tolerance):
+            raise SystemExit(1)
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def regressions(results, baseline, tolerance):
+    """
+    Prints how ``results`` compare to ``baseline``. Returns the regressions.
+    The best result is compared to the median of the baseline's runs (or to
+    its value, for baselines saved without them), so that a baseline with one
+    lucky run doesn't make every later run look like a regression.
+
+    """
+    failed = []
+    print("")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        reference = median(baseline[name].get('samples',
+                                              [baseline[name]['value']]))
+        ratio = results[name]['value'] / reference
+        mark = ''
+        if ratio < 1 - tolerance:
+            failed.append(name)
+            mark = '  REGRESSION'
+        print("{0:<24}{1:>8.2f}x baseline{2}".format(name, ratio, mark))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="save the results to this file")
+    parser.add_argument('--baseline', help="compare to results in this file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown relative to the baseline")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each benchmark (the best one counts)")
+    parser.add_argument('--quick', action='store_true',
+                        help="run smaller benchmarks")
+    options = parser.parse_args()
+    task.react(run, [options])
+
+if __name__ == '__main__':
+    main()
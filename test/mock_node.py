@@ -0,0 +1,377 @@
+"""
+A mock Freenet node for load testing clients offline. Unlike the plain
+``TestServerProtocol``, every connection shares one store (optionally kept on
+disk), and requests take time: each key type has a latency distribution and a
+bandwidth limit, shared by all the transfers of that type. While a request
+runs, the node reports its progress with ``SimpleProgress`` messages, and
+requests can be made to fail at random with any of the errors of
+``twistedfcp.error``.
+
+Run it on its own with::
+
+    python test/mock_node.py --port 9481 --latency CHK=exponential:0.5 \\
+        --bandwidth CHK=1000000 --failure-rate 0.01
+
+"""
+import hashlib
+import os
+import random
+import sys
+
+sys.path.insert(0, '.')
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twistedfcp.error import error_dict
+from twistedfcp.message import Message
+
+from simple_server import TestServerProtocol, sha
+
+def constant(seconds):
+    "A latency distribution that always takes ``seconds``."
+    return lambda rng: seconds
+
+def uniform(low, high):
+    "A latency distribution uniform between ``low`` and ``high`` seconds."
+    return lambda rng: rng.uniform(low, high)
+
+def exponential(mean):
+    "An exponential latency distribution with the given ``mean``."
+    return lambda rng: rng.expovariate(1.0 / mean) if mean else 0.0
+
+def lognormal(mu, sigma):
+    "A log-normal latency distribution (of ``exp(normal(mu, sigma))``)."
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+distributions = dict(constant=constant, uniform=uniform,
+                     exponential=exponential, lognormal=lognormal)
+
+class MockStore(object):
+    """
+    The content of the mock node, keyed by URI. If a ``directory`` is given,
+    the data is kept in files there, so it outlives the node.
+
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.data = {}
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, uri):
+        return os.path.join(self.directory, hashlib.sha1(uri).hexdigest())
+
+    def __contains__(self, uri):
+        if self.directory is None:
+            return uri in self.data
+        return os.path.exists(self.path(uri))
+
+    def __getitem__(self, uri):
+        if self.directory is None:
+            return self.data[uri]
+        try:
+            with open(self.path(uri), 'rb') as f:
+                return f.read()
+        except IOError:
+            raise KeyError(uri)
+
+    def __setitem__(self, uri, data):
+        if self.directory is None:
+            self.data[uri] = data
+        else:
+            with open(self.path(uri), 'wb') as f:
+                f.write(data)
+
+class Link(object):
+    """
+    A link of ``bandwidth`` bytes per second (or unlimited, if ``None``) that
+    transfers are queued on, one after the other.
+
+    """
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+        self.free_at = 0.0
+
+    def reserve(self, size, now):
+        "Returns how long from ``now`` a transfer of ``size`` bytes ends."
+        if not self.bandwidth:
+            return 0.0
+        self.free_at = max(now, self.free_at) + size / float(self.bandwidth)
+        return self.free_at - now
+
+class KeyProfile(object):
+    """
+    How requests for one key type behave: how long they take before any data
+    is transferred (a ``latency`` distribution, see ``constant`` and friends)
+    and how fast data is transferred (``bandwidth`` bytes per second, shared
+    by every request of the type).
+
+    """
+    def __init__(self, latency=constant(0.0), bandwidth=None):
+        self.latency = latency
+        self.link = Link(bandwidth)
+
+class FailureInjector(object):
+    """
+    Makes requests fail at random, with probability ``rate``. ``errors`` maps
+    request names to the ``(error message, code)`` pairs to fail them with (one
+    is picked at random). Error messages must be those of
+    ``twistedfcp.error``.
+
+    """
+    default_errors = {
+        'ClientGet': [('GetFailed', 13), ('GetFailed', 28)],
+        'ClientPut': [('PutFailed', 10), ('PutFailed', 5)],
+    }
+
+    def __init__(self, rate=0.0, errors=None):
+        self.rate = rate
+        self.errors = errors or self.default_errors
+        for choices in self.errors.itervalues():
+            for name, _ in choices:
+                if name not in error_dict:
+                    raise ValueError("Unknown error message: " + name)
+
+    def pick(self, rng, request):
+        "Returns the ``(error, code)`` to fail ``request`` with, or ``None``."
+        choices = self.errors.get(request)
+        if choices and self.rate and rng.random() < self.rate:
+            return rng.choice(choices)
+
+class MockNodeProtocol(TestServerProtocol):
+    """
+    A connection to the mock node. Requests are answered after the delay of
+    their key type, with ``progress_steps`` progress messages along the way.
+
+    """
+    def __init__(self):
+        TestServerProtocol.__init__(self)
+        self.requests = {}
+
+    def connectionLost(self, reason):
+        for calls in self.requests.values():
+            for call in calls:
+                if call.active():
+                    call.cancel()
+        self.requests = {}
+        TestServerProtocol.connectionLost(self, reason)
+
+    def profile(self, uri):
+        key_type = uri.split('@', 1)[0].upper()
+        return self.factory.profiles.get(key_type, self.factory.default)
+
+    def schedule(self, identifier, delay, finish, *args):
+        """
+        Calls ``finish(*args)`` to end request ``identifier`` after ``delay``
+        seconds, and sends its progress until then.
+
+        """
+        factory = self.factory
+        steps = factory.progress_steps if delay else 0
+        calls = []
+        for step in xrange(1, steps):
+            progress = Message("SimpleProgress",
+                               [("Identifier", identifier),
+                                ("Total", steps), ("Required", steps),
+                                ("Failed", 0), ("FatallyFailed", 0),
+                                ("Succeeded", step),
+                                ("FinalizedTotal", "true")])
+            calls.append(factory.clock.callLater(delay * step / steps,
+                                                 self.sendMessage, progress))
+
+        def end():
+            self.requests.pop(identifier, None)
+            finish(*args)
+
+        calls.append(factory.clock.callLater(delay, end))
+        self.requests[identifier] = calls
+
+    def delay(self, uri, size):
+        "Returns how long a request for ``uri``, of ``size`` bytes, takes."
+        profile = self.profile(uri)
+        latency = profile.latency(self.factory.rng)
+        now = self.factory.clock.seconds()
+        return latency + profile.link.reserve(size, now + latency)
+
+    def failure(self, message):
+        "Returns the injected error message for ``message``, or ``None``."
+        picked = self.factory.failures.pick(self.factory.rng, message.name)
+        if picked is None:
+            return None
+        self.factory.stats['failures'] += 1
+        name, code = picked
+        return Message(name, [("Identifier", message["Identifier"]),
+                              ("Code", code),
+                              ("CodeDescription", "Injected failure")])
+
+    def ClientGet(self, message):
+        self.factory.stats['gets'] += 1
+        uri, identifier = message["URI"], message["Identifier"]
+        id_pair = ("Identifier", identifier)
+        error = self.failure(message)
+        if error is None and uri not in self.store:
+            error = Message("GetFailed", [id_pair, ("Code", 13),
+                                          ("CodeDescription",
+                                           "Data not found")])
+        if error is not None:
+            self.schedule(identifier, self.delay(uri, 0), self.sendMessage,
+                          error)
+            return
+
+        data = self.store[uri]
+        found = Message("DataFound", [id_pair, ("DataLength", len(data)),
+                                      ("Metadata.ContentType",
+                                       "application/octet-stream")])
+        messages = [(found, None)]
+        filename = None
+        if message.get("ReturnType") == "disk":
+            filename = message["Filename"]
+        elif message.get("ReturnType") != "none":
+            messages.append((Message("AllData", [id_pair]), data))
+        self.schedule(identifier, self.delay(uri, len(data)), self.found,
+                      messages, filename, data)
+
+    def found(self, messages, filename, data):
+        """
+        Sends ``messages`` (``(message, data)`` pairs) at the end of a get,
+        after writing ``data`` to ``filename`` for a get to disk.
+
+        """
+        if filename is not None:
+            with open(filename, 'wb') as f:
+                f.write(data)
+            self.factory.stats['bytes_sent'] += len(data)
+        for message, body in messages:
+            self.sendMessage(message, body)
+            self.factory.stats['bytes_sent'] += len(body or '')
+
+    def ClientPut(self, message):
+        self.factory.stats['puts'] += 1
+        uri, identifier = message["URI"], message["Identifier"]
+        id_pair = ("Identifier", identifier)
+        if message.get("UploadFrom") == "disk":
+            try:
+                with open(message["Filename"], 'rb') as f:
+                    message["Data"] = f.read()
+            except IOError:
+                self.sendMessage(Message("ProtocolError",
+                                         [id_pair, ("Code", 7),
+                                          ("CodeDescription", "No such file")]))
+                return
+        data = message["Data"]
+        if uri.split("@", 1)[0] == 'CHK':
+            uri = "CHK@{0}".format(sha(data).hexdigest())
+        generated = Message("URIGenerated", [id_pair, ("URI", uri)])
+        success = Message("PutSuccessful", [id_pair, ("URI", uri)])
+        if message.get("GetCHKOnly") == "true":
+            self.sendMessage(generated)
+            self.sendMessage(success)
+            return
+
+        error = self.failure(message)
+        self.sendMessage(generated)
+        delay = self.delay(uri, len(data))
+        if error is not None:
+            self.schedule(identifier, delay, self.sendMessage, error)
+        else:
+            self.schedule(identifier, delay, self.stored, uri, data, success)
+
+    def stored(self, uri, data, success):
+        "Stores ``data`` once its put completes, and reports its ``success``."
+        self.store[uri] = data
+        self.sendMessage(success)
+
+    def GenerateSSK(self, message):
+        rng = self.factory.rng
+        key = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789")
+                      for _ in xrange(43))
+        crypto = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789")
+                         for _ in xrange(43))
+        self.sendMessage(Message("SSKKeypair",
+                                 [("Identifier", message["Identifier"]),
+                                  ("InsertURI",
+                                   "SSK@{0},{1},AQECAAE/".format(key, crypto)),
+                                  ("RequestURI",
+                                   "SSK@{0},{1},AQACAAE/".format(crypto,
+                                                                 key))]))
+
+    def RemoveRequest(self, message):
+        identifier = message["Identifier"]
+        for call in self.requests.pop(identifier, []):
+            if call.active():
+                call.cancel()
+        self.sendMessage(Message("PersistentRequestRemoved",
+                                 [("Identifier", identifier)]))
+
+class MockNodeFactory(ServerFactory):
+    """
+    Builds the connections of a mock node, which share its ``store`` (a
+    ``MockStore``). ``profiles`` maps key types (``'CHK'``, ``'KSK'``...) to
+    their ``KeyProfile``; other key types use ``default``. Requests are
+    counted in ``stats``.
+
+    """
+    protocol = MockNodeProtocol
+
+    def __init__(self, store=None, profiles=None, default=None,
+                 failures=None, progress_steps=4, seed=None, clock=reactor):
+        self.store = store if store is not None else MockStore()
+        self.profiles = profiles or {}
+        self.default = default or KeyProfile()
+        self.failures = failures or FailureInjector()
+        self.progress_steps = progress_steps
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.stats = dict(connections=0, gets=0, puts=0, failures=0,
+                          bytes_sent=0)
+
+    def buildProtocol(self, addr):
+        node = ServerFactory.buildProtocol(self, addr)
+        node.store = self.store
+        node.clock = self.clock
+        self.stats['connections'] += 1
+        return node
+
+def parse_profiles(latencies, bandwidths):
+    """
+    Returns ``KeyProfile`` objects from ``TYPE=distribution:arg,...`` latency
+    and ``TYPE=bytes_per_second`` bandwidth options.
+
+    """
+    specs = {}
+    for spec in latencies:
+        key_type, _, distribution = spec.partition('=')
+        name, _, args = distribution.partition(':')
+        args = [float(arg) for arg in args.split(',') if arg]
+        specs.setdefault(key_type.upper(), {})['latency'] = \
+            distributions[name](*args)
+    for spec in bandwidths:
+        key_type, _, bandwidth = spec.partition('=')
+        specs.setdefault(key_type.upper(), {})['bandwidth'] = float(bandwidth)
+    return dict((key_type, KeyProfile(**spec))
+                for key_type, spec in specs.iteritems())
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=9481)
+    parser.add_argument('--store', help="keep the store in this directory")
+    parser.add_argument('--latency', action='append', default=[],
+                        help="e.g. CHK=exponential:0.5 or KSK=uniform:0.1,1")
+    parser.add_argument('--bandwidth', action='append', default=[],
+                        help="bytes per second, e.g. CHK=1000000")
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--progress-steps', type=int, default=4)
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args()
+
+    factory = MockNodeFactory(MockStore(options.store),
+                              parse_profiles(options.latency,
+                                             options.bandwidth),
+                              failures=FailureInjector(options.failure_rate),
+                              progress_steps=options.progress_steps,
+                              seed=options.seed)
+    reactor.listenTCP(options.port, factory, backlog=4096)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
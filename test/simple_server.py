@@ -1,4 +1,6 @@
 import hashlib
+import os
+import uuid
 from twisted.internet.protocol import ServerFactory
 
 from twistedfcp.message import Message, IdentifiedMessage
@@ -13,13 +15,14 @@ class TestServerProtocol(MessageBasedProtocol):
 
     """
     port = 9999 
+    dda = True
 
     def __init__(self):
         MessageBasedProtocol.__init__(self)
         self.store = {}
+        self.dda_tests = {}
 
-    def message_received(self, messageName, messageItems):
-        message = Message(messageName, messageItems.items())
+    def message_received(self, message):
         if hasattr(self, message.name):
             f = getattr(self, message.name)
             f(message)
@@ -30,7 +33,11 @@ class TestServerProtocol(MessageBasedProtocol):
     def ClientGet(self, message):
         uri = message["URI"]
         id_pair = ("Identifier", message["Identifier"])
-        if uri in self.store:
+        if uri in self.store and message.get("ReturnType") == "disk":
+            with open(message["Filename"], 'wb') as f:
+                f.write(self.store[uri])
+            self.sendMessage(Message("DataFound", [id_pair]))
+        elif uri in self.store:
             msg = Message("AllData", [id_pair])
             self.sendMessage(msg, data=self.store[uri])
         else:
@@ -42,14 +49,77 @@ class TestServerProtocol(MessageBasedProtocol):
 
     def ClientPut(self, message):
         uri = message["URI"]
+        if message.get("UploadFrom") == "disk":
+            try:
+                with open(message["Filename"], 'rb') as f:
+                    message["Data"] = f.read()
+            except IOError:
+                self.sendMessage(Message("ProtocolError",
+                                         [("Identifier", message["Identifier"]),
+                                          ("Code", 7),
+                                          ("CodeDescription", "No such file")]))
+                return
         if uri.split("@", 1)[0] == 'CHK':
             uri = "CHK@{0}".format(sha(message["Data"]).hexdigest())
         
-        self.store[uri] = message["Data"]
+        if message.get("GetCHKOnly") != "true":
+            self.store[uri] = message["Data"]
         self.sendMessage(Message("PutSuccessful", 
                                  [("Identifier", message["Identifier"]),
                                   ("URI", uri)]))
 
+    def ClientPutComplexDir(self, message):
+        files = {}
+        i = 0
+        while "Files.{0}.Name".format(i) in message:
+            prefix = "Files.{0}.".format(i)
+            files[message[prefix + "Name"]] = message[prefix + "TargetURI"]
+            i += 1
+
+        self.store[message["URI"]] = files
+        self.sendMessage(Message("PutSuccessful",
+                                 [("Identifier", message["Identifier"]),
+                                  ("URI", message["URI"])]))
+
+    def TestDDARequest(self, message):
+        directory = message["Directory"]
+        fields = [("Directory", directory)]
+        read = read_content = write = write_content = None
+        if message.get("WantReadDirectory") == "true":
+            read = os.path.join(directory,
+                                "DDA-read-{0}.tmp".format(uuid.uuid4()))
+            read_content = uuid.uuid4().hex
+            with open(read, 'wb') as f:
+                f.write(read_content)
+            fields.append(("ReadFilename", read))
+        if message.get("WantWriteDirectory") == "true":
+            write = os.path.join(directory,
+                                 "DDA-write-{0}.tmp".format(uuid.uuid4()))
+            write_content = uuid.uuid4().hex
+            fields += [("WriteFilename", write),
+                       ("ContentToWrite", write_content)]
+        self.dda_tests[directory] = (read, read_content, write, write_content)
+        self.sendMessage(Message("TestDDAReply", fields))
+
+    def TestDDAResponse(self, message):
+        directory = message["Directory"]
+        read, read_content, write, write_content = self.dda_tests.pop(directory)
+        allowed = lambda ok: str(ok and self.dda).lower()
+        fields = [("Directory", directory)]
+        if read is not None:
+            os.remove(read)
+            fields.append(("ReadDirectoryAllowed",
+                           allowed(message.get("ReadContent") == read_content)))
+        if write is not None:
+            try:
+                with open(write, 'rb') as f:
+                    written = f.read()
+            except IOError:
+                written = None
+            fields.append(("WriteDirectoryAllowed",
+                           allowed(written == write_content)))
+        self.sendMessage(Message("TestDDAComplete", fields))
+
     def ListPeers(self, message):
         for x in xrange(5):
             msg = Message("Peer", [("identity", hex(x))])
@@ -59,3 +129,22 @@ class TestServerProtocol(MessageBasedProtocol):
 
 class TestServerFactory(ServerFactory):
     protocol = TestServerProtocol
+
+class RecordingFactory(TestServerFactory):
+    "Test server that records the messages (and their names) it receives."
+    def __init__(self):
+        self.servers = []
+        self.messages = []
+        self.received = []
+
+    def buildProtocol(self, addr):
+        server = TestServerFactory.buildProtocol(self, addr)
+        self.servers.append(server)
+        message_received = server.message_received
+        def record(message):
+            self.messages.append(message)
+            self.received.append(message.name)
+            message_received(message)
+
+        server.message_received = record
+        return server
@@ -0,0 +1,99 @@
+import unittest
+
+try:
+    import asyncio
+    from twistedfcp import aio
+except ImportError:
+    asyncio = None
+
+from twistedfcp.core import MessageParser, encode_message
+from twistedfcp.error import FetchException, NodeTimeout
+from twistedfcp.message import Message
+
+if asyncio is not None:
+    class StoreServerProtocol(asyncio.Protocol, MessageParser):
+        "A node that keeps a store, and never answers gets of ``KSK@slow``."
+        def __init__(self, store, received):
+            MessageParser.__init__(self)
+            self.store = store
+            self.received = received
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.feed(data)
+
+        def send(self, message, data=None):
+            if data is None:
+                self.transport.write(encode_message(message))
+            else:
+                self.transport.write(encode_message(message, len(data)) + data)
+
+        def message_received(self, message):
+            self.received.append(message.name)
+            identifier = ("Identifier", message.get("Identifier"))
+            if message.name == "ClientHello":
+                self.send(Message("NodeHello", [("FCPVersion", "2.0")]))
+            elif message.name == "ClientPut":
+                self.store[message["URI"]] = message["Data"]
+                self.send(Message("PutSuccessful",
+                                  [identifier, ("URI", message["URI"])]))
+            elif message.name == "ClientGet" and message["URI"] == "KSK@slow":
+                self.send(Message("SimpleProgress", [identifier]))
+            elif message.name == "ClientGet" and message["URI"] in self.store:
+                self.send(Message("DataFound", [identifier]))
+                self.send(Message("AllData", [identifier]),
+                          self.store[message["URI"]])
+            elif message.name == "ClientGet":
+                self.send(Message("GetFailed",
+                                  [identifier, ("Code", 13),
+                                   ("CodeDescription", "Data not found")]))
+
+@unittest.skipIf(asyncio is None, "asyncio needs Python 3.")
+class AsyncioClientTest(unittest.TestCase):
+    "Tests the asyncio client against a small asyncio node."
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.store = {}
+        self.received = []
+        protocol = lambda: StoreServerProtocol(self.store, self.received)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(protocol, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.client = self.run_loop(aio.connect('127.0.0.1', port, self.loop))
+        self.addCleanup(self.close)
+
+    def close(self):
+        self.client.transport.close()
+        self.server.close()
+        self.run_loop(self.server.wait_closed())
+
+    def run_loop(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_put_get(self):
+        response = self.run_loop(self.client.put_direct("KSK@a", b"data"))
+        self.assertEqual(response["URI"], "KSK@a")
+        response = self.run_loop(self.client.get_direct("KSK@a"))
+        self.assertEqual(response["Data"], b"data")
+        self.assertEqual(len(self.client.router), 0)
+
+    def test_failure(self):
+        self.assertRaises(FetchException, self.run_loop,
+                          self.client.get_direct("KSK@missing"))
+
+    def test_cancel(self):
+        "Cancelling a request asks the node to remove it."
+        get = self.client.get_direct("KSK@slow")
+        self.loop.call_later(0.05, get.cancel)
+        self.assertRaises(asyncio.CancelledError, self.run_loop, get)
+        self.run_loop(asyncio.sleep(0.05))
+        self.assertEqual(self.received[-1], "RemoveRequest")
+        self.assertEqual(len(self.client.router), 0)
+
+    def test_timeout(self):
+        self.client.timeout = 0.05
+        self.assertRaises(NodeTimeout, self.run_loop,
+                          self.client.get_direct("KSK@slow"))
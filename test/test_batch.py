@@ -0,0 +1,81 @@
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.trial import unittest
+from twistedfcp.batch import ResultStream
+from twistedfcp.error import FetchException
+
+from test_basic import FCPBaseTest
+
+class ResultStreamTest(unittest.TestCase):
+    "Tests the concurrency and ordering of result streams."
+    def setUp(self):
+        self.requests = {}
+        self.taken = []
+
+    def request(self, item):
+        self.requests[item] = Deferred()
+        return self.requests[item]
+
+    def items(self, count):
+        "A lazy generator that records which items were taken."
+        for i in xrange(count):
+            self.taken.append(i)
+            yield i
+
+    def test_bounded(self):
+        "Only ``concurrency`` items are taken from a lazy generator at once."
+        stream = ResultStream(self.request, self.items(100), str, 
+                              concurrency=5)
+        self.assertEqual(self.taken, range(5))
+        self.requests[3].callback("three")
+        self.assertEqual(self.taken, range(6))
+
+    def test_completion_order(self):
+        "Results, including failures, stream back as requests complete."
+        stream = ResultStream(self.request, self.items(3), str, concurrency=3)
+        first, second = stream.next(), stream.next()
+        self.requests[2].callback("two")
+        self.requests[0].errback(ValueError("zero"))
+        self.assertEqual(self.successResultOf(first).result, "two")
+        failed = self.successResultOf(second)
+        self.assertFalse(failed.ok)
+        self.assertEqual(failed.key, "0")
+        self.assertTrue(failed.failure.check(ValueError))
+        third = stream.next()
+        self.assertNoResult(third)
+        self.requests[1].callback("one")
+        self.assertEqual(self.successResultOf(third).key, "1")
+        self.assertIdentical(self.successResultOf(stream.next()), None)
+
+    def test_synchronous(self):
+        "Thousands of results that are already available don't recurse."
+        stream = ResultStream(succeed, xrange(5000), str, concurrency=10)
+        results = self.successResultOf(stream.collect())
+        self.assertEqual(len(results), 5000)
+        self.assertEqual(results[-1].result, 4999)
+
+    def test_backpressure(self):
+        "Unread results stop new requests from being started."
+        stream = ResultStream(self.request, self.items(100), str,
+                              concurrency=2, buffered=2)
+        for i in xrange(3):
+            self.requests[i].callback(i)
+        self.assertEqual(self.taken, range(3))
+        self.successResultOf(stream.next())
+        self.assertEqual(self.taken, range(3))
+        self.successResultOf(stream.next())
+        self.assertEqual(self.taken, range(5))
+
+class BatchTest(FCPBaseTest):
+    "Tests batch requests against the node."
+    @inlineCallbacks
+    def test_put_get_many(self):
+        _ = yield self.client.deferred['NodeHello']
+        items = (("KSK@batch-{0}".format(i), str(i)) for i in xrange(50))
+        puts = yield self.client.put_many(items, concurrency=8).collect()
+        self.assertTrue(all(r.ok for r in puts))
+        uris = ["KSK@batch-{0}".format(i) for i in xrange(50)]
+        uris.append("KSK@missing")
+        gets = yield self.client.get_many(uris, concurrency=8).collect()
+        gets = dict((r.key, r) for r in gets)
+        self.assertEqual(gets["KSK@batch-7"].result["Data"], "7")
+        self.assertTrue(gets["KSK@missing"].failure.check(FetchException))
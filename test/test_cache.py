@@ -0,0 +1,100 @@
+import os
+import tempfile
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twistedfcp.cache import ContentCache, is_immutable
+from twistedfcp.message import Message
+from twistedfcp.stream import FileSink
+
+from test_basic import FCPBaseTest
+
+def all_data(data):
+    return Message("AllData", [("Identifier", "Request1"), 
+                               ("DataLength", str(len(data))), ("Data", data)])
+
+class ContentCacheTest(unittest.TestCase):
+    "Tests the memory and disk tiers of the content cache."
+    def test_immutable(self):
+        self.assertTrue(is_immutable("CHK@abc,def,AAIC--8/file.txt"))
+        self.assertTrue(is_immutable("SSK@abc,def,AQACAAE/site-3/index.html"))
+        self.assertTrue(is_immutable("USK@abc,def,AQACAAE/site/3/"))
+        self.assertFalse(is_immutable("USK@abc,def,AQACAAE/site/-3/"))
+        self.assertFalse(is_immutable("KSK@gpl.txt"))
+
+    def test_memory_lru(self):
+        cache = ContentCache(memory_bytes=10)
+        cache.put("CHK@a", all_data("aaaa"))
+        cache.put("CHK@b", all_data("bbbb"))
+        cache.get("CHK@a")
+        cache.put("CHK@c", all_data("cccc"))
+        self.assertEqual(cache.get("CHK@a")["Data"], "aaaa")
+        self.assertIdentical(cache.get("CHK@b"), None)
+        self.assertEqual(cache.stats['memory_hits'], 2)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_disk(self):
+        "Entries evicted from memory are still found on disk."
+        directory = self.mktemp()
+        cache = ContentCache(memory_bytes=4, directory=directory,
+                             disk_bytes=1000)
+        cache.put("CHK@a", all_data("aaaa"))
+        cache.put("CHK@b", all_data("bb=b"))
+        self.assertEqual(cache.get("CHK@a")["Data"], "aaaa")
+        self.assertEqual(cache.stats['disk_hits'], 1)
+
+        reopened = ContentCache(directory=directory)
+        message = reopened.get("CHK@b", FileSink(tempfile.TemporaryFile()))
+        message["Data"].seek(0)
+        self.assertEqual(message["Data"].read(), "bb=b")
+        self.assertNotIn("Identifier", message)
+
+    def test_copies(self):
+        "Hits are copies, without the identifier of the request that fetched."
+        cache = ContentCache()
+        cache.put("CHK@a", all_data("aaaa"))
+        first = cache.get("CHK@a")
+        first["Identifier"] = "Request2"
+        self.assertNotIn("Identifier", cache.get("CHK@a"))
+
+    def test_corrupt(self):
+        "Entries that are truncated or removed by hand count as misses."
+        directory = self.mktemp()
+        cache = ContentCache(memory_bytes=0, directory=directory)
+        cache.put("CHK@a", all_data("aaaa"))
+        cache.put("CHK@b", all_data("bbbb"))
+        name = cache.disk.name("CHK@a")
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write("AllData\nDataLength=4\n")
+        os.remove(os.path.join(directory, cache.disk.name("CHK@b")))
+        self.assertIdentical(cache.get("CHK@a"), None)
+        self.assertIdentical(cache.get("CHK@b"), None)
+        self.assertEqual(cache.stats['misses'], 2)
+        self.assertEqual(cache.disk.size, 0)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_disk_eviction(self):
+        cache = ContentCache(memory_bytes=0, directory=self.mktemp(),
+                             disk_bytes=150)
+        for uri in ("CHK@a", "CHK@b", "CHK@c"):
+            cache.put(uri, all_data("x" * 50))
+        self.assertIdentical(cache.get("CHK@a"), None)
+        self.assertEqual(cache.get("CHK@c")["Data"], "x" * 50)
+
+class CachedGetTest(FCPBaseTest):
+    "Tests that fetches of immutable keys are served from the cache."
+    @inlineCallbacks
+    def test_cached(self):
+        _ = yield self.client.deferred['NodeHello']
+        self.client.cache = ContentCache()
+        response = yield self.client.put_direct("CHK@", "cached data")
+        uri = response["URI"]
+        for _ in xrange(3):
+            response = yield self.client.get_direct(uri)
+            self.assertEqual(response["Data"], "cached data")
+        self.assertEqual(self.client.cache.stats['misses'], 1)
+        self.assertEqual(self.client.cache.stats['memory_hits'], 2)
+        _ = yield self.client.put_direct("KSK@mutable", "data")
+        _ = yield self.client.get_direct("KSK@mutable")
+        self.assertEqual(self.client.cache.stats['misses'], 1)
@@ -0,0 +1,79 @@
+from twisted.internet.defer import CancelledError, succeed
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.coalesce import SingleFlight
+from twistedfcp.error import FetchException
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+
+class CoalescedGetTest(unittest.TestCase):
+    "Tests that concurrent gets of the same key share a session."
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.timers = TimerWheel(clock=self.client.clock)
+        self.client.makeConnection(self.transport)
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+        self.flush()
+
+    def flush(self):
+        "Returns everything the client wrote since the last call."
+        self.client.clock.advance(0)
+        written = self.transport.value()
+        self.transport.clear()
+        return written
+
+    def test_shared(self):
+        gets = [self.client.get_direct("CHK@popular") for _ in xrange(5)]
+        other = self.client.get_direct("CHK@popular", MaxSize=10)
+        self.assertEqual(self.flush().count("ClientGet"), 2)
+        self.client.dataReceived("AllData\nIdentifier=Request{0}\n"
+                                 "DataLength=4\nData\nabcd"
+                                 .format(self.first_id()))
+        results = [self.successResultOf(get) for get in gets]
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(results[0]["Data"], "abcd")
+        self.assertNoResult(other)
+        self.assertEqual(len(self.client.flights), 1)
+
+    def first_id(self):
+        return min(int(i[len("Request"):]) for i in self.client.router.sessions)
+
+    def test_shared_failure(self):
+        gets = [self.client.get_direct("CHK@missing") for _ in xrange(3)]
+        self.client.dataReceived("GetFailed\nIdentifier=Request{0}\nCode=13\n"
+                                 "CodeDescription=Data not found\nEndMessage\n"
+                                 .format(self.first_id()))
+        for get in gets:
+            self.failureResultOf(get, FetchException)
+
+    def test_cancel(self):
+        "The session is only cancelled once every caller has cancelled."
+        first = self.client.get_direct("CHK@popular")
+        second = self.client.get_direct("CHK@popular")
+        self.flush()
+        first.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.assertEqual(len(self.client.router), 1)
+        self.assertNotIn("RemoveRequest", self.flush())
+        second.cancel()
+        self.failureResultOf(second, CancelledError)
+        self.assertEqual(len(self.client.router), 0)
+        self.assertIn("RemoveRequest\nIdentifier=", self.flush())
+        third = self.client.get_direct("CHK@popular")
+        self.assertIn("ClientGet", self.flush())
+
+class SingleFlightTest(unittest.TestCase):
+    "Tests coalescing requests directly."
+    def test_raises(self):
+        "A request that raises doesn't leave its key in flight."
+        flights = SingleFlight()
+        def fail():
+            raise ValueError()
+
+        self.failureResultOf(flights.call("key", fail), ValueError)
+        self.assertEqual(len(flights), 0)
+        self.assertEqual(self.successResultOf(flights.call("key", succeed, 1)),
+                         1)
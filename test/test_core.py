@@ -0,0 +1,83 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.core import Session, SessionRouter
+from twistedfcp.error import FetchException
+from twistedfcp.message import IdentifiedMessage, Message
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+
+class SessionRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = SessionRouter()
+        self.outcomes = []
+        def process(message):
+            if message.name == "AllData":
+                return message
+
+        for identifier in ("a", "b"):
+            started = Message("ClientGet", [("Identifier", identifier)])
+            finished = lambda outcome, result: self.outcomes.append(
+                (outcome, result))
+            self.router.add(Session(started, process, finished))
+
+    def receive(self, name, identifier, *args):
+        return self.router.dispatch(
+            Message(name, [("Identifier", identifier)] + list(args)))
+
+    def test_dispatch(self):
+        self.assertTrue(self.receive("SimpleProgress", "a"))
+        self.assertFalse(self.receive("SimpleProgress", "unknown"))
+        self.assertFalse(self.router.dispatch(Message("NodeHello", [])))
+        self.assertEqual(self.outcomes, [])
+
+        self.assertTrue(self.receive("AllData", "a"))
+        self.assertEqual(self.outcomes[0][0], "success")
+        self.assertNotIn("a", self.router)
+        self.assertFalse(self.receive("AllData", "a"))
+
+    def test_error(self):
+        self.receive("GetFailed", "b", ("Code", 13),
+                     ("CodeDescription", "Data not found"))
+        outcome, error = self.outcomes[0]
+        self.assertEqual(outcome, "GetFailed")
+        self.assertIsInstance(error, FetchException)
+        self.assertEqual(len(self.router), 1)
+
+class RoutedSessionTest(unittest.TestCase):
+    "Tests how the protocol routes messages to ``do_session`` handlers."
+    def setUp(self):
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.timers = TimerWheel(clock=self.client.clock)
+        self.client.makeConnection(StringTransport())
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+
+    def test_progress(self):
+        "Progress messages reach the handler without firing any Deferred."
+        seen = []
+        def process(message):
+            seen.append(message.name)
+            if message.name == "PutSuccessful":
+                return message
+
+        put = IdentifiedMessage("ClientPut", [("URI", "KSK@a")])
+        done = self.client.do_session(put, process, "data")
+        progress = "SimpleProgress\nIdentifier={0}\nEndMessage\n"
+        self.client.dataReceived(progress.format(put.id) * 3)
+        self.assertEqual(dict(self.client.sessions), {})
+        self.assertNoResult(done)
+        self.client.dataReceived("PutSuccessful\nIdentifier={0}\nEndMessage\n"
+                                 .format(put.id))
+        self.assertEqual(seen, ["SimpleProgress"] * 3 + ["PutSuccessful"])
+        self.assertEqual(self.successResultOf(done).name, "PutSuccessful")
+        self.assertEqual(len(self.client.router), 0)
+
+    def test_handler_error(self):
+        "A handler that raises ends its session with the exception."
+        get = IdentifiedMessage("ClientGet", [("URI", "KSK@a")])
+        done = self.client.do_session(get, lambda message: 1 / 0)
+        self.client.dataReceived("DataFound\nIdentifier={0}\nEndMessage\n"
+                                 .format(get.id))
+        self.failureResultOf(done, ZeroDivisionError)
+        self.assertEqual(len(self.client.router), 0)
@@ -0,0 +1,123 @@
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twistedfcp.error import FetchException
+from twistedfcp.message import Message
+
+from test_basic import ClientTest, LoopbackBaseTest
+from simple_server import RecordingFactory
+
+class DirectAccessTest(LoopbackBaseTest):
+    "Tests direct disk access, and falling back when the node is denied it."
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.server = reactor.listenTCP(self.port, self.factory)
+        self.directory = os.path.abspath(self.mktemp())
+        os.makedirs(self.directory)
+        self.filename = os.path.join(self.directory, "file.bin")
+        with open(self.filename, 'wb') as f:
+            f.write("data" * 1000)
+        return ClientTest.setUp(self)
+
+    def sent(self, name):
+        return [m for m in self.factory.messages if m.name == name]
+
+    @inlineCallbacks
+    def test_check(self):
+        "Tests are cached, and leave no files behind."
+        _ = yield self.client.deferred['NodeHello']
+        allowed = yield self.client.dda.check(self.directory)
+        self.assertEqual(allowed, (True, True))
+        allowed = yield self.client.dda.can_read(self.directory)
+        self.assertTrue(allowed)
+        self.assertEqual(len(self.sent("TestDDARequest")), 1)
+        self.assertEqual(os.listdir(self.directory), ["file.bin"])
+
+    @inlineCallbacks
+    def test_check_kinds(self):
+        "Only the access that is needed is tested, one test at a time."
+        _ = yield self.client.deferred['NodeHello']
+        read = self.client.dda.can_read(self.directory)
+        written = self.client.dda.can_write(self.directory)
+        allowed = yield read
+        self.assertTrue(allowed)
+        allowed = yield written
+        self.assertTrue(allowed)
+        requests = self.sent("TestDDARequest")
+        self.assertEqual([m.get("WantReadDirectory") for m in requests],
+                         ["true", None])
+        self.assertEqual([m.get("WantWriteDirectory") for m in requests],
+                         [None, "true"])
+        allowed = yield self.client.dda.check(self.directory)
+        self.assertEqual(allowed, (True, True))
+        self.assertEqual(len(self.sent("TestDDARequest")), 2)
+        self.assertEqual(os.listdir(self.directory), ["file.bin"])
+
+    @inlineCallbacks
+    def test_disk(self):
+        _ = yield self.client.deferred['NodeHello']
+        put = yield self.client.put_file("KSK@file", self.filename)
+        self.assertEqual(put["URI"], "KSK@file")
+        target = os.path.join(self.directory, "copy.bin")
+        found = yield self.client.get_file("KSK@file", target)
+        self.assertEqual(found.name, "DataFound")
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), "data" * 1000)
+        self.assertEqual(self.sent("ClientPut")[0]["UploadFrom"], "disk")
+        self.assertEqual(self.sent("ClientGet")[0]["ReturnType"], "disk")
+        self.assertNotIn("DataLength", self.sent("ClientPut")[0])
+
+    @inlineCallbacks
+    def test_denied(self):
+        "Transfers go through the connection if the node is denied access."
+        self.factory.protocol = type("Denied", (self.factory.protocol,),
+                                     dict(dda=False))
+        self.client.transport.loseConnection()
+        _ = yield ClientTest.setUp(self)
+        _ = yield self.client.deferred['NodeHello']
+        _ = yield self.client.put_file("KSK@file", self.filename)
+        target = os.path.join(self.directory, "copy.bin")
+        found = yield self.client.get_file("KSK@file", target)
+        self.assertEqual(found.name, "AllData")
+        self.assertTrue(found["Data"].closed)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), "data" * 1000)
+        self.assertFalse(self.client.dda.allowed[(self.directory, 'read')])
+        self.assertFalse(self.client.dda.allowed[(self.directory, 'write')])
+        self.assertNotIn("UploadFrom", self.sent("ClientPut")[0])
+        self.assertEqual(len(self.sent("TestDDARequest")), 2)
+
+        missing = os.path.join(self.directory, "missing.bin")
+        try:
+            _ = yield self.client.get_file("KSK@missing", missing)
+        except FetchException:
+            pass
+        else:
+            self.fail("The get should have failed.")
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["copy.bin", "file.bin"])
+
+    @inlineCallbacks
+    def test_refused(self):
+        "A node that refuses to test a directory denies access to it."
+        def TestDDARequest(server, message):
+            server.sendMessage(Message("ProtocolError",
+                                       [("Code", 28),
+                                        ("CodeDescription",
+                                         "Direct disk access denied")]))
+        self.factory.protocol = type("Refusing", (self.factory.protocol,),
+                                     dict(TestDDARequest=TestDDARequest))
+        self.client.transport.loseConnection()
+        _ = yield ClientTest.setUp(self)
+        _ = yield self.client.deferred['NodeHello']
+        self.client.timeout = 5
+        _ = yield self.client.put_file("KSK@file", self.filename)
+        target = os.path.join(self.directory, "copy.bin")
+        found = yield self.client.get_file("KSK@file", target)
+        self.assertEqual(found.name, "AllData")
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), "data" * 1000)
+        self.assertFalse(self.client.dda.allowed[(self.directory, 'read')])
+        self.assertFalse(self.client.dda.allowed[(self.directory, 'write')])
+        self.assertEqual(self.client.dda.pending, [])
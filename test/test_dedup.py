@@ -0,0 +1,64 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twistedfcp.dedup import DedupIndex, digest
+
+from test_basic import ClientTest, LoopbackBaseTest
+from simple_server import RecordingFactory
+
+class DedupTest(LoopbackBaseTest):
+    "Tests that content is only inserted once."
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.server = reactor.listenTCP(self.port, self.factory)
+        self.path = self.mktemp()
+        self.index = DedupIndex(self.path)
+        self.addCleanup(self.index.close)
+        connected = ClientTest.setUp(self)
+        def hello(_):
+            self.client.dedup = self.index
+            return self.client.deferred['NodeHello']
+
+        return connected.addCallback(hello)
+
+    def puts(self):
+        "Returns the ``GetCHKOnly`` value of every ``ClientPut`` sent."
+        return [m.get("GetCHKOnly") for m in self.factory.messages
+                if m.name == "ClientPut"]
+
+    @inlineCallbacks
+    def test_put_direct(self):
+        first = yield self.client.put_direct("CHK@", "content")
+        second = yield self.client.put_direct("CHK@", "content")
+        self.assertEqual(second["URI"], first["URI"])
+        self.assertEqual(second["Deduplicated"], "true")
+        self.assertEqual(self.puts(), [None])
+        _ = yield self.client.put_direct("CHK@", "content", DontCompress="true")
+        _ = yield self.client.put_direct("KSK@a", "content")
+        _ = yield self.client.put_direct("KSK@a", "content")
+        self.assertEqual(self.puts(), [None] * 4)
+        self.assertEqual(self.index.stats['hits'], 1)
+
+    @inlineCallbacks
+    def test_persistent(self):
+        put = yield self.client.put_direct("CHK@", "content")
+        self.index.close()
+        self.index = DedupIndex(self.path)
+        self.addCleanup(self.index.close)
+        self.assertTrue(self.index.known(put["URI"]))
+
+    @inlineCallbacks
+    def test_put_many(self):
+        "Content put before, even with other neutral fields, isn't put again."
+        _ = yield self.client.put_direct("CHK@", "old", ClientToken="old",
+                                         PriorityClass=1)
+        items = [("CHK@", "old"), ("CHK@", "new"), ("CHK@", "new")]
+        stream = self.index.put_many(self.client, items, concurrency=3)
+        results = yield stream.collect()
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(len(set(r.result["URI"] for r in results)), 2)
+        self.assertEqual(sorted(r.key for r in results),
+                         sorted((uri, digest(data)) for uri, data in items))
+        self.assertEqual(self.puts(), [None, None])
+        self.assertEqual(self.index.stats['hits'], 1)
+        store = self.factory.servers[0].store
+        self.assertIn("new", store.values())
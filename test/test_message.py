@@ -0,0 +1,28 @@
+from twisted.trial import unittest
+from twistedfcp.message import Message, IdentifiedMessage
+
+class MessageTest(unittest.TestCase):
+    "Tests field lookup and modification of messages."
+    def test_lookup(self):
+        msg = Message("Peer", [("identity", "0x1"), ("opennet", "false")])
+        self.assertEqual(msg["identity"], "0x1")
+        self.assertTrue("opennet" in msg)
+        self.assertFalse("location" in msg)
+        self.assertEqual(msg.get("location", "none"), "none")
+        self.assertRaises(KeyError, lambda: msg["location"])
+
+    def test_set(self):
+        "Setting fields keeps arguments in order and in sync with the index."
+        msg = Message("ClientGet", [("URI", "KSK@a"), ("Verbosity", 1)])
+        msg["URI"] = "KSK@b"
+        msg["MaxRetries"] = 3
+        self.assertEqual(msg.args, [("URI", "KSK@b"), ("Verbosity", 1),
+                                    ("MaxRetries", 3)])
+        self.assertEqual(msg["URI"], "KSK@b")
+
+    def test_identified(self):
+        first = IdentifiedMessage("ClientGet", [])
+        second = IdentifiedMessage("ClientGet", [])
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(first.args, [("Identifier", first.id)])
+        self.assertFalse(hasattr(first, "__dict__"))
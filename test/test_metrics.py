@@ -0,0 +1,126 @@
+from zope.interface import implementer
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.iweb import IBodyProducer
+from twistedfcp.error import FetchException, NodeTimeout
+from twistedfcp.message import Message
+from twistedfcp.metrics import Metrics
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+
+class MetricsTest(unittest.TestCase):
+    def test_snapshot(self):
+        metrics = Metrics(buckets=[1, 10])
+        metrics.increment('requests', (('kind', 'get'),))
+        metrics.increment('requests', (('kind', 'get'),), 2)
+        metrics.adjust('open', (), 3)
+        metrics.adjust('open', (), -1)
+        for value in (0.5, 5, 50):
+            metrics.observe('seconds', (), value)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['requests{kind="get"}'], 3)
+        self.assertEqual(snapshot['open'], 2)
+        self.assertEqual(snapshot['seconds'],
+                         dict(count=3, sum=55.5,
+                              buckets=[(1, 1), (10, 2), ('+Inf', 3)]))
+
+    def test_prometheus(self):
+        metrics = Metrics(buckets=[1])
+        metrics.increment('sent_total', (('message', 'Say "hi"'),))
+        metrics.observe('seconds', (('outcome', 'success'),), 2)
+        self.assertEqual(metrics.prometheus().splitlines(), [
+            '# TYPE sent_total counter',
+            'sent_total{message="Say \\"hi\\""} 1',
+            '# TYPE seconds histogram',
+            'seconds_bucket{outcome="success",le="1"} 0',
+            'seconds_bucket{outcome="success",le="+Inf"} 1',
+            'seconds_sum{outcome="success"} 2.0',
+            'seconds_count{outcome="success"} 1'])
+
+class ProtocolMetricsTest(unittest.TestCase):
+    "Tests what the protocol reports about its messages and sessions."
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.timers = TimerWheel(clock=self.client.clock)
+        self.client.metrics = self.metrics = Metrics()
+        self.client.makeConnection(self.transport)
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+        self.client.clock.advance(0)
+
+    def session(self, message, labels):
+        key = ('fcp_session_seconds', (('message', message),) + labels)
+        return self.metrics.histograms[key]
+
+    def test_sessions(self):
+        get = self.client.get_direct("KSK@a")
+        failed = self.client.get_direct("KSK@b")
+        self.client.clock.advance(2)
+        self.assertEqual(self.metrics.gauges[('fcp_sessions_in_flight',
+                                              (('message', 'ClientGet'),))], 2)
+        self.client.dataReceived("AllData\nIdentifier={0}\nDataLength=2\n"
+                                 "Data\nhi".format(self.identifier("KSK@a")))
+        self.client.dataReceived("GetFailed\nIdentifier={0}\nCode=13\n"
+                                 "CodeDescription=Data not found\n"
+                                 "EndMessage\n"
+                                 .format(self.identifier("KSK@b")))
+        self.successResultOf(get)
+        self.failureResultOf(failed, FetchException)
+
+        success = self.session('ClientGet', (('outcome', 'success'),))
+        self.assertEqual((success.count, success.sum), (1, 2.0))
+        self.assertEqual(self.session('ClientGet',
+                                      (('outcome', 'GetFailed'),)).count, 1)
+        self.assertEqual(self.metrics.gauges[('fcp_sessions_in_flight',
+                                              (('message', 'ClientGet'),))], 0)
+        counters = self.metrics.counters
+        self.assertEqual(counters[('fcp_messages_sent_total',
+                                   (('message', 'ClientGet'),))], 2)
+        self.assertEqual(counters[('fcp_messages_received_total',
+                                   (('message', 'AllData'),))], 1)
+        self.assertEqual(counters[('fcp_bytes_sent_total', ())],
+                         len(self.transport.value()))
+
+    def identifier(self, uri):
+        for line in self.transport.value().split("ClientGet\n")[1:]:
+            fields = dict(l.split('=', 1) for l in line.split('\n')
+                          if '=' in l)
+            if fields['URI'] == uri:
+                return fields['Identifier']
+
+    def test_timeout(self):
+        get = self.client.get_direct("KSK@slow")
+        self.client.clock.advance(self.client.timeout + 1)
+        self.failureResultOf(get, NodeTimeout)
+        self.assertEqual(self.session('ClientGet',
+                                      (('outcome', 'timeout'),)).count, 1)
+
+    def test_failed_body(self):
+        "Only the part of a streamed body that was written counts as sent."
+        sent = self.client.sendMessage(Message("ClientPut", []),
+                                       HalfProducer())
+        self.failureResultOf(sent, IOError)
+        self.assertEqual(self.metrics.counters[('fcp_bytes_sent_total', ())],
+                         len(self.transport.value()))
+        self.assertTrue(self.transport.value().endswith("Data\nabc"))
+
+@implementer(IBodyProducer)
+class HalfProducer(object):
+    "A body producer that writes half of its body, then fails."
+    length = 6
+
+    def startProducing(self, consumer):
+        consumer.write("abc")
+        return fail(IOError("Disk error"))
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
@@ -0,0 +1,139 @@
+import os
+import random
+
+from twisted.internet import protocol, reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twistedfcp.error import FetchException, PutException
+from twistedfcp.message import Message
+from twistedfcp.progress import ProgressCoalescer
+from twistedfcp.protocol import FreenetClientProtocol
+
+from test_basic import ClientTest, LoopbackBaseTest
+from mock_node import (MockNodeFactory, MockStore, KeyProfile, Link,
+                       FailureInjector, constant, exponential, parse_profiles)
+
+class MockNodeTest(LoopbackBaseTest):
+    "Tests the mock node's shared store, latency, progress and failures."
+    def setUp(self):
+        self.factory = MockNodeFactory(profiles={
+            'KSK': KeyProfile(constant(0.2)),
+        }, seed=1)
+        self.server = reactor.listenTCP(self.port, self.factory)
+        return ClientTest.setUp(self)
+
+    def tearDown(self):
+        if hasattr(self, "other"):
+            self.other.transport.loseConnection()
+        return ClientTest.tearDown(self)
+
+    @inlineCallbacks
+    def test_shared_store(self):
+        "Data put on one connection can be got on another."
+        creator = protocol.ClientCreator(reactor, FreenetClientProtocol)
+        self.other = yield creator.connectTCP('localhost', self.port)
+        _ = yield self.client.deferred['NodeHello']
+        _ = yield self.other.deferred['NodeHello']
+        put = yield self.client.put_direct("CHK@", "data")
+        got = yield self.other.get_direct(put["URI"])
+        self.assertEqual(got["Data"], "data")
+        self.assertEqual(self.factory.stats['connections'], 2)
+
+    @inlineCallbacks
+    def test_latency_and_progress(self):
+        _ = yield self.client.deferred['NodeHello']
+        self.client.progress = ProgressCoalescer(interval=0.01)
+        seen = []
+        started = reactor.seconds()
+        _ = yield self.client.put_direct("KSK@a", "data",
+                                         on_progress=seen.append)
+        self.assertTrue(reactor.seconds() - started >= 0.2)
+        self.assertTrue(seen)
+        self.assertEqual(seen[0].name, "SimpleProgress")
+        got = yield self.client.get_direct("KSK@a")
+        self.assertEqual(got["Data"], "data")
+
+    @inlineCallbacks
+    def test_not_found(self):
+        _ = yield self.client.deferred['NodeHello']
+        try:
+            _ = yield self.client.get_direct("CHK@missing")
+        except FetchException as e:
+            self.assertEqual(e.code, 13)
+        else:
+            self.fail("The get should have failed.")
+
+    @inlineCallbacks
+    def test_failure_injection(self):
+        self.factory.failures = FailureInjector(1.0, {
+            'ClientPut': [('PutFailed', 10)],
+        })
+        _ = yield self.client.deferred['NodeHello']
+        try:
+            _ = yield self.client.put_direct("KSK@b", "data")
+        except PutException as e:
+            self.assertEqual(e.code, 10)
+        else:
+            self.fail("The put should have failed.")
+        self.assertEqual(self.factory.stats['failures'], 1)
+        self.assertNotIn("KSK@b", self.factory.store)
+
+    @inlineCallbacks
+    def test_ssk_keypair(self):
+        _ = yield self.client.deferred['NodeHello']
+        insert, request = yield self.client.get_ssk_keypair()
+        self.assertTrue(insert.startswith("SSK@"))
+        self.assertTrue(request.startswith("SSK@"))
+
+class ModelTest(unittest.TestCase):
+    "Tests the building blocks of the mock node."
+    def test_link(self):
+        "Transfers on a link queue behind each other."
+        link = Link(100)
+        self.assertEqual(link.reserve(100, 0.0), 1.0)
+        self.assertEqual(link.reserve(50, 0.5), 1.0)
+        self.assertEqual(link.reserve(50, 10.0), 0.5)
+        self.assertEqual(Link().reserve(10 ** 9, 0.0), 0.0)
+
+    def test_distributions(self):
+        rng = random.Random(0)
+        self.assertEqual(constant(2)(rng), 2)
+        delays = [exponential(1.0)(rng) for _ in xrange(1000)]
+        self.assertTrue(0.8 < sum(delays) / len(delays) < 1.2)
+
+    def test_parse_profiles(self):
+        profiles = parse_profiles(["chk=uniform:1,2"], ["CHK=1000"])
+        delay = profiles['CHK'].latency(random.Random(0))
+        self.assertTrue(1 <= delay <= 2)
+        self.assertEqual(profiles['CHK'].link.bandwidth, 1000)
+
+    def test_unknown_error(self):
+        self.assertRaises(ValueError, FailureInjector, 0.5,
+                          {'ClientGet': [('NoSuchError', 1)]})
+
+    def test_disk_store(self):
+        "A store on disk outlives the node."
+        directory = os.path.abspath(self.mktemp())
+        MockStore(directory)["KSK@a"] = "data"
+        store = MockStore(directory)
+        self.assertIn("KSK@a", store)
+        self.assertEqual(store["KSK@a"], "data")
+        self.assertRaises(KeyError, store.__getitem__, "KSK@b")
+
+    def test_clock(self):
+        "Requests are answered on the factory's clock."
+        clock = Clock()
+        factory = MockNodeFactory(default=KeyProfile(constant(5.0)),
+                                  clock=clock)
+        node = factory.buildProtocol(None)
+        sent = []
+        node.sendMessage = lambda message, data=None: sent.append(message.name)
+        node.store["KSK@a"] = "data"
+        node.message_received(FreenetClientProtocol.hello)
+        node.message_received(Message("ClientGet", [("URI", "KSK@a"),
+                                                    ("Identifier", "1")]))
+        self.assertEqual(sent, ["NodeHello"])
+        clock.advance(5)
+        self.assertEqual(sent[-2:], ["DataFound", "AllData"])
+        self.assertEqual(sent.count("SimpleProgress"), 3)
@@ -0,0 +1,164 @@
+from twisted.trial import unittest
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twistedfcp.error import NodeTimeout
+from twistedfcp.message import Message, IdentifiedMessage
+from twistedfcp.metrics import Metrics
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.stream import IterableProducer
+from twistedfcp.timer import TimerWheel
+from twistedfcp.util import encode_message
+
+class RecordingTransport(StringTransport):
+    "A transport that records each call to ``writeSequence``."
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.sequences = []
+
+    def writeSequence(self, data):
+        self.sequences.append(data)
+        StringTransport.writeSequence(self, data)
+
+class OutputTest(unittest.TestCase):
+    "Tests the encoding and coalescing of outgoing messages."
+    def setUp(self):
+        self.transport = RecordingTransport()
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.makeConnection(self.transport)
+
+    def hello(self):
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+
+    def test_encode(self):
+        msg = Message("ClientGet", [("URI", "KSK@a"), ("Verbosity", 1)])
+        self.assertEqual(encode_message(msg),
+                         "ClientGet\nURI=KSK@a\nVerbosity=1\nEndMessage\n")
+        self.assertEqual(encode_message(msg, 10),
+                         "ClientGet\nURI=KSK@a\nVerbosity=1\n"
+                         "DataLength=10\nData\n")
+
+    def test_held_until_hello(self):
+        "Requests made before the NodeHello are sent right after it."
+        self.client.clock.advance(0)
+        self.assertEqual(self.transport.value(), 
+                         "ClientHello\nName=Epoxy\nExpectedVersion=2.0\n"
+                         "EndMessage\n")
+        self.client.sendMessage(Message("ListPeers", []))
+        self.client.clock.advance(0)
+        self.assertNotIn("ListPeers", self.transport.value())
+        self.hello()
+        self.client.clock.advance(0)
+        self.assertIn("ListPeers", self.transport.value())
+
+    def test_coalesced(self):
+        "All messages sent during one reactor iteration are written at once."
+        self.hello()
+        self.client.clock.advance(0)
+        del self.transport.sequences[:]
+        for i in xrange(100):
+            self.client.sendMessage(IdentifiedMessage("ClientGet", 
+                                                      [("URI", "KSK@a")]))
+        self.client.sendMessage(Message("ClientPut", []), "data")
+        self.assertEqual(self.transport.sequences, [])
+        self.client.clock.advance(0)
+        self.assertEqual(len(self.transport.sequences), 1)
+        self.assertTrue(self.transport.value().endswith("Data\ndata"))
+
+    def test_timers_use_clock(self):
+        "Session timeouts run on the protocol's clock."
+        self.assertIdentical(self.client.timers.clock, self.client.clock)
+        self.hello()
+        self.client.timeout = 5
+        get = self.client.get_direct("KSK@a")
+        self.client.clock.advance(6)
+        self.failureResultOf(get, NodeTimeout)
+
+    def test_lost_while_held(self):
+        "Messages still held when the connection is lost fail."
+        sent = self.client.sendMessage(Message("ListPeers", []))
+        self.client.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(sent, ConnectionLost)
+
+class FlowControlTest(unittest.TestCase):
+    "Tests that writes wait while the transport (or the queue) is full."
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.timers = TimerWheel(clock=self.client.clock)
+        self.client.makeConnection(self.transport)
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+        self.client.clock.advance(0)
+
+    def test_registered(self):
+        self.assertIdentical(self.transport.producer, self.client)
+        self.assertTrue(self.transport.streaming)
+
+    def test_transport_paused(self):
+        "Puts wait until the transport resumes the protocol."
+        self.client.pauseProducing()
+        self.assertFalse(self.client.writable)
+        self.client.put_direct("KSK@a", "data")
+        self.client.clock.advance(0)
+        self.assertNotIn("ClientPut", self.transport.value())
+        self.client.resumeProducing()
+        self.client.clock.advance(0)
+        self.assertIn("ClientPut", self.transport.value())
+
+    def test_watermarks(self):
+        "Once ``high_water`` bytes are queued, writes wait for ``low_water``."
+        self.client.high_water, self.client.low_water = 100, 10
+        self.client.sendMessage(Message("ClientPut", []), "x" * 100)
+        self.assertFalse(self.client.writable)
+        waiting = self.client.wait_writable()
+        self.assertNoResult(waiting)
+        self.client.clock.advance(0)
+        self.assertEqual(self.client.queued, 0)
+        self.successResultOf(waiting)
+
+    def test_cancelled(self):
+        "A put that is cancelled while waiting is never sent."
+        metrics = self.client.metrics = Metrics()
+        self.client.pauseProducing()
+        put = self.client.put_direct("KSK@a", "data")
+        put.cancel()
+        self.failureResultOf(put)
+        self.assertEqual(self.client.writable_waiters, [])
+        labels = (('message', 'ClientPut'),)
+        self.assertEqual(metrics.gauges[('fcp_sessions_in_flight', labels)], 0)
+        outcomes = [key[1][-1][1] for key in metrics.histograms
+                    if key[0] == 'fcp_session_seconds']
+        self.assertEqual(outcomes, ['cancelled'])
+        self.client.resumeProducing()
+        self.client.clock.advance(0)
+        self.assertNotIn("ClientPut", self.transport.value())
+        self.assertNotIn("RemoveRequest", self.transport.value())
+
+    def test_timeout_after_send(self):
+        "The timeout of a put starts once it is sent, not while it waits."
+        self.client.timeout = 5
+        self.client.pauseProducing()
+        put = self.client.put_direct("KSK@a", "data")
+        self.client.clock.advance(10)
+        self.assertNoResult(put)
+        self.client.resumeProducing()
+        self.client.clock.advance(0)
+        self.assertIn("ClientPut", self.transport.value())
+        self.client.clock.advance(6)
+        self.failureResultOf(put, NodeTimeout)
+
+    def test_body_paused(self):
+        "A body being streamed is paused along with the protocol."
+        self.client.pauseProducing()
+        sent = self.client.sendMessage(Message("ClientPut", []),
+                                       IterableProducer(["abc", "def"], 6))
+        self.assertTrue(self.client.body_paused)
+        self.client.resumeProducing()
+        self.assertFalse(self.client.body_paused)
+        def check(_):
+            self.assertTrue(self.transport.value().endswith("Data\nabcdef"))
+
+        return sent.addCallback(check)
@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+from twistedfcp.error import MalformedMessageException
+
+from test_stream import RecordingProtocol, all_data
+
+class HeaderParsingTest(unittest.TestCase):
+    "Tests parsing whole header blocks."
+    def setUp(self):
+        self.protocol = RecordingProtocol()
+        self.protocol.makeConnection(StringTransport())
+
+    def test_burst(self):
+        "Many messages arriving in one read are all parsed, in order."
+        wire = ''.join("Peer\nidentity={0}\nEndMessage\n".format(i)
+                       for i in xrange(100)) + "EndListPeers\nEndMessage\n"
+        self.protocol.dataReceived(wire)
+        self.assertEqual(len(self.protocol.received), 101)
+        self.assertEqual(self.protocol.received[42][1]["identity"], "42")
+        self.assertEqual(self.protocol.received[-1][0], "EndListPeers")
+
+    def test_split_on_first_equals(self):
+        self.protocol.dataReceived("PutSuccessful\nURI=CHK@abc=,def=\n"
+                                   "EndMessage\n")
+        message = self.protocol.received[0][1]
+        self.assertEqual(message["URI"], "CHK@abc=,def=")
+        self.assertEqual(message.args, [("URI", "CHK@abc=,def=")])
+
+    def test_split_terminator(self):
+        "The header terminator may be split across reads."
+        wire = "NodeHello\nFCPVersion=2.0\nEndMessage\n"
+        for i in xrange(1, len(wire)):
+            protocol = RecordingProtocol()
+            protocol.makeConnection(StringTransport())
+            protocol.dataReceived(wire[:i])
+            protocol.dataReceived(wire[i:])
+            self.assertEqual(len(protocol.received), 1)
+            self.assertEqual(protocol.received[0][1]["FCPVersion"], "2.0")
+
+    def test_payload_like_terminator(self):
+        "Payloads that look like header terminators are read as data."
+        payload = "EndMessage\nData\n"
+        self.protocol.dataReceived(all_data(payload) +
+                                   "EndListPeers\nEndMessage\n")
+        self.assertEqual(self.protocol.received[0][1]["Data"], payload)
+        self.assertEqual(self.protocol.received[1][0], "EndListPeers")
+
+    def test_malformed(self):
+        self.assertRaises(MalformedMessageException, self.protocol.dataReceived,
+                          "Peer\nno value here\nEndMessage\n")
+        self.assertRaises(MalformedMessageException, self.protocol.dataReceived,
+                          "AllData\nIdentifier=a\nData\n")
+
+    def test_header_too_long(self):
+        "A header block that never ends isn't buffered forever."
+        self.protocol.max_header_size = 100
+        self.protocol.dataReceived("Peer\n")
+        self.assertRaises(MalformedMessageException, self.protocol.dataReceived,
+                          "identity=x\n" * 20)
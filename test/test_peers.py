@@ -0,0 +1,88 @@
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.protocol import FreenetClientProtocol
+
+class PeerTableTest(unittest.TestCase):
+    "Tests that the peer table is cached, and refreshed with diffs."
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = FreenetClientProtocol()
+        self.client.clock = Clock()
+        self.client.makeConnection(self.transport)
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+        self.client.clock.advance(0)
+        self.transport.clear()
+        self.table = self.client.peer_table(interval=10, volatile=True)
+        self.diffs = []
+        self.table.subscribe(self.diffs.append)
+
+    def requests(self):
+        "Returns the number of ListPeers sent since the last call."
+        self.client.clock.advance(0)
+        self.sent = self.transport.value()
+        self.transport.clear()
+        return self.sent.count("ListPeers\n")
+
+    def answer(self, *peers):
+        self.client.dataReceived(''.join(
+            "Peer\nidentity={0}\nvolatile.status={1}\nEndMessage\n"
+            .format(identity, status) for identity, status in peers) +
+            "EndListPeers\nEndMessage\n")
+
+    def test_refresh(self):
+        self.assertEqual(self.requests(), 1)
+        self.assertIn("WithVolatile=true", self.sent)
+        self.answer(("a", "CONNECTED"), ("b", "CONNECTED"))
+        self.assertEqual(sorted(self.diffs[0].added), ["a", "b"])
+        self.assertEqual(self.table.get("a")["volatile.status"], "CONNECTED")
+
+        peers = self.successResultOf(self.table.get_peers(max_age=60))
+        self.assertEqual(sorted(peers), ["a", "b"])
+        self.assertEqual(self.requests(), 0)
+
+        self.client.clock.advance(10)
+        self.assertEqual(self.requests(), 1)
+        self.answer(("a", "BACKED OFF"), ("c", "CONNECTED"))
+        diff = self.diffs[1]
+        self.assertEqual(list(diff.added), ["c"])
+        self.assertEqual(list(diff.removed), ["b"])
+        self.assertEqual(diff.changed, {"a": {"volatile.status":
+                                              ("CONNECTED", "BACKED OFF")}})
+
+        self.client.clock.advance(10)
+        self.answer(("a", "BACKED OFF"), ("c", "CONNECTED"))
+        self.assertEqual(len(self.diffs), 2)
+
+    def test_stale(self):
+        "Reads older than the staleness bound share one refresh."
+        self.answer(("a", "CONNECTED"))
+        self.requests()
+        self.client.clock.advance(5)
+        first = self.table.get_peers(max_age=1)
+        second = self.table.get_peers(max_age=1)
+        self.assertEqual(self.requests(), 1)
+        self.answer(("a", "CONNECTED"), ("b", "CONNECTED"))
+        self.assertEqual(sorted(self.successResultOf(first)), ["a", "b"])
+        self.assertEqual(sorted(self.successResultOf(second)), ["a", "b"])
+
+    def test_overlapping(self):
+        "A list asked for during a refresh is sent once the refresh ends."
+        self.assertEqual(self.requests(), 1)
+        peers = self.client.get_all_peers()
+        self.assertEqual(self.requests(), 0)
+        self.answer(("a", "CONNECTED"))
+        self.assertEqual(sorted(self.table.peers), ["a"])
+        self.assertNoResult(peers)
+        self.assertEqual(self.requests(), 1)
+        self.answer(("a", "CONNECTED"), ("b", "CONNECTED"))
+        self.assertEqual([dict(p)["identity"] for p in
+                          self.successResultOf(peers)], ["a", "b"])
+        self.assertEqual(sorted(self.table.peers), ["a"])
+
+    def test_connection_lost(self):
+        self.client.connectionLost(Failure(ConnectionLost()))
+        self.client.clock.advance(30)
+        self.assertEqual(self.client.clock.getDelayedCalls(), [])
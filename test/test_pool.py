@@ -0,0 +1,84 @@
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.internet.error import ConnectionDone
+from twisted.trial import unittest
+from twistedfcp.pool import FCPPool
+
+from simple_server import TestServerFactory
+
+class SharedStoreFactory(TestServerFactory):
+    "Test server whose connections share one store and count their requests."
+    def __init__(self):
+        self.store = {}
+        self.requests = 0
+
+    def buildProtocol(self, addr):
+        server = TestServerFactory.buildProtocol(self, addr)
+        server.store = self.store
+        message_received = server.message_received
+        def count(message):
+            self.requests += 1
+            message_received(message)
+
+        server.message_received = count
+        return server
+
+@inlineCallbacks
+def wait_for(condition, interval=0.05):
+    "Polls ``condition`` until it holds."
+    while not condition():
+        yield task.deferLater(reactor, interval, lambda: None)
+
+class PoolTest(unittest.TestCase):
+    "Tests routing requests across several nodes."
+    ports = [9996, 9997]
+
+    def setUp(self):
+        self.factories = [SharedStoreFactory() for _ in self.ports]
+        self.servers = [reactor.listenTCP(port, factory)
+                        for port, factory in zip(self.ports, self.factories)]
+        self.pool = FCPPool([('localhost', port) for port in self.ports],
+                            size=2, timeout=5)
+        self.pool.retry_delay = 0.1
+        self.pool.start()
+
+    def tearDown(self):
+        stopped = [s.stopListening() for s in self.servers]
+        return gatherResults([self.pool.stop()] + stopped)
+
+    @inlineCallbacks
+    def test_balanced(self):
+        "Concurrent requests are spread across all connections."
+        yield wait_for(lambda: len(self.pool.connections()) == 4)
+        for factory in self.factories:
+            factory.requests = 0
+        puts = [self.pool.put_direct("KSK@key{0}".format(i), "data")
+                for i in xrange(40)]
+        yield gatherResults(puts)
+        self.assertEqual([f.requests for f in self.factories], [20, 20])
+
+    @inlineCallbacks
+    def test_failover(self):
+        "Requests go to healthy nodes, and nodes rejoin when they recover."
+        yield wait_for(lambda: len(self.pool.connections()) == 4)
+        down, up = self.pool.nodes
+        yield self.servers[0].stopListening()
+        for connection in down.connections:
+            connection.transport.loseConnection()
+        yield wait_for(lambda: not down.healthy)
+
+        response = yield self.pool.put_direct("KSK@failover", "data")
+        self.assertEqual(response["URI"], "KSK@failover")
+        self.assertTrue(up.healthy)
+
+        self.servers[0] = reactor.listenTCP(self.ports[0], self.factories[0])
+        yield wait_for(lambda: down.healthy)
+
+class StoppedPoolTest(unittest.TestCase):
+    "Tests that stopping a pool fails the requests waiting for a connection."
+    def test_waiting(self):
+        pool = FCPPool([('localhost', 9995)], reactor=task.Clock())
+        get = pool.get_direct("KSK@a")
+        self.assertNoResult(get)
+        pool.stop()
+        self.failureResultOf(get, ConnectionDone)
@@ -0,0 +1,63 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.progress import ProgressCoalescer, fraction
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+
+class ProgressTest(unittest.TestCase):
+    "Tests that progress updates are coalesced before reaching observers."
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FreenetClientProtocol()
+        self.client.clock = self.clock
+        self.client.timers = TimerWheel(clock=self.clock)
+        self.client.progress = ProgressCoalescer(1.0, self.clock)
+        self.client.makeConnection(StringTransport())
+        self.client.dataReceived("NodeHello\nFCPVersion=2.0\nEndMessage\n")
+        self.seen = []
+
+    def progress(self, identifier, succeeded):
+        self.client.dataReceived("SimpleProgress\nIdentifier={0}\nRequired=10\n"
+                                 "Succeeded={1}\nEndMessage\n"
+                                 .format(identifier, succeeded))
+
+    def observe(self, message):
+        self.seen.append((message["Identifier"], fraction(message)))
+
+    def test_coalesced(self):
+        get = self.client.get_direct("KSK@a", on_progress=self.observe)
+        other = self.client.get_direct("KSK@b", on_progress=self.observe)
+        first, second = sorted(self.client.router.sessions)
+        for succeeded in xrange(1, 6):
+            self.progress(first, succeeded)
+            self.progress(second, succeeded * 2)
+            self.clock.advance(0.1)
+        self.assertEqual(self.seen, [])
+        self.assertEqual(len(self.client.progress), 2)
+
+        self.clock.advance(0.5)
+        self.assertEqual(sorted(self.seen), [(first, 0.5), (second, 1.0)])
+        self.assertEqual(len(self.client.progress), 0)
+        self.assertIdentical(self.client.progress.call, None)
+
+        self.progress(first, 7)
+        self.client.dataReceived("AllData\nIdentifier={0}\nDataLength=2\n"
+                                 "Data\nok".format(first))
+        self.assertEqual(self.seen[-1], (first, 0.7))
+        self.assertEqual(self.successResultOf(get)["Data"], "ok")
+        self.assertNoResult(other)
+
+    def test_observer_error(self):
+        "An observer that fails doesn't stop others, or its session."
+        def fail(message):
+            raise ValueError()
+
+        get = self.client.get_direct("KSK@a", on_progress=fail)
+        self.client.get_direct("KSK@b", on_progress=self.observe)
+        first, second = sorted(self.client.router.sessions)
+        self.progress(first, 1)
+        self.progress(second, 1)
+        self.clock.advance(1)
+        self.assertEqual(self.seen, [(second, 0.1)])
+        self.assertNoResult(get)
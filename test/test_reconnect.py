@@ -0,0 +1,102 @@
+from twisted.internet.defer import CancelledError
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.reconnect import ResumingClient
+from twistedfcp.timer import TimerWheel
+
+class FakeConnector(object):
+    "Stands in for the connector a ``ReconnectingClientFactory`` retries."
+    attempts = 0
+
+    def connect(self):
+        self.attempts += 1
+
+class ResumingClientTest(unittest.TestCase):
+    "Tests that requests survive the connection to the node dropping."
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = ResumingClient(name="test")
+        self.factory.clock = self.clock
+        self.connector = FakeConnector()
+
+    def connect(self, listed=""):
+        "Connects a new protocol, with the node knowing the ``listed`` requests."
+        self.connection = self.factory.buildProtocol(None)
+        self.connection.clock = self.clock
+        self.connection.timers = TimerWheel(clock=self.clock)
+        self.transport = StringTransport()
+        self.connection.makeConnection(self.transport)
+        self.receive("NodeHello\nFCPVersion=2.0\nEndMessage\n" + listed +
+                     "EndListPersistentRequests\nEndMessage\n")
+
+    def receive(self, data):
+        self.connection.dataReceived(data)
+        self.clock.advance(0)
+
+    def sent(self):
+        written = self.transport.value()
+        self.transport.clear()
+        return written
+
+    def disconnect(self):
+        reason = Failure(ConnectionLost())
+        self.connection.connectionLost(reason)
+        self.factory.clientConnectionLost(self.connector, reason)
+
+    def test_resumed(self):
+        "A request the node still has is reattached, not restarted."
+        self.connect()
+        get = self.factory.get_direct("CHK@big")
+        self.clock.advance(0)
+        sent = self.sent()
+        self.assertIn("ClientGet\nIdentifier=test-0\n", sent)
+        self.assertIn("Persistence=reboot\nGlobal=true\n", sent)
+
+        self.disconnect()
+        self.assertNoResult(get)
+        self.clock.advance(self.factory.maxDelay)
+        self.assertEqual(self.connector.attempts, 1)
+
+        self.connect("PersistentGet\nIdentifier=test-0\nGlobal=true\n"
+                     "EndMessage\nPersistentGet\nIdentifier=test-9\n"
+                     "Global=true\nEndMessage\n")
+        sent = self.sent()
+        self.assertNotIn("ClientGet", sent)
+        self.assertIn("GetRequestStatus\nIdentifier=test-0\n", sent)
+        self.assertIn("RemoveRequest\nIdentifier=test-9\n", sent)
+
+        self.receive("DataFound\nIdentifier=test-0\nGlobal=true\n"
+                     "DataLength=4\nEndMessage\n")
+        self.assertIn("OnlyData=true", self.sent())
+        self.receive("AllData\nIdentifier=test-0\nGlobal=true\n"
+                     "DataLength=4\nData\nabcd")
+        self.assertEqual(self.successResultOf(get)["Data"], "abcd")
+        self.assertIn("RemoveRequest\nIdentifier=test-0\n", self.sent())
+        self.assertEqual(len(self.factory.requests), 0)
+
+    def test_resubmitted(self):
+        "Requests the node lost, or made while disconnected, are sent again."
+        self.connect()
+        put = self.factory.put_direct("KSK@a", "data")
+        self.disconnect()
+        get = self.factory.get_direct("KSK@b")
+        self.connect()
+        sent = self.sent()
+        self.assertIn("ClientPut\nIdentifier=test-0\n", sent)
+        self.assertIn("ClientGet\nIdentifier=test-1\n", sent)
+        self.assertIn("DataLength=4\nData\ndata", sent)
+        get.cancel()
+        self.clock.advance(0)
+        self.failureResultOf(get, CancelledError)
+        self.assertIn("RemoveRequest\nIdentifier=test-1\n", self.sent())
+        self.assertEqual(list(self.factory.requests), ["test-0"])
+
+    def test_connection_lost(self):
+        "Plain sessions fail as soon as their connection is lost."
+        self.connect()
+        get = self.connection.get_direct("CHK@a")
+        self.disconnect()
+        self.failureResultOf(get, ConnectionLost)
@@ -0,0 +1,98 @@
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, inlineCallbacks
+from twisted.trial import unittest
+from twistedfcp.scheduler import Scheduler, PriorityClass
+
+from test_basic import ClientTest, LoopbackBaseTest
+from simple_server import RecordingFactory
+
+class SchedulerTest(unittest.TestCase):
+    "Tests the order in which a scheduler starts requests."
+    def setUp(self):
+        self.started = []
+        self.requests = []
+        self.scheduler = Scheduler(None, max_in_flight=1)
+
+    def submit(self, name, priority=None, tenant=None):
+        def start():
+            self.started.append(name)
+            self.requests.append(Deferred())
+            return self.requests[-1]
+
+        return self.scheduler.submit(start, priority, tenant)
+
+    def finish(self, count):
+        "Finishes the running request ``count`` times."
+        for _ in xrange(count):
+            self.requests[len(self.started) - 1].callback(None)
+
+    def test_in_flight(self):
+        self.scheduler.max_in_flight = 2
+        results = [self.submit(i) for i in xrange(5)]
+        self.assertEqual(self.started, [0, 1])
+        self.assertEqual(len(self.scheduler), 3)
+        self.requests[1].callback("one")
+        self.assertEqual(self.successResultOf(results[1]), "one")
+        self.assertEqual(self.started, [0, 1, 2])
+
+    def test_priority(self):
+        self.submit("running")
+        self.submit("bulk", PriorityClass.BULK)
+        self.submit("interactive", PriorityClass.INTERACTIVE)
+        self.finish(2)
+        self.assertEqual(self.started, ["running", "interactive", "bulk"])
+
+    def test_fairness(self):
+        "Tenants share requests in proportion to their weights."
+        self.scheduler.weights = {"web": 2}
+        self.submit("running")
+        for _ in xrange(6):
+            self.submit("web", tenant="web")
+        for _ in xrange(6):
+            self.submit("backfill", tenant="backfill")
+        self.finish(6)
+        self.assertEqual(self.started[1:].count("web"), 4)
+        self.assertEqual(self.started[1:].count("backfill"), 2)
+
+    def test_idle_tenant(self):
+        "A tenant that was idle doesn't get to catch up on its share."
+        self.submit("running", tenant="a")
+        for _ in xrange(6):
+            self.submit("a", tenant="a")
+        self.finish(3)
+        for _ in xrange(2):
+            self.submit("b", tenant="b")
+        self.finish(4)
+        self.assertEqual(self.started[4:], ["a", "b", "a", "b"])
+
+    def test_cancel(self):
+        self.submit("running")
+        waiting = self.submit("waiting")
+        waiting.cancel()
+        self.failureResultOf(waiting, CancelledError)
+        self.assertEqual(len(self.scheduler), 0)
+        self.submit("next")
+        self.finish(1)
+        self.assertEqual(self.started, ["running", "next"])
+        self.assertEqual(len(self.scheduler), 0)
+
+class ScheduledRequestTest(LoopbackBaseTest):
+    "Tests that scheduled requests tell the node their priority."
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.server = reactor.listenTCP(self.port, self.factory)
+        return ClientTest.setUp(self)
+
+    @inlineCallbacks
+    def test_priority_class(self):
+        _ = yield self.client.deferred['NodeHello']
+        scheduler = Scheduler(self.client)
+        _ = yield scheduler.put_direct("KSK@a", "data",
+                                       priority=PriorityClass.BULK,
+                                       tenant="backfill")
+        got = yield scheduler.get_direct("KSK@a",
+                                         priority=PriorityClass.INTERACTIVE)
+        self.assertEqual(got["Data"], "data")
+        priorities = [m["PriorityClass"] for m in self.factory.messages
+                      if m.name in ("ClientPut", "ClientGet")]
+        self.assertEqual(priorities, ["4", "1"])
@@ -0,0 +1,82 @@
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twistedfcp.error import FetchException
+from twistedfcp.sharded import ShardedClient
+
+from simple_server import RecordingFactory, TestServerProtocol
+
+class SharedStoreFactory(RecordingFactory):
+    "Test server whose connections share one store."
+    def __init__(self):
+        RecordingFactory.__init__(self)
+        self.store = {}
+
+    def buildProtocol(self, addr):
+        server = RecordingFactory.buildProtocol(self, addr)
+        server.store = self.store
+        return server
+
+class ShardedClientTest(unittest.TestCase):
+    "Tests running requests on worker processes."
+    timeout = 30
+
+    def setUp(self):
+        self.factory = SharedStoreFactory()
+        self.server = reactor.listenTCP(TestServerProtocol.port, self.factory)
+        self.spool = os.path.abspath(self.mktemp())
+        os.makedirs(self.spool)
+        self.client = ShardedClient('localhost', TestServerProtocol.port,
+                                    workers=2, inline_limit=100,
+                                    spool_dir=self.spool)
+        return self.client.start()
+
+    def tearDown(self):
+        stopped = self.client.stop()
+        return stopped.addCallback(lambda _: self.server.stopListening())
+
+    @inlineCallbacks
+    def test_put_get(self):
+        small, large = "small", "large" * 1000
+        _ = yield self.client.put_direct("KSK@small", small)
+        _ = yield self.client.put_direct("KSK@large", large)
+        got = yield self.client.get_direct("KSK@small")
+        self.assertEqual(got["Data"], small)
+        got = yield self.client.get_direct("KSK@large")
+        self.assertEqual(got["Data"], large)
+        self.assertEqual(os.listdir(self.spool), [])
+        uploads = dict((m["URI"], m.get("UploadFrom"))
+                       for m in self.factory.messages if m.name == "ClientPut")
+        self.assertEqual(uploads, {"KSK@small": None, "KSK@large": "disk"})
+
+    @inlineCallbacks
+    def test_failure(self):
+        try:
+            _ = yield self.client.get_direct("KSK@missing")
+        except FetchException as e:
+            self.assertEqual(e.code, 13)
+        else:
+            self.fail("The get should have failed.")
+
+    @inlineCallbacks
+    def test_namespaces(self):
+        "Workers use their own client names and identifiers."
+        puts = [("KSK@{0}".format(i), str(i)) for i in xrange(20)]
+        results = yield self.client.put_many(puts).collect()
+        self.assertTrue(all(r.ok for r in results))
+        names = set(m["Name"] for m in self.factory.messages
+                    if m.name == "ClientHello")
+        self.assertEqual(len(names), 2)
+        identifiers = [m["Identifier"] for m in self.factory.messages
+                       if m.name == "ClientPut"]
+        self.assertEqual(len(set(identifiers)), 20)
+        prefixes = set(i.rsplit("-", 1)[0] for i in identifiers)
+        self.assertEqual(prefixes, names)
+
+class InlineLimitTest(unittest.TestCase):
+    def test_capped(self):
+        "Inline payloads are limited to what fits in an AMP value."
+        client = ShardedClient(workers=1, inline_limit=10 ** 6)
+        self.assertEqual(client.inline_limit, 65535)
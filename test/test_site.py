@@ -0,0 +1,72 @@
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twistedfcp.site import SiteInsert, IncompleteInsert, manifest
+
+from test_basic import ClientTest, LoopbackBaseTest
+from simple_server import RecordingFactory
+
+class SiteInsertTest(LoopbackBaseTest):
+    "Tests inserting a directory as a site."
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.server = reactor.listenTCP(self.port, self.factory)
+        self.directory = self.mktemp()
+        os.makedirs(os.path.join(self.directory, "css"))
+        self.files = {"index.html": "<html></html>",
+                      "css/site.css": "body {}",
+                      "data.bin": "\0" * 5000}
+        for name, data in self.files.iteritems():
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(data)
+        self.state = self.mktemp()
+        return ClientTest.setUp(self)
+
+    def insert(self):
+        return SiteInsert(self.client, "USK@site/1", self.directory,
+                          concurrency=2, state=self.state).run()
+
+    def test_manifest(self):
+        names = [name for name, _ in manifest(self.directory)]
+        self.assertEqual(names, ["css/site.css", "data.bin", "index.html"])
+
+    @inlineCallbacks
+    def test_insert(self):
+        _ = yield self.client.deferred['NodeHello']
+        response = yield self.insert()
+        self.assertEqual(response["URI"], "USK@site/1")
+        store = self.factory.servers[0].store
+        redirects = store["USK@site/1"]
+        self.assertEqual(sorted(redirects), sorted(self.files))
+        for name, data in self.files.iteritems():
+            self.assertEqual(store[redirects[name]], data)
+        self.assertEqual(self.factory.received.count("ClientPut"), 3)
+
+    @inlineCallbacks
+    def test_resume(self):
+        "Only files that are new or changed are inserted again."
+        _ = yield self.client.deferred['NodeHello']
+        _ = yield self.insert()
+        with open(os.path.join(self.directory, "index.html"), 'wb') as f:
+            f.write("<html>changed</html>")
+        _ = yield self.insert()
+        self.assertEqual(self.factory.received.count("ClientPut"), 4)
+        store = self.factory.servers[0].store
+        index = store["USK@site/1"]["index.html"]
+        self.assertEqual(store[index], "<html>changed</html>")
+
+    @inlineCallbacks
+    def test_failure(self):
+        "A file that fails keeps the manifest from being inserted."
+        _ = yield self.client.deferred['NodeHello']
+        insert = SiteInsert(self.client, "USK@site/1", self.directory,
+                            state=self.state)
+        os.remove(os.path.join(self.directory, "data.bin"))
+        try:
+            _ = yield insert.run()
+        except IncompleteInsert as e:
+            self.assertEqual(list(e.failures), ["data.bin"])
+        else:
+            self.fail("The insert should have failed.")
+        self.assertNotIn("ClientPutComplexDir", self.factory.received)
@@ -0,0 +1,171 @@
+import mmap
+import tempfile
+from StringIO import StringIO
+
+from zope.interface import implementer
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet.defer import fail, inlineCallbacks
+from twisted.web.iweb import IBodyProducer
+from twistedfcp.message import Message
+from twistedfcp.util import MessageBasedProtocol
+from twistedfcp.stream import (BufferSink, FileSink, SpoolSink,
+                               IterableProducer)
+
+from test_basic import FCPBaseTest
+
+class RecordingProtocol(MessageBasedProtocol):
+    "Records every message it receives, using a configurable sink."
+    def __init__(self, sink=None):
+        MessageBasedProtocol.__init__(self)
+        self.received = []
+        self.sink_used = sink
+
+    def data_sink(self, message):
+        if self.sink_used is None:
+            return MessageBasedProtocol.data_sink(self, message)
+        return self.sink_used
+
+    def message_received(self, message):
+        self.received.append((message.name, message))
+
+def all_data(payload):
+    return ("AllData\nIdentifier=Request0\nDataLength={0}\nData\n{1}"
+            .format(len(payload), payload))
+
+class DataReceptionTest(unittest.TestCase):
+    "Tests that message data is streamed into sinks."
+
+    def feed(self, protocol, data, chunk_size):
+        protocol.makeConnection(StringTransport())
+        for i in xrange(0, len(data), chunk_size):
+            protocol.dataReceived(data[i:i + chunk_size])
+
+    def test_chunked(self):
+        "Data split across many chunks, followed by another message."
+        payload = "0123456789" * 100
+        wire = all_data(payload) + "EndListPeers\nEndMessage\n"
+        for chunk_size in (1, 7, 100, len(wire)):
+            protocol = RecordingProtocol()
+            self.feed(protocol, wire, chunk_size)
+            self.assertEqual([name for name, _ in protocol.received],
+                             ["AllData", "EndListPeers"])
+            self.assertEqual(protocol.received[0][1]["Data"], payload)
+
+    def test_empty(self):
+        "A zero length payload ends the message right away."
+        protocol = RecordingProtocol()
+        self.feed(protocol, all_data("") + "EndListPeers\nEndMessage\n", 5)
+        self.assertEqual(protocol.received[0][1]["Data"], "")
+        self.assertEqual(len(protocol.received), 2)
+
+    def test_buffer_sink(self):
+        protocol = RecordingProtocol(BufferSink())
+        self.feed(protocol, all_data("buffered data"), 3)
+        data = protocol.received[0][1]["Data"]
+        self.assertIsInstance(data, bytearray)
+        self.assertEqual(data, "buffered data")
+
+    def test_spool_sink(self):
+        "Payloads above the threshold are spooled to disk and memory mapped."
+        small, large = "x" * 4, "y" * 64
+        for payload, kind in ((small, bytearray), (large, mmap.mmap)):
+            protocol = RecordingProtocol(SpoolSink(threshold=16))
+            self.feed(protocol, all_data(payload), 10)
+            data = protocol.received[0][1]["Data"]
+            self.assertIsInstance(data, kind)
+            self.assertEqual(data[:], payload)
+
+class GetToSinkTest(FCPBaseTest):
+    "Tests fetching data from the node directly into a sink."
+    @inlineCallbacks
+    def test_file_sink(self):
+        _ = yield self.client.deferred['NodeHello']
+        testdata = "Testing file sink..." * 1000
+        response = yield self.client.put_direct("CHK@", testdata)
+        out = tempfile.TemporaryFile()
+        response = yield self.client.get_direct(response["URI"], FileSink(out))
+        self.assertIdentical(response["Data"], out)
+        out.seek(0)
+        self.assertEqual(out.read(), testdata)
+        self.assertEqual(self.client.sinks, {})
+
+class StreamedPutTest(FCPBaseTest):
+    "Tests inserting data that is streamed from files and iterables."
+    @inlineCallbacks
+    def test_file(self):
+        _ = yield self.client.deferred['NodeHello']
+        testdata = "Testing streamed file put..." * 10000
+        response = yield self.client.put_direct("CHK@", StringIO(testdata))
+        response = yield self.client.get_direct(response["URI"])
+        self.assertEqual(response["Data"], testdata)
+
+    @inlineCallbacks
+    def test_iterable(self):
+        _ = yield self.client.deferred['NodeHello']
+        chunks = ["chunk {0};".format(i) for i in xrange(1000)]
+        length = sum(len(c) for c in chunks)
+        uri = "KSK@streamed-iterable"
+        _ = yield self.client.put_direct(uri, iter(chunks), length)
+        response = yield self.client.get_direct(uri)
+        self.assertEqual(response["Data"], ''.join(chunks))
+
+class ProducedMessageTest(unittest.TestCase):
+    "Tests the framing of messages with a streamed body."
+    def setUp(self):
+        self.transport = StringTransport()
+        self.protocol = MessageBasedProtocol()
+        self.protocol.clock = Clock()
+        self.protocol.makeConnection(self.transport)
+
+    def test_held_back(self):
+        "Messages sent while a body is streamed follow the body."
+        chunks = ["abc", "def"]
+        sent = self.protocol.sendMessage(Message("ClientPut", []), 
+                                         IterableProducer(chunks, 6))
+        self.protocol.sendMessage(Message("ListPeers", []))
+        self.assertTrue(self.transport.producer is not None)
+        def check(_):
+            self.protocol.clock.advance(0)
+            self.assertEqual(self.transport.value(),
+                             "ClientPut\nDataLength=6\nData\nabcdef"
+                             "ListPeers\nEndMessage\n")
+
+        return sent.addCallback(check)
+
+    def test_wrong_length(self):
+        "A body that is shorter than its length drops the connection."
+        sent = self.protocol.sendMessage(Message("ClientPut", []), 
+                                         IterableProducer(["abc"], 6))
+        def check(failure):
+            failure.trap(ValueError)
+            self.assertTrue(self.transport.disconnecting)
+
+        return sent.addCallbacks(self.fail, check)
+
+    def test_failed_producer(self):
+        "Once a body fails, later messages aren't queued behind it."
+        sent = self.protocol.sendMessage(Message("ClientPut", []),
+                                         FailingProducer())
+        self.failureResultOf(sent, IOError)
+        self.assertIdentical(self.protocol.producing, None)
+        self.protocol.sendMessage(Message("ListPeers", []))
+        self.assertEqual(self.protocol.pending, [])
+
+@implementer(IBodyProducer)
+class FailingProducer(object):
+    "A body producer that fails as soon as it starts."
+    length = 6
+
+    def startProducing(self, consumer):
+        return fail(IOError("Disk error"))
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
@@ -0,0 +1,58 @@
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.error import NodeTimeout
+from twistedfcp.protocol import FreenetClientProtocol
+from twistedfcp.timer import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+    "Tests scheduling and expiring timers in batches."
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(granularity=1.0, clock=self.clock)
+        self.fired = []
+
+    def test_batched(self):
+        "Many timers share a single delayed call, and never fire early."
+        timers = [self.wheel.schedule(10 + i / 100.0, self.fired.append, i)
+                  for i in xrange(1000)]
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(9.9)
+        self.assertEqual(self.fired, [])
+        self.clock.pump([0.1] * 110)
+        self.assertEqual(sorted(self.fired), range(1000))
+        self.assertFalse(any(t.active() for t in timers))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        timers = [self.wheel.schedule(5, self.fired.append, i) 
+                  for i in xrange(10)]
+        for timer in timers[::2]:
+            timer.cancel()
+        self.assertEqual(len(self.wheel), 5)
+        self.clock.advance(6)
+        self.assertEqual(sorted(self.fired), [1, 3, 5, 7, 9])
+
+    def test_idle(self):
+        "An empty wheel leaves nothing scheduled on the clock."
+        self.wheel.schedule(5, self.fired.append, 1).cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(100)
+        self.wheel.schedule(0.5, self.fired.append, 2)
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [2])
+
+class SessionTimeoutTest(unittest.TestCase):
+    "Tests that sessions still time out with a ``NodeTimeout``."
+    def test_timeout(self):
+        clock = Clock()
+        client = FreenetClientProtocol()
+        client.clock = clock
+        client.timers = TimerWheel(clock=clock)
+        client.makeConnection(StringTransport())
+        client.timeout = 30
+        done = client.get_direct("KSK@slow")
+        clock.advance(31)
+        self.assertFailure(done, NodeTimeout)
+        self.assertEqual(dict(client.router.sessions), {})
+        return done
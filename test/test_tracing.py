@@ -0,0 +1,90 @@
+import logging
+from StringIO import StringIO
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twistedfcp.message import Message
+from twistedfcp.stream import IterableProducer
+from twistedfcp.tracing import FileTrace, RingTrace, read_trace, replay
+from twistedfcp.util import MessageBasedProtocol
+
+from test_stream import RecordingProtocol, all_data
+
+class Unprintable(object):
+    "A field value that counts how often it is formatted for the log."
+    formatted = 0
+
+    def __str__(self): return "value"
+
+    def __repr__(self):
+        Unprintable.formatted += 1
+        return "value"
+
+class LazyLoggingTest(unittest.TestCase):
+    def setUp(self):
+        self.level = logging.root.level
+        self.addCleanup(logging.root.setLevel, self.level)
+        self.protocol = MessageBasedProtocol()
+        self.protocol.clock = Clock()
+        self.protocol.makeConnection(StringTransport())
+
+    def test_disabled(self):
+        "Nothing is formatted while logging is disabled."
+        logging.root.setLevel(logging.WARNING)
+        self.protocol.sendMessage(Message("ClientGet", [("URI", Unprintable())]))
+        self.assertEqual(Unprintable.formatted, 0)
+        logging.root.setLevel(logging.DEBUG)
+        self.protocol.sendMessage(Message("ClientGet", [("URI", Unprintable())]))
+        self.assertEqual(Unprintable.formatted, 1)
+
+class TraceTest(unittest.TestCase):
+    "Tests recording the data a protocol sends and receives."
+    def setUp(self):
+        self.protocol = RecordingProtocol()
+        self.protocol.clock = Clock()
+        self.protocol.makeConnection(StringTransport())
+
+    def traffic(self):
+        "Sends and receives a few messages, a second apart."
+        self.protocol.sendMessage(Message("ClientGet", [("URI", "KSK@a")]))
+        self.protocol.clock.advance(1)
+        self.protocol.dataReceived(all_data("first")[:20])
+        self.protocol.clock.advance(1)
+        self.protocol.dataReceived(all_data("first")[20:] + all_data("second"))
+
+    def test_ring(self):
+        self.protocol.trace = trace = RingTrace(max_frames=2)
+        self.traffic()
+        self.assertEqual([f[:2] for f in trace.frames], [(1, '<'), (2, '<')])
+        self.assertEqual(trace.size, len(all_data("first") * 2) + 1)
+
+        trace = RingTrace(max_bytes=10)
+        trace.record(0, '<', "x" * 6)
+        trace.record(1, '<', "y" * 6)
+        self.assertEqual(list(trace.frames), [(1, '<', "y" * 6)])
+
+    def test_streamed_body(self):
+        "Bodies written by a producer are recorded too."
+        self.protocol.trace = trace = RingTrace()
+        sent = self.protocol.sendMessage(Message("ClientPut", []),
+                                         IterableProducer(["ab", "cd"], 4))
+        def check(_):
+            self.assertEqual(''.join(data for _, _, data in trace.frames),
+                             "ClientPut\nDataLength=4\nData\nabcd")
+        return sent.addCallback(check)
+
+    def test_file_replay(self):
+        "A trace file can be replayed through the parser."
+        out = StringIO()
+        self.protocol.trace = FileTrace(out)
+        self.traffic()
+        out.seek(0)
+        frames = list(read_trace(out))
+        self.assertEqual([f[:2] for f in frames],
+                         [(1, '>'), (1, '<'), (2, '<')])
+        self.assertEqual(frames[0][2], "ClientGet\nURI=KSK@a\nEndMessage\n")
+
+        replayed = replay(frames, RecordingProtocol())
+        self.assertEqual([m["Data"] for _, m in replayed.received],
+                         [m["Data"] for _, m in self.protocol.received])
@@ -0,0 +1,182 @@
+"""
+An asyncio implementation of the Freenet Client Protocol, for Python 3. It is
+built on the same parser, encoder and session handling (``twistedfcp.core``)
+as the Twisted client, and doesn't need Twisted::
+
+    client = await twistedfcp.aio.connect('localhost', 9481)
+    response = await client.put_direct('CHK@', b'some data')
+    response = await client.get_direct(response['URI'])
+
+Requests return ``asyncio.Future`` objects. Cancelling one ends the session
+and asks the node to remove the request.
+
+"""
+import asyncio
+import logging
+
+from .core import MessageParser, Session, SessionRouter, encode_message
+from .error import NodeTimeout
+from .message import IdentifiedMessage, Message, ClientHello
+
+class FCPClientProtocol(asyncio.Protocol, MessageParser):
+    """
+    An ``asyncio.Protocol`` that talks FCP. Messages are routed to sessions by
+    their ``Identifier`` (see ``SessionRouter``), and every session is ended
+    with a ``NodeTimeout`` after ``timeout`` seconds. ``hello`` is a future
+    that resolves with the node's ``NodeHello``.
+
+    Messages that are not part of a session are passed to ``unhandled``,
+    which does nothing by default.
+
+    """
+    default_timeout = 10 * 60
+    port = 9481
+
+    def __init__(self, loop=None):
+        MessageParser.__init__(self)
+        self.loop = loop or asyncio.get_event_loop()
+        self.router = SessionRouter()
+        self.active = {}
+        self.timeout = self.default_timeout
+        self.hello = self.loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send_message(ClientHello)
+
+    def data_received(self, data):
+        self.feed(data)
+
+    def connection_lost(self, exc):
+        "Fails every ongoing session, and ``hello`` if it is still pending."
+        error = exc or ConnectionError("The connection to the node was closed.")
+        if not self.hello.done():
+            self.hello.set_exception(error)
+        for fail in list(self.active.values()):
+            fail(error)
+
+    def message_received(self, message):
+        if message.name == 'NodeHello' and not self.hello.done():
+            self.hello.set_result(message)
+        elif not self.router.dispatch(message):
+            self.unhandled(message)
+
+    def unhandled(self, message):
+        "Called with every message that is not part of a session."
+
+    def send_message(self, message, data=None):
+        """
+        Sends ``message``, followed by ``data`` (``bytes``), if it is given.
+
+        """
+        if data is None:
+            self.transport.write(encode_message(message))
+        else:
+            self.transport.write(encode_message(message, len(data)))
+            self.transport.write(data)
+
+    def do_session(self, msg, handler, data=None):
+        """
+        Sends ``msg`` (and its ``data``) and returns a future for the result
+        of the session it starts. Each message of the session is passed to
+        ``handler``, until it returns a true value, which becomes the result.
+
+        """
+        session_id = msg['Identifier']
+        done = self.loop.create_future()
+
+        def end():
+            timer.cancel()
+            self.router.remove(session_id)
+            self.active.pop(session_id, None)
+
+        def finished(outcome, result):
+            end()
+            if done.done():
+                return
+            if outcome == 'success':
+                done.set_result(result)
+            else:
+                done.set_exception(result)
+
+        def fail(error):
+            finished('failed', error)
+
+        def timeout():
+            text = 'The node timed out on session "{0}"'
+            logging.error(text.format(session_id))
+            fail(NodeTimeout())
+
+        def cancelled(future):
+            if future.cancelled() and session_id in self.active:
+                end()
+                if not self.transport.is_closing():
+                    self.send_message(Message("RemoveRequest",
+                                              [("Identifier", session_id),
+                                               ("Global", "false")]))
+
+        timer = self.loop.call_later(self.timeout, timeout)
+        self.router.add(Session(msg, handler, finished))
+        self.active[session_id] = fail
+        done.add_done_callback(cancelled)
+        self.send_message(msg, data)
+        return done
+
+    def get_direct(self, uri, **fields):
+        """
+        Gets ``uri``, returning a future for the final ``AllData`` message.
+        Any keyword arguments are added as fields of the ``ClientGet``.
+
+        """
+        get = IdentifiedMessage("ClientGet", [("URI", uri), ("Verbosity", 1)]
+                                + sorted(fields.items()))
+        def process(message):
+            if message.name == "AllData":
+                return message
+
+        return self.do_session(get, process)
+
+    def put_direct(self, uri, data):
+        "Puts ``data`` to ``uri``, returning a future for ``PutSuccessful``."
+        put = IdentifiedMessage("ClientPut", [("URI", uri), ("Verbosity", 1)])
+        def process(message):
+            if message.name == "PutSuccessful":
+                return message
+
+        return self.do_session(put, process, data)
+
+    def get_ssk_keypair(self):
+        "Returns a future for a new ``[insert URI, request URI]`` pair."
+        gen = IdentifiedMessage("GenerateSSK", [])
+        def process(message):
+            if message.name == "SSKKeypair":
+                return [message["InsertURI"], message["RequestURI"]]
+
+        return self.do_session(gen, process)
+
+def connect(host='localhost', port=FCPClientProtocol.port, loop=None):
+    """
+    Connects to the node at ``host``:``port``. Returns a future for the
+    ``FCPClientProtocol``, which resolves once the node has said hello.
+
+    """
+    loop = loop or asyncio.get_event_loop()
+    connected = loop.create_future()
+
+    def made(future):
+        if future.exception() is not None:
+            connected.set_exception(future.exception())
+            return
+        _, client = future.result()
+        client.hello.add_done_callback(lambda hello: ready(client, hello))
+
+    def ready(client, hello):
+        if hello.exception() is not None:
+            connected.set_exception(hello.exception())
+        else:
+            connected.set_result(client)
+
+    connection = asyncio.ensure_future(loop.create_connection(
+        lambda: FCPClientProtocol(loop), host, port), loop=loop)
+    connection.add_done_callback(made)
+    return connected
@@ -0,0 +1,165 @@
+"""
+Defines batch requests, which run a request for every item of an iterable
+while keeping a bounded number of them in flight.
+
+"""
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+class BatchResult(object):
+    """
+    The outcome of the request for one item of a batch. ``key`` identifies the
+    item (it is the URI for gets and puts). Exactly one of ``result`` and
+    ``failure`` is set.
+
+    """
+    __slots__ = ('key', 'result', 'failure')
+
+    def __init__(self, key, outcome):
+        self.key = key
+        if isinstance(outcome, Failure):
+            self.result, self.failure = None, outcome
+        else:
+            self.result, self.failure = outcome, None
+
+    @property
+    def ok(self): return self.failure is None
+
+class ResultStream(object):
+    """
+    Calls ``request(item)`` for every item, with at most ``concurrency``
+    requests in flight, and streams the results back in completion order.
+    ``next`` returns a ``Deferred`` that fires with the next ``BatchResult``,
+    or with ``None`` once every item is done::
+
+        @inlineCallbacks
+        def fetch(client, uris):
+            stream = client.get_many(uris)
+            while True:
+                result = yield stream.next()
+                if result is None:
+                    break
+                ...
+
+    Items are only taken from ``items`` when a request can be started, so a
+    lazy generator is never read ahead. Requests also stop being started while
+    ``buffered`` results are waiting to be read.
+
+    """
+    def __init__(self, request, items, key, concurrency=10, buffered=None):
+        self.request = request
+        self.items = iter(items)
+        self.key = key
+        self.concurrency = concurrency
+        self.buffered = buffered or concurrency
+        self.in_flight = 0
+        self.results = deque()
+        self.waiting = deque()
+        self.exhausted = False
+        self.filling = False
+        self.fill()
+
+    @property
+    def finished(self):
+        "Whether all results have been produced (they may not all be read)."
+        return self.exhausted and not self.in_flight
+
+    def fill(self):
+        "Starts requests until the concurrency or buffer limit is reached."
+        if self.filling:
+            return
+        self.filling = True
+        try:
+            while (not self.exhausted and self.in_flight < self.concurrency
+                   and len(self.results) < self.buffered):
+                try:
+                    item = next(self.items)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                self.in_flight += 1
+                started = maybeDeferred(self.request, item)
+                started.addBoth(self.done, self.key(item))
+        finally:
+            self.filling = False
+
+        if self.finished and not self.results:
+            waiting, self.waiting = self.waiting, deque()
+            for deferred in waiting:
+                deferred.callback(None)
+
+    def done(self, outcome, key):
+        "Records the outcome of a request and starts the next one."
+        self.in_flight -= 1
+        result = BatchResult(key, outcome)
+        if self.waiting:
+            self.waiting.popleft().callback(result)
+        else:
+            self.results.append(result)
+        self.fill()
+
+    def next(self):
+        "Returns a ``Deferred`` for the next result (``None`` at the end)."
+        if self.results:
+            result = self.results.popleft()
+            self.fill()
+            return succeed(result)
+        elif self.finished:
+            return succeed(None)
+        waiting = Deferred()
+        self.waiting.append(waiting)
+        return waiting
+
+    def collect(self):
+        "Returns a ``Deferred`` that fires with a list of all the results."
+        results = []
+        done = Deferred()
+        def drain(result=None):
+            # Results that are ready are read in a loop rather than through
+            # nested callbacks, which would recurse once per cached result.
+            if result is not None:
+                results.append(result)
+            while self.results:
+                results.append(self.results.popleft())
+                self.fill()
+            if self.finished and not self.results:
+                done.callback(results)
+                return
+            waiting = Deferred()
+            self.waiting.append(waiting)
+            waiting.addCallback(collected)
+
+        def collected(result):
+            if result is None:
+                done.callback(results)
+            else:
+                drain(result)
+
+        drain()
+        return done
+
+class BatchMixin(object):
+    """
+    Adds ``get_many`` and ``put_many`` to any class that implements
+    ``get_direct`` and ``put_direct``.
+
+    """
+    def get_many(self, uris, concurrency=10, buffered=None):
+        """
+        Gets every URI in ``uris`` with ``get_direct``. Returns a
+        ``ResultStream`` of ``BatchResult`` objects keyed by URI.
+
+        """
+        return ResultStream(self.get_direct, uris, lambda uri: uri,
+                            concurrency, buffered)
+
+    def put_many(self, items, concurrency=10, buffered=None):
+        """
+        Puts every ``(uri, data)`` pair in ``items`` with ``put_direct``.
+        Returns a ``ResultStream`` of ``BatchResult`` objects keyed by URI.
+
+        """
+        return ResultStream(lambda item: self.put_direct(*item), items,
+                            lambda item: item[0], concurrency, buffered)
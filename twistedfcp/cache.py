@@ -0,0 +1,263 @@
+"""
+Defines a cache for the content of immutable Freenet keys. Content fetched
+from a ``CHK`` (or an ``SSK``, or a ``USK`` at a fixed edition) can never
+change, so it can be kept locally and returned without asking the node again.
+
+``ContentCache`` has two tiers: a least recently used cache in memory, and an
+optional store on disk. Both are bounded by the total size of the data they
+hold.
+
+"""
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+
+from twisted.internet.defer import succeed
+from message import Message
+from util import encode_message
+
+_usk_edition = re.compile(r'^USK@[^/]*/[^/]+/(-?\d+)(/|$)')
+
+def is_immutable(uri):
+    """
+    Returns whether the content of ``uri`` can never change. That is the case
+    for ``CHK`` and ``SSK`` keys (an SSK can only be inserted once), and for
+    ``USK`` keys that ask for a specific, non-negative edition.
+
+    """
+    key_type = uri.split('@', 1)[0].upper()
+    if key_type in ('CHK', 'SSK'):
+        return True
+    elif key_type == 'USK':
+        match = _usk_edition.match(uri)
+        return match is not None and int(match.group(1)) >= 0
+    return False
+
+# Fields of a request that change how the node schedules it, but not what it
+# returns (or, for a put, which key it inserts).
+scheduling_fields = frozenset(['PriorityClass', 'MaxRetries', 'RealTimeFlag'])
+
+def cacheable(fields):
+    "Returns whether a get with the given extra ``fields`` can be cached."
+    return all(key in scheduling_fields for key in fields)
+
+class MemoryCache(object):
+    "Keeps messages in memory, evicting the least recently used ones."
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, uri):
+        message = self.entries.pop(uri, None)
+        if message is not None:
+            self.entries[uri] = message
+        return message
+
+    def put(self, uri, message):
+        size = len(message['Data'])
+        if size > self.max_bytes:
+            return 0
+        if uri in self.entries:
+            self.size -= len(self.entries.pop(uri)['Data'])
+        self.entries[uri] = message
+        self.size += size
+        evicted = 0
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old['Data'])
+            evicted += 1
+        return evicted
+
+class DiskCache(object):
+    """
+    Keeps messages as files in ``directory``, evicting the least recently used
+    ones once their total size exceeds ``max_bytes``. Each file holds the
+    message as it would be sent over FCP, data included.
+
+    """
+    chunk_size = 2 ** 16
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self.entries = OrderedDict((name, size)
+                                   for _, name, size in sorted(entries))
+        self.size = sum(self.entries.itervalues())
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def name(self, uri):
+        return hashlib.sha1(uri).hexdigest()
+
+    def get(self, uri, sink=None):
+        """
+        Returns the cached message for ``uri``, or ``None``. If a ``sink`` is
+        given, the data is copied into it in chunks rather than read into
+        memory.
+
+        """
+        name = self.name(uri)
+        if name not in self.entries:
+            return None
+        try:
+            return self.read(name, sink)
+        except (EnvironmentError, ValueError, KeyError) as e:
+            logging.warning("Dropping unreadable cache entry {0}: {1}"
+                            .format(name, e))
+            self.drop(name)
+            return None
+
+    def read(self, name, sink):
+        "Reads the message in file ``name``, see ``get``."
+        self.entries[name] = self.entries.pop(name)
+        os.utime(self.path(name), None)
+
+        with open(self.path(name), 'rb') as f:
+            args = []
+            line = f.readline()
+            if not line.endswith('\n'):
+                raise ValueError("Truncated cache entry")
+            message_name = line[:-1]
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    raise ValueError("Truncated cache entry")
+                line = line[:-1]
+                if line == 'Data':
+                    break
+                key, _, value = line.partition('=')
+                args.append((key, value))
+            message = Message(message_name, args)
+            length = int(message['DataLength'])
+            if os.fstat(f.fileno()).st_size - f.tell() != length:
+                raise ValueError("Cache entry has the wrong data length")
+            if sink is None:
+                message['Data'] = f.read(length)
+            else:
+                sink.open(length)
+                while length:
+                    chunk = f.read(min(length, self.chunk_size))
+                    if not chunk:
+                        raise ValueError("Truncated cache entry")
+                    sink.write(chunk)
+                    length -= len(chunk)
+                message['Data'] = sink.finish()
+        return message
+
+    def drop(self, name):
+        "Forgets the entry in file ``name``, and removes the file if it exists."
+        self.size -= self.entries.pop(name, 0)
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def put(self, uri, message):
+        data = message['Data']
+        if len(data) > self.max_bytes:
+            return 0
+        header = Message(message.name, [(k, v) for k, v in message.args
+                                        if k not in ('Data', 'DataLength')])
+        name = self.name(uri)
+        temporary = self.path(name + '.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(encode_message(header, len(data)))
+            f.write(data)
+        os.rename(temporary, self.path(name))
+
+        self.size -= self.entries.pop(name, 0)
+        self.entries[name] = os.path.getsize(self.path(name))
+        self.size += self.entries[name]
+        evicted = 0
+        while self.size > self.max_bytes and self.entries:
+            self.drop(next(iter(self.entries)))
+            evicted += 1
+        return evicted
+
+class ContentCache(object):
+    """
+    A two-tier cache of immutable content, keyed by URI. Messages are kept in
+    memory (up to ``memory_bytes`` of data) and, if a ``directory`` is given,
+    on disk (up to ``disk_bytes``). Hits and misses are counted in ``stats``.
+
+    Only data that was received as a string is cached, so fetches that used a
+    sink are not. Messages are cached without their ``Identifier``, and every
+    hit returns a copy of its own. Disk entries that can't be read are
+    dropped, and count as misses.
+
+    """
+    def __init__(self, memory_bytes=64 * 2 ** 20, directory=None,
+                 disk_bytes=1024 * 2 ** 20):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(directory, disk_bytes) if directory else None
+        self.stats = dict(memory_hits=0, disk_hits=0, misses=0, stores=0,
+                          evictions=0)
+
+    def get(self, uri, sink=None):
+        "Returns the cached message for ``uri``, or ``None``."
+        message = self.memory.get(uri)
+        if message is not None:
+            self.stats['memory_hits'] += 1
+            data = message['Data']
+            message = Message(message.name, message.args)
+            if sink is not None:
+                sink.open(len(data))
+                sink.write(data)
+                message['Data'] = sink.finish()
+            return message
+
+        if self.disk is not None:
+            message = self.disk.get(uri, sink)
+            if message is not None:
+                self.stats['disk_hits'] += 1
+                if sink is None:
+                    self.stats['evictions'] += self.memory.put(uri, message)
+                    message = Message(message.name, message.args)
+                return message
+
+        self.stats['misses'] += 1
+
+    def put(self, uri, message):
+        "Caches ``message``, if its data is a string."
+        if not isinstance(message.get('Data'), str):
+            return
+        message = Message(message.name, [(k, v) for k, v in message.args
+                                         if k != 'Identifier'])
+        self.stats['stores'] += 1
+        self.stats['evictions'] += self.memory.put(uri, message)
+        if self.disk is not None:
+            self.stats['evictions'] += self.disk.put(uri, message)
+
+    def get_direct(self, uri, sink, fetch):
+        """
+        Returns a ``Deferred`` for the content of ``uri``, from the cache if
+        possible. Otherwise, calls ``fetch(uri, sink)`` and caches its result.
+        Mutable keys always go straight to ``fetch``.
+
+        """
+        if not is_immutable(uri):
+            return fetch(uri, sink)
+
+        message = self.get(uri, sink)
+        if message is not None:
+            return succeed(message)
+
+        def store(message):
+            self.put(uri, message)
+            return message
+
+        return fetch(uri, sink).addCallback(store)
@@ -0,0 +1,87 @@
+"""
+Defines ``SingleFlight``, which lets concurrent callers asking for the same
+thing share a single request.
+
+"""
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+class Flight(object):
+    """
+    One request in flight, and the callers waiting for it. Every caller gets
+    its own ``Deferred``, so that it can cancel it without affecting the
+    others. The request itself is only cancelled once every caller has.
+
+    """
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.waiters = []
+        self.request = None
+
+    def start(self, request):
+        "Waits for ``request``, a ``Deferred``."
+        self.request = request
+        request.addBoth(self.landed)
+
+    def waiter(self):
+        "Returns a new ``Deferred`` for the result of the request."
+        waiter = Deferred(self.cancel)
+        self.waiters.append(waiter)
+        return waiter
+
+    def cancel(self, waiter):
+        "Called when ``waiter`` is cancelled by its caller."
+        self.waiters.remove(waiter)
+        if not self.waiters:
+            self.group.landed(self)
+            self.request.cancel()
+
+    def landed(self, result):
+        "Hands the result (or failure) of the request to every waiter."
+        self.group.landed(self)
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent requests with the same key. The first caller for a
+    key starts the request, and callers arriving while it is in flight wait
+    for the same result::
+
+        flights = SingleFlight()
+        first = flights.call(uri, fetch, uri)   # calls fetch(uri)
+        second = flights.call(uri, fetch, uri)  # waits for the same fetch
+
+    """
+    def __init__(self):
+        self.flights = {}
+
+    def __len__(self):
+        return len(self.flights)
+
+    def call(self, key, f, *args):
+        """
+        Returns a ``Deferred`` for the result of ``f(*args)`` (an exception
+        raised by ``f`` fails it). If a request for ``key`` is already in
+        flight, ``f`` isn't called, and the result of that request is used
+        instead.
+
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(self, key)
+            self.flights[key] = flight
+            waiter = flight.waiter()
+            flight.start(maybeDeferred(f, *args))
+            return waiter
+        return flight.waiter()
+
+    def landed(self, flight):
+        "Forgets ``flight``, so that new callers start a new request."
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
@@ -0,0 +1,310 @@
+"""
+Defines the parts of the Freenet Client Protocol that don't depend on how
+bytes get to and from the node: parsing messages (``MessageParser``), encoding
+them (``encode_message``), and tracking the sessions they belong to
+(``Session`` and ``SessionRouter``).
+
+Nothing here does any I/O, or imports Twisted. The Twisted client
+(``twistedfcp.protocol``) and the asyncio client (``twistedfcp.aio``) are both
+built on this module, which runs on Python 2 and 3. On Python 3, data is
+``bytes``, and message names and fields are decoded to ``str``.
+
+"""
+import sys
+
+from .error import MalformedMessageException, error_dict
+from .message import Message
+
+PY2 = bytes is str
+_newline = b'\n'[0]
+try:
+    intern = intern
+except NameError:
+    intern = sys.intern
+
+class DataSink(object):
+    "Base class for all sinks. Subclasses must at least implement ``write``."
+    transport = None
+
+    def open(self, length):
+        "Called once, before any data arrives, with the expected length."
+        self.length = length
+
+    def write(self, data):
+        "Called with each chunk of the payload, in order."
+        raise NotImplementedError()
+
+    def finish(self):
+        "Called once the whole payload arrived. Returns the ``Data`` value."
+
+class StringSink(DataSink):
+    """
+    Collects the payload into a single string. This is the default sink, and
+    joins the received chunks only once, after the last one arrives.
+
+    """
+    def open(self, length):
+        DataSink.open(self, length)
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def finish(self):
+        data = b''.join(self.chunks)
+        del self.chunks
+        return data
+
+class MessageParser(object):
+    """
+    Parses FCP messages from data, as it arrives, with ``feed``. Each complete
+    message is passed to ``message_received``, which subclasses implement.
+
+    Instead of handling a line at a time, the parser looks for the end of the
+    whole header block and parses it in one pass. A payload that follows a
+    ``Data`` line is handed to a sink (see ``twistedfcp.stream``) chunk by
+    chunk, straight from the received data. The sink used for a given message
+    is chosen by ``data_sink``, which subclasses can override.
+
+    A header block longer than ``max_header_size`` bytes (one that never ends,
+    say) raises ``MalformedMessageException`` rather than being buffered
+    forever.
+
+    """
+    transport = None
+    max_header_size = 2 ** 20
+
+    def __init__(self):
+        self.buffer = b''
+        self.scanned = 0
+        self.message = None
+        self.sink = None
+
+    def feed(self, data):
+        "Parses every complete message in ``data`` (and any leftovers)."
+        if self.sink is not None:
+            data = self.payload_received(data)
+            if not data:
+                return
+
+        if self.buffer:
+            buf = self.buffer + data
+            start = self.scanned
+        else:
+            buf = data
+            start = 0
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            if buf[pos] == _newline:
+                pos += 1
+                continue
+
+            # Find whichever line ends the header block first. A "Data" line
+            # may share its leading newline with an "EndMessage" line that is
+            # really the start of the payload, hence the + 1.
+            end = buf.find(b'\nEndMessage\n', max(pos, start))
+            bound = end + 1 if end >= 0 else size
+            data_end = buf.find(b'\nData\n', max(pos, start), bound)
+            if data_end >= 0:
+                end = data_end
+            elif end < 0:
+                break
+
+            if end - pos > self.max_header_size:
+                raise MalformedMessageException("Message header too long")
+            self.message = self.parse_header(buf, pos, end)
+            if data_end < 0:
+                pos = end + 12
+                self.end_message()
+                continue
+
+            pos = end + 6
+            self.start_data()
+            if self.sink is not None:
+                count = min(self.dataRemaining, size - pos)
+                if count:
+                    self.sink.write(buf[pos:pos + count])
+                    self.dataRemaining -= count
+                    pos += count
+                if self.dataRemaining:
+                    break
+                self.end_data()
+
+        if pos >= size:
+            self.buffer = b''
+            self.scanned = 0
+        else:
+            self.buffer = buf[pos:] if pos else buf
+            self.scanned = max(0, len(self.buffer) - 11)
+            if len(self.buffer) > self.max_header_size:
+                raise MalformedMessageException("Message header too long")
+
+    def parse_header(self, buf, start, end):
+        """
+        Returns the ``Message`` whose header block (not including its final
+        ``EndMessage`` or ``Data`` line) is ``buf[start:end]``. Every line but
+        the first is split on its first ``=`` only, as values (URIs, base64)
+        may contain more.
+
+        """
+        header = buf[start:end]
+        if not PY2:
+            header = header.decode('utf-8')
+        lines = header.split('\n')
+        args = []
+        fields = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition('=')
+            if not sep:
+                text = 'Bad line encountered: "{0}" (expected "key=value")'
+                raise MalformedMessageException(text.format(line))
+            key = intern(key)
+            args.append((key, value))
+            fields[key] = value
+        return Message(intern(lines[0]), args, fields)
+
+    def start_data(self):
+        "Opens a sink for the data that follows the current message."
+        if 'DataLength' not in self.message:
+            text = ('Encountered a "Data" ending in a message without '
+                    'a "DataLength" key')
+            raise MalformedMessageException(text)
+
+        self.dataRemaining = int(self.message['DataLength'])
+        self.sink = self.data_sink(self.message)
+        self.sink.transport = self.transport
+        self.sink.open(self.dataRemaining)
+        if not self.dataRemaining:
+            self.end_data()
+
+    def payload_received(self, data):
+        """
+        Hands ``data`` to the current sink. If this completes the payload, the
+        message is ended and whatever follows the payload is returned.
+
+        """
+        remaining = self.dataRemaining
+        if len(data) < remaining:
+            self.dataRemaining -= len(data)
+            self.sink.write(data)
+        else:
+            self.sink.write(data[:remaining] if len(data) > remaining else data)
+            self.end_data()
+            return data[remaining:]
+
+    def data_sink(self, message):
+        """
+        Returns the sink that receives the data of the ``message`` currently
+        being parsed (everything but the data itself has been parsed by now).
+        By default, data is collected into a string.
+
+        """
+        return StringSink()
+
+    def end_data(self):
+        "Stores the value of the finished sink in the message and ends it."
+        sink, self.sink = self.sink, None
+        self.message['Data'] = sink.finish()
+        self.end_message()
+
+    def end_message(self):
+        "Passes the fully received message on, and resets the parser."
+        message, self.message = self.message, None
+        self.message_received(message)
+
+    def message_received(self, message):
+        "Called with every message that was parsed."
+        raise NotImplementedError()
+
+def encode_message(message, data_length=None):
+    """
+    Encodes ``message`` into a single string. If ``data_length`` is given, the
+    message ends with a ``DataLength`` field and a ``Data`` line, and must be
+    followed by that many bytes of data.
+
+    """
+    lines = [message.name]
+    lines.extend(str(key) + '=' + str(value) for key, value in message.args)
+    if data_length is None:
+        lines.append('EndMessage\n')
+    else:
+        lines.append('DataLength=' + str(data_length))
+        lines.append('Data\n')
+    text = '\n'.join(lines)
+    return text if PY2 else text.encode('utf-8')
+
+class Session(object):
+    """
+    The state of one request to the node, identified by the ``Identifier`` of
+    the ``message`` that started it. Every message of the session is passed to
+    ``receive``, which hands it to ``handler``. The session ends, and calls
+    ``finished(outcome, result)``, either when ``handler`` first returns a true
+    value (the ``result``, with an ``outcome`` of ``'success'``), or when the
+    node sends an error message (the ``result`` is the matching exception from
+    ``twistedfcp.error``, and the ``outcome`` is the message's name). If
+    ``handler`` raises an exception, the session ends with it, and an
+    ``outcome`` of ``'failed'``.
+
+    """
+    __slots__ = ('message', 'handler', 'finished')
+
+    def __init__(self, message, handler, finished):
+        self.message = message
+        self.handler = handler
+        self.finished = finished
+
+    @property
+    def id(self): return self.message['Identifier']
+
+    def receive(self, message):
+        "Handles a message of this session. Returns whether it ended."
+        exception = error_dict.get(message.name)
+        if exception is not None:
+            self.finished(message.name, exception(message))
+            return True
+        try:
+            result = self.handler(message)
+        except Exception as e:
+            self.finished('failed', e)
+            return True
+        if result:
+            self.finished('success', result)
+            return True
+        return False
+
+class SessionRouter(object):
+    """
+    Routes messages to the ``Session`` with the same ``Identifier``, with one
+    dictionary lookup per message. Sessions are forgotten once they end.
+
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, identifier):
+        return identifier in self.sessions
+
+    def add(self, session):
+        "Starts routing the messages of ``session`` to it."
+        self.sessions[session.id] = session
+
+    def remove(self, identifier):
+        "Stops routing messages to a session. Returns it, or ``None``."
+        return self.sessions.pop(identifier, None)
+
+    def dispatch(self, message):
+        """
+        Passes ``message`` to its session, if it has one. Returns whether it
+        did.
+
+        """
+        session = self.sessions.get(message.fields.get('Identifier'))
+        if session is None:
+            return False
+        if session.receive(message):
+            self.sessions.pop(session.id, None)
+        return True
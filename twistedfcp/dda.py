@@ -0,0 +1,189 @@
+"""
+Defines ``DirectAccess``, which finds out whether the node may read and write
+files in a directory itself, with Direct Disk Access (DDA).
+
+When the client runs on the same host as the node, a get can be written by the
+node straight to disk (``ReturnType=disk``), and a put read by the node
+straight from disk (``UploadFrom=disk``), so that the data never goes through
+the connection or the client. Before it does either, the node makes the client
+prove that it can access the directory too, with a ``TestDDARequest``
+handshake:
+
+1. The client sends ``TestDDARequest`` for a directory.
+2. The node answers with ``TestDDAReply``. To be allowed to read from the
+   directory, the client must read the contents of ``ReadFilename``, which the
+   node wrote. To be allowed to write to it, the client must write
+   ``ContentToWrite`` to ``WriteFilename``.
+3. The client sends ``TestDDAResponse`` with the contents it read.
+4. The node checks both files and answers with ``TestDDAComplete``.
+
+Only the access that is needed is asked for: a put only needs the node to
+read, and a get only needs it to write. A node that won't test a directory at
+all answers with a ``ProtocolError`` that names neither the directory nor a
+request, which is taken to be about the oldest handshake still waiting for an
+answer, and denies it.
+
+The node remembers the outcome for the rest of the connection, so it is cached
+per connection, directory and kind of access.
+
+"""
+import logging
+import os
+from collections import defaultdict
+
+from twisted.internet.defer import DeferredLock, succeed
+from coalesce import SingleFlight
+from error import NodeTimeout, ProtocolException
+from message import Message
+
+access = {'read': ('WantReadDirectory', 'ReadDirectoryAllowed'),
+          'write': ('WantWriteDirectory', 'WriteDirectoryAllowed')}
+
+class DirectAccess(object):
+    """
+    Tests, and remembers, which directories the node of ``client`` (a
+    ``FreenetClientProtocol``) may read from and write to. ``allowed`` maps
+    each tested ``(directory, kind)`` pair, where ``kind`` is ``'read'`` or
+    ``'write'``, to whether the node has that access.
+
+    """
+    def __init__(self, client):
+        self.client = client
+        self.allowed = {}
+        self.flights = SingleFlight()
+        self.locks = defaultdict(DeferredLock)
+        self.pending = []
+
+    def check(self, directory, read=True, write=True):
+        """
+        Returns a ``Deferred`` that fires with the ``(read, write)`` access the
+        node has to ``directory``, testing the kinds that are asked for if they
+        haven't been yet. Access that isn't asked for, or whose test fails
+        (rather than being denied), isn't known, and is given as ``False``.
+
+        """
+        directory = os.path.abspath(directory)
+        wanted = tuple(kind for kind, want in (('read', read),
+                                               ('write', write))
+                       if want and (directory, kind) not in self.allowed)
+
+        def known(_=None):
+            return (self.allowed.get((directory, 'read'), False),
+                    self.allowed.get((directory, 'write'), False))
+
+        if not wanted:
+            return succeed(known())
+
+        def failed(failure):
+            text = "Testing direct disk access to {0} failed: {1}"
+            logging.error(text.format(directory, failure.getErrorMessage()))
+
+        tested = self.flights.call((directory, wanted), self.test,
+                                   directory, wanted)
+        return tested.addErrback(failed).addCallback(known)
+
+    def can_read(self, directory):
+        "Returns a ``Deferred`` that fires with whether the node may read."
+        read = self.check(directory, write=False)
+        return read.addCallback(lambda allowed: allowed[0])
+
+    def can_write(self, directory):
+        "Returns a ``Deferred`` that fires with whether the node may write."
+        written = self.check(directory, read=False)
+        return written.addCallback(lambda allowed: allowed[1])
+
+    def test(self, directory, wanted):
+        """
+        Tests the ``wanted`` kinds of access to ``directory``. The node keeps
+        one test per directory, so tests of the same directory take turns.
+
+        """
+        return self.locks[directory].run(self.handshake, directory, wanted)
+
+    def waiting(self, directory):
+        "Returns the waiter for the node's next answer about ``directory``."
+        def answered(result):
+            self.pending.remove(directory)
+            return result
+
+        self.pending.append(directory)
+        return self.client.sessions[directory].addBoth(answered)
+
+    def refused(self, message):
+        """
+        Fails the oldest handshake waiting for an answer with the
+        ``ProtocolError`` ``message``. Returns whether there was one.
+
+        """
+        if not self.pending:
+            return False
+        waiting = self.client.sessions.pop(self.pending[0], None)
+        if waiting is not None:
+            waiting.errback(ProtocolException(message))
+        return True
+
+    def handshake(self, directory, wanted):
+        "Does the ``TestDDARequest`` handshake for ``directory``."
+        wanted = [kind for kind in wanted
+                  if (directory, kind) not in self.allowed]
+        if not wanted:
+            return
+        client = self.client
+        def expired():
+            waiting = client.sessions.pop(directory, None)
+            if waiting is not None:
+                waiting.errback(NodeTimeout())
+
+        timeout = client.clock.callLater(client.timeout, expired)
+
+        def replied(reply):
+            response = Message("TestDDAResponse", [("Directory", directory)])
+            if 'read' in wanted and 'ReadFilename' in reply:
+                try:
+                    with open(reply['ReadFilename'], 'rb') as f:
+                        response['ReadContent'] = f.read()
+                except IOError:
+                    pass
+            written = None
+            if 'write' in wanted:
+                written = reply.get('WriteFilename')
+            if written is not None:
+                try:
+                    with open(written, 'wb') as f:
+                        f.write(reply['ContentToWrite'])
+                except IOError:
+                    written = None
+
+            complete = self.waiting(directory)
+            client.sendMessage(response)
+            return complete.addBoth(completed, written)
+
+        def completed(result, written):
+            if written is not None and os.path.exists(written):
+                os.remove(written)
+            return result
+
+        def allowed(message):
+            for kind in wanted:
+                answer = message.get(access[kind][1])
+                self.allowed[(directory, kind)] = answer == 'true'
+
+        def denied(failure):
+            failure.trap(ProtocolException)
+            text = "The node refused to test direct disk access to {0}: {1}"
+            logging.warning(text.format(directory, failure.getErrorMessage()))
+            for kind in wanted:
+                self.allowed[(directory, kind)] = False
+
+        def ended(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        reply = self.waiting(directory)
+        client.sendMessage(Message("TestDDARequest",
+                                   [("Directory", directory)]
+                                   + [(access[kind][0], "true")
+                                      for kind in wanted]))
+        reply.addCallback(replied).addCallbacks(allowed, denied)
+        return reply.addBoth(ended)
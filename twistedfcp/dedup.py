@@ -0,0 +1,158 @@
+"""
+Defines ``DedupIndex``, a persistent index of the ``CHK`` keys that content
+was inserted as, so that inserting the same content again doesn't upload it
+again.
+
+A ``CHK`` is derived from the content and the options of the insert, so the
+same content inserted with the same options always gets the same key. The
+index maps a hash of the content, along with the URI and fields of the put, to
+the resulting ``CHK``. Fields that don't change the key, such as the priority
+or the ``ClientToken``, are left out, so content is found again however it was
+scheduled. The index is kept in an SQLite database.
+
+"""
+import hashlib
+import json
+import sqlite3
+
+from twisted.internet.defer import succeed
+from batch import ResultStream
+from cache import scheduling_fields
+from coalesce import SingleFlight
+from message import Message
+
+# Fields of a put that don't change which key it inserts.
+neutral_fields = scheduling_fields | frozenset(['ClientToken', 'Verbosity',
+                                                'Persistence', 'Global'])
+
+def digest(data):
+    "Returns the hash that content is indexed by."
+    return hashlib.sha256(data).hexdigest()
+
+def is_dedupable(uri, data):
+    "Returns whether a put of ``data`` to ``uri`` always gives the same key."
+    return uri.split('@', 1)[0].upper() == 'CHK' and isinstance(data, str)
+
+class DedupIndex(object):
+    """
+    Maps content (by hash) and insert options to the ``CHK`` it was inserted
+    as, in the SQLite database ``path`` (by default, an in-memory one). Hits,
+    misses and new entries are counted in ``stats``.
+
+    Set a ``FreenetClientProtocol``'s (or an ``FCPPool``'s) ``dedup`` to an
+    index to have its ``put_direct`` use it::
+
+        client.dedup = DedupIndex('inserts.db')
+        client.put_direct('CHK@', data)   # inserts data
+        client.put_direct('CHK@', data)   # answers from the index
+
+    """
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS inserted "
+                        "(digest TEXT, options TEXT, uri TEXT, "
+                        "PRIMARY KEY (digest, options))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS inserted_uri "
+                        "ON inserted (uri)")
+        self.db.commit()
+        self.stats = dict(hits=0, misses=0, stores=0)
+        self.flights = SingleFlight()
+
+    def close(self):
+        self.db.close()
+
+    def options(self, uri, fields):
+        """
+        Returns the options of a put as a string. Every field but those that
+        don't change the key (``neutral_fields``) is included, as most of them
+        (compression, crypto keys, metadata) do.
+
+        """
+        options = sorted((key, value) for key, value in fields.iteritems()
+                         if key not in neutral_fields)
+        return json.dumps([uri] + options)
+
+    def get(self, key, options):
+        "Returns the URI that content with hash ``key`` was inserted as."
+        row = self.db.execute("SELECT uri FROM inserted "
+                              "WHERE digest = ? AND options = ?",
+                              (key, options)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, key, options, uri):
+        "Records that content with hash ``key`` was inserted as ``uri``."
+        self.db.execute("INSERT OR REPLACE INTO inserted VALUES (?, ?, ?)",
+                        (key, options, uri))
+        self.db.commit()
+        self.stats['stores'] += 1
+
+    def known(self, uri):
+        "Returns whether any content was recorded as inserted as ``uri``."
+        row = self.db.execute("SELECT 1 FROM inserted WHERE uri = ? LIMIT 1",
+                              (uri,)).fetchone()
+        return row is not None
+
+    def put_direct(self, uri, data, fields, insert):
+        """
+        Returns a ``Deferred`` for a put of ``data`` to ``uri``. If the same
+        content was inserted with the same options before, it fires right away
+        with a ``PutSuccessful`` message for the recorded URI (with a
+        ``Deduplicated`` field). Otherwise, calls ``insert()`` and records the
+        URI it gets. Puts of other keys, or of data that isn't a string, always
+        go straight to ``insert``.
+
+        """
+        if not is_dedupable(uri, data):
+            return insert()
+
+        key, options = digest(data), self.options(uri, fields)
+        recorded = self.get(key, options)
+        if recorded is not None:
+            self.stats['hits'] += 1
+            return succeed(deduplicated(recorded))
+
+        self.stats['misses'] += 1
+        def record(message):
+            self.add(key, options, message['URI'])
+            return message
+
+        return insert().addCallback(record)
+
+    def put_many(self, client, items, concurrency=10, buffered=None):
+        """
+        Puts every ``(uri, data)`` pair of ``items`` with ``client``, like
+        ``put_many``, but answers content that is in the index from it, like
+        ``put_direct``. Items with the same content share a single insert.
+
+        Returns a ``ResultStream`` keyed by ``(uri, hash of the content)``.
+
+        """
+        def put(item):
+            uri, data = item
+            insert = lambda: client.insert_direct(uri, data)
+            if not is_dedupable(uri, data):
+                return insert()
+
+            key, options = digest(data), self.options(uri, {})
+            recorded = self.get(key, options)
+            if recorded is not None:
+                self.stats['hits'] += 1
+                return succeed(deduplicated(recorded))
+
+            self.stats['misses'] += 1
+            def record(message):
+                self.add(key, options, message['URI'])
+                return message
+
+            inserted = lambda: insert().addCallback(record)
+            return self.flights.call((key, options), inserted)
+
+        def key(item):
+            uri, data = item
+            return uri, digest(data) if isinstance(data, str) else None
+
+        return ResultStream(put, items, key, concurrency, buffered)
+
+def deduplicated(uri):
+    "Returns the message that a put answered from the index fires with."
+    return Message("PutSuccessful", [("URI", uri), ("Deduplicated", "true")])
@@ -3,15 +3,14 @@ Defines errors that can be thrown by the Freenet Node. These exceptions
 transform raw messages into Python ``Exception`` objects.
 
 """
-from twisted.python.failure import Failure
 
 class FCPException(Exception):
     "Base exception for all FCP errors."
 
 class MalformedMessageException(FCPException):
     "Indicates that the Freenet node sent a malformed message to the client."
-    def __init__(self):
-        FCPException.__init__(self, "The message sent was malformed.")
+    def __init__(self, text="The message sent was malformed."):
+        FCPException.__init__(self, text)
 
 class NodeTimeout(FCPException):
     "Indicates that the Freenet node has timed out while waiting for a result."
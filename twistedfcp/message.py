@@ -4,27 +4,60 @@ Defines messages sent through the Freenet Client Protocol.
 """
 
 class Message(object):
-    "A simple message with a name and arguments."
+    """
+    A simple message with a name and arguments. The arguments are kept, in
+    order, as a list of ``(key, value)`` pairs in ``args`` (which is how they
+    are serialized) and are indexed by key in ``fields``, so looking a key up
+    doesn't scan the arguments. If a key appears more than once, lookups return
+    its last value.
 
-    def __getitem__(self, el):
-        for k, v in self.args:
-            if k == el: return v
+    Use item assignment (``message[key] = value``) rather than modifying
+    ``args`` directly, so that both stay consistent.
+
+    """
+    __slots__ = ('name', 'args', 'fields')
 
-        raise KeyError("The key {0} is not in the message.".format(el))
+    def __getitem__(self, el):
+        try:
+            return self.fields[el]
+        except KeyError:
+            raise KeyError("The key {0} is not in the message.".format(el))
 
     def __contains__(self, el):
-        return any(k == el for k, _ in self.args)
+        return el in self.fields
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            self.args = [(k, value if k == key else v) for k, v in self.args]
+        else:
+            self.args.append((key, value))
+        self.fields[key] = value
 
-    def __init__(self, name, args):
+    def __init__(self, name, args, fields=None):
         self.name = name
-        self.args = args
+        self.args = list(args)
+        if fields is None:
+            fields = dict(self.args)
+        self.fields = fields
+
+    def get(self, el, default=None):
+        "Returns the value of ``el``, or ``default`` if it isn't present."
+        return self.fields.get(el, default)
 
 class IdentifiedMessage(Message):
-    "A message with an ``Identifier`` that is used to identify sessions."
+    """
+    A message with an ``Identifier`` that is used to identify sessions.
+    Identifiers are numbered from ``current_id`` and start with ``prefix``,
+    which processes sharing a node (as the same client) must set to different
+    values.
+
+    """
+    __slots__ = ()
     current_id = 0
+    prefix = "Request"
     def __init__(self, *args):
         Message.__init__(self, *args)
-        self.args.append(["Identifier", self.unused_identifier])
+        self["Identifier"] = self.unused_identifier
 
     @property
     def id(self): return self["Identifier"]
@@ -32,10 +65,10 @@ class IdentifiedMessage(Message):
     @property
     def unused_identifier(self):
         "Returns an ``identifier`` that is guaranteed to be unused."
-        i = "Request{0}".format(IdentifiedMessage.current_id)
+        i = "{0}{1}".format(IdentifiedMessage.prefix,
+                            IdentifiedMessage.current_id)
         IdentifiedMessage.current_id += 1
         return i
 
 ClientHello = Message("ClientHello", [("Name", "Epoxy"), 
                                       ("ExpectedVersion", "2.0")])
-
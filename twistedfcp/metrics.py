@@ -0,0 +1,136 @@
+"""
+Defines ``Metrics``, a registry of counters, gauges and histograms that a
+protocol can report to. It is disabled unless a ``Metrics`` is assigned to the
+``metrics`` attribute of a protocol (or passed to a pool)::
+
+    metrics = Metrics()
+    client.metrics = metrics
+    ...
+    metrics.snapshot()    # a dict, keyed by series
+    metrics.prometheus()  # the Prometheus text exposition format
+
+A series is a metric name together with a tuple of ``(label, value)`` pairs.
+The protocols report:
+
+- ``fcp_messages_sent_total`` and ``fcp_messages_received_total``, labelled by
+  ``message`` name.
+- ``fcp_bytes_sent_total`` and ``fcp_bytes_received_total``.
+- ``fcp_sessions_in_flight``, a gauge labelled by the ``message`` that started
+  the sessions.
+- ``fcp_session_seconds``, a histogram of session durations labelled by
+  ``message`` and ``outcome``. The outcome is ``success``, ``timeout``,
+  ``cancelled``, ``failed`` (any other local failure, such as a lost
+  connection) or the name of the node's error message (e.g. ``GetFailed``).
+
+"""
+from bisect import bisect_left
+
+class Histogram(object):
+    "Counts observed values in cumulative ``buckets``, Prometheus style."
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        "Returns ``(upper bound, count)`` pairs, ending with ``+Inf``."
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+def series_name(name, labels):
+    "Formats a series the way Prometheus does: ``name{label=\"value\"}``."
+    if not labels:
+        return name
+    pairs = ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                                        .replace('"', '\\"'))
+                     for k, v in labels)
+    return '{0}{{{1}}}'.format(name, pairs)
+
+class Metrics(object):
+    """
+    Holds counters, gauges and histograms, keyed by ``(name, labels)``. Every
+    update is a dictionary lookup and an addition, so reporting is cheap.
+
+    """
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=(), amount=1):
+        "Adds ``amount`` to a counter."
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def adjust(self, name, labels=(), amount=1):
+        "Adds ``amount`` (which may be negative) to a gauge."
+        key = (name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        "Records ``value`` in a histogram."
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def snapshot(self):
+        """
+        Returns the current value of every series, as a dict keyed by series
+        name (see ``series_name``). Histograms are dicts with their ``count``,
+        ``sum`` and cumulative ``buckets``.
+
+        """
+        result = {}
+        for (name, labels), value in self.counters.items():
+            result[series_name(name, labels)] = value
+        for (name, labels), value in self.gauges.items():
+            result[series_name(name, labels)] = value
+        for (name, labels), histogram in self.histograms.items():
+            result[series_name(name, labels)] = dict(
+                count=histogram.count, sum=histogram.sum,
+                buckets=histogram.cumulative())
+        return result
+
+    def prometheus(self):
+        "Returns every series in the Prometheus text exposition format."
+        lines = []
+        def section(kind, series):
+            seen = set()
+            for (name, labels) in sorted(series):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                yield name, labels, series[(name, labels)]
+
+        for metrics in (self.counters, self.gauges):
+            kind = 'counter' if metrics is self.counters else 'gauge'
+            for name, labels, value in section(kind, metrics):
+                lines.append('{0} {1}'.format(series_name(name, labels), value))
+        for name, labels, histogram in section('histogram', self.histograms):
+            for bound, count in histogram.cumulative():
+                bucket = labels + (('le', bound),)
+                lines.append('{0} {1}'.format(
+                    series_name(name + '_bucket', bucket), count))
+            lines.append('{0} {1!r}'.format(series_name(name + '_sum', labels),
+                                            histogram.sum))
+            lines.append('{0} {1}'.format(series_name(name + '_count', labels),
+                                          histogram.count))
+        return '\n'.join(lines) + '\n'
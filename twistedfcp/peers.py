@@ -0,0 +1,147 @@
+"""
+Defines ``PeerTable``, a cache of the node's peers that is refreshed in the
+background, so that reading it doesn't cost a round trip to the node.
+
+"""
+import logging
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import succeed
+from coalesce import SingleFlight
+from message import Message
+
+class PeerDiff(object):
+    """
+    The changes between two refreshes of a ``PeerTable``. ``added`` and
+    ``removed`` map identities to the fields of the peers that appeared or
+    disappeared. ``changed`` maps the identities of the other peers to the
+    fields that changed, as ``{field: (old, new)}`` dictionaries (a field that
+    was added or removed has ``None`` as its old or new value).
+
+    """
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, old, new):
+        self.added = dict((i, new[i]) for i in new if i not in old)
+        self.removed = dict((i, old[i]) for i in old if i not in new)
+        self.changed = {}
+        for identity, fields in new.iteritems():
+            previous = old.get(identity)
+            if previous is None or previous == fields:
+                continue
+            self.changed[identity] = dict(
+                (key, (previous.get(key), fields.get(key)))
+                for key in set(previous) | set(fields)
+                if previous.get(key) != fields.get(key))
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __bool__ = __nonzero__
+
+class PeerTable(object):
+    """
+    Keeps the node's peers, indexed by identity, in ``peers`` (each peer is a
+    dictionary of its fields). Once started, the table is refreshed every
+    ``interval`` seconds with a ``ListPeers`` request, optionally asking for
+    the peers' metadata and volatile fields. After each refresh that changed
+    anything, every subscriber is called with a ``PeerDiff``::
+
+        table = client.peer_table(interval=10, volatile=True)
+        table.subscribe(lambda diff: update_dashboard(diff.changed))
+        table.get_peers(max_age=60).addCallback(show)
+
+    Refreshes never overlap: asking for one while another is running returns
+    the running one.
+
+    """
+    def __init__(self, client, interval=30.0, metadata=False, volatile=False,
+                 clock=reactor):
+        self.client = client
+        self.interval = interval
+        self.fields = [("WithMetadata", str(metadata).lower()),
+                       ("WithVolatile", str(volatile).lower())]
+        self.clock = clock
+        self.peers = {}
+        self.updated = None
+        self.subscribers = []
+        self.flights = SingleFlight()
+        self.loop = None
+
+    def start(self):
+        "Refreshes the table now, then every ``interval`` seconds."
+        self.loop = task.LoopingCall(self.refresh_logged)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval)
+
+    def stop(self):
+        "Stops refreshing the table."
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+
+    def subscribe(self, f):
+        "Calls ``f`` with the ``PeerDiff`` of every refresh that changes peers."
+        self.subscribers.append(f)
+
+    def unsubscribe(self, f):
+        self.subscribers.remove(f)
+
+    def refresh(self):
+        """
+        Asks the node for its peers and updates the table. Returns a
+        ``Deferred`` that fires with the ``PeerDiff``.
+
+        """
+        return self.flights.call('refresh', self.list_peers)
+
+    def list_peers(self):
+        "Does the ``ListPeers`` request of ``refresh``."
+        def listed(messages):
+            peers = {}
+            for message in messages:
+                fields = dict(message.args)
+                peers[fields.get('identity')] = fields
+            diff = PeerDiff(self.peers, peers)
+            self.peers = peers
+            self.updated = self.clock.seconds()
+            if diff:
+                for subscriber in list(self.subscribers):
+                    subscriber(diff)
+            return diff
+
+        list_msg = Message("ListPeers", self.fields)
+        collected = self.client.collect(list_msg, ["Peer"], "EndListPeers")
+        return collected.addCallback(listed)
+
+    def refresh_logged(self):
+        "Refreshes the table, logging (rather than raising) any failure."
+        def failed(failure):
+            text = "Refreshing the peer table failed: {0}"
+            logging.error(text.format(failure.getErrorMessage()))
+
+        return self.refresh().addErrback(failed)
+
+    def age(self):
+        "Returns how many seconds ago the table was refreshed, or ``None``."
+        if self.updated is None:
+            return None
+        return self.clock.seconds() - self.updated
+
+    def get_peers(self, max_age=None):
+        """
+        Returns a ``Deferred`` that fires with ``peers``. The cached table is
+        used unless it is older than ``max_age`` seconds (by default, the
+        refresh ``interval``), in which case it is refreshed first.
+
+        """
+        if max_age is None:
+            max_age = self.interval
+        age = self.age()
+        if age is not None and age <= max_age:
+            return succeed(self.peers)
+        return self.refresh().addCallback(lambda _: self.peers)
+
+    def get(self, identity):
+        "Returns the cached fields of the peer ``identity``, or ``None``."
+        return self.peers.get(identity)
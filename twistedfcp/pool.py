@@ -0,0 +1,266 @@
+"""
+Defines ``FCPPool``, a client that keeps several connections open to one or
+more Freenet nodes and spreads requests across them.
+
+"""
+import logging
+
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from batch import BatchMixin
+from cache import cacheable
+from coalesce import SingleFlight
+from error import NodeTimeout
+from progress import ProgressCoalescer
+from protocol import FreenetClientProtocol
+from timer import TimerWheel
+
+class _PoolFactory(protocol.ClientFactory):
+    "Builds the single protocol of one pooled connection attempt."
+    protocol = FreenetClientProtocol
+
+    def __init__(self, node):
+        self.node = node
+        self.client = None
+        self.done = Deferred()
+
+    def buildProtocol(self, addr):
+        self.client = protocol.ClientFactory.buildProtocol(self, addr)
+        self.client.clock = self.node.pool.reactor
+        self.client.timeout = self.node.pool.timeout
+        self.client.timers = self.node.pool.timers
+        self.client.cache = self.node.pool.cache
+        self.client.dedup = self.node.pool.dedup
+        self.client.metrics = self.node.pool.metrics
+        self.client.progress = self.node.pool.progress
+        hello = self.client.deferred['NodeHello']
+        hello.addCallback(lambda _: self.node.ready(self.client))
+        return self.client
+
+    def clientConnectionFailed(self, connector, reason):
+        self.node.lost(self, reason)
+        self.done.callback(None)
+
+    def clientConnectionLost(self, connector, reason):
+        self.node.lost(self, reason)
+        self.done.callback(None)
+
+class PoolNode(object):
+    """
+    A single node in a pool. Tracks its connections, and reconnects (with an
+    exponential backoff) whenever a connection fails or is lost. A node is
+    *healthy*, and part of the rotation, as long as it has a connection that
+    has completed the ``ClientHello`` handshake.
+
+    """
+    def __init__(self, pool, host, port):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.factories = []
+        self.connections = []
+        self.delay = pool.retry_delay
+        self.retry = None
+        self.timeouts = 0
+
+    @property
+    def healthy(self): return bool(self.connections)
+
+    def connect(self):
+        "Opens connections until there are as many as the pool's ``size``."
+        self.retry = None
+        while len(self.factories) < self.pool.size:
+            factory = _PoolFactory(self)
+            self.factories.append(factory)
+            factory.connector = self.pool.reactor.connectTCP(self.host, 
+                                                             self.port, factory)
+
+    def ready(self, client):
+        "Called once ``client`` has completed its handshake."
+        logging.info("Connected to {0}:{1}.".format(self.host, self.port))
+        self.delay = self.pool.retry_delay
+        self.timeouts = 0
+        self.connections.append(client)
+        self.pool.serve_waiting()
+
+    def lost(self, factory, reason):
+        "Called when one of the connections failed or was lost."
+        self.factories.remove(factory)
+        if factory.client in self.connections:
+            self.connections.remove(factory.client)
+        if self.pool.running and self.retry is None:
+            text = "Connection to {0}:{1} lost ({2}), retrying in {3}s."
+            logging.warning(text.format(self.host, self.port,
+                                        reason.getErrorMessage(), self.delay))
+            self.retry = self.pool.reactor.callLater(self.delay, self.connect)
+            self.delay = min(self.delay * 2, self.pool.max_retry_delay)
+
+    def session_ended(self, result):
+        """
+        Tracks the outcome of a session routed to this node. A node that times
+        out ``max_timeouts`` sessions in a row is considered hung, and all of
+        its connections are dropped (and then retried).
+
+        """
+        if isinstance(result, Failure) and result.check(NodeTimeout):
+            self.timeouts += 1
+            if self.timeouts >= self.pool.max_timeouts:
+                self.timeouts = 0
+                for client in list(self.connections):
+                    client.transport.loseConnection()
+        else:
+            self.timeouts = 0
+        return result
+
+    def stop(self):
+        "Closes all connections, returning a ``Deferred`` for when they are."
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+        done = [f.done for f in self.factories]
+        for factory in self.factories:
+            factory.connector.disconnect()
+        return gatherResults(done)
+
+class FCPPool(BatchMixin):
+    """
+    Keeps ``size`` connections open to each of the given ``nodes`` (a list of
+    ``(host, port)`` pairs) and routes every request to the connection with
+    the fewest outstanding sessions. Offers the same request methods as
+    ``FreenetClientProtocol``::
+
+        pool = FCPPool([('localhost', 9481), ('otherhost', 9481)], size=4)
+        pool.start()
+        pool.get_direct('CHK@...').addCallback(got_data)
+
+    Requests made while no node is healthy wait until one is. All connections
+    share one ``TimerWheel`` for their session timeouts, one
+    ``ProgressCoalescer`` for progress updates, the ``cache`` (a
+    ``ContentCache``), ``metrics`` (a ``Metrics``) and ``dedup`` (a
+    ``DedupIndex``), if they are given.
+
+    """
+    retry_delay = 1.0
+    max_retry_delay = 60.0
+    max_timeouts = 3
+
+    def __init__(self, nodes, size=2, timeout=None, cache=None, metrics=None,
+                 reactor=reactor, dedup=None):
+        self.size = size
+        self.cache = cache
+        self.dedup = dedup
+        self.metrics = metrics
+        self.timeout = timeout or FreenetClientProtocol.default_timeout
+        self.reactor = reactor
+        self.timers = TimerWheel(clock=reactor)
+        self.progress = ProgressCoalescer(clock=reactor)
+        self.nodes = [PoolNode(self, host, port) for host, port in nodes]
+        self.waiting = []
+        self.running = False
+        self.flights = SingleFlight()
+
+    def start(self):
+        "Connects to all nodes."
+        self.running = True
+        for node in self.nodes:
+            node.connect()
+
+    def stop(self):
+        """
+        Closes all connections, and fails the requests still waiting for one
+        with ``ConnectionDone``. Returns a ``Deferred`` that fires once they are
+        all closed.
+
+        """
+        self.running = False
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            if not deferred.called:
+                deferred.errback(ConnectionDone("The pool was stopped."))
+        return gatherResults([node.stop() for node in self.nodes])
+
+    def connections(self):
+        "Returns ``(node, connection)`` pairs for every usable connection."
+        return [(node, c) for node in self.nodes for c in node.connections]
+
+    def connection(self):
+        """
+        Returns a ``Deferred`` that fires with a ``(node, connection)`` pair for
+        the least loaded connection, as soon as there is one.
+
+        """
+        connections = self.connections()
+        if connections:
+            return succeed(min(connections, key=lambda nc: len(nc[1].router)))
+        waiting = Deferred()
+        self.waiting.append(waiting)
+        return waiting
+
+    def serve_waiting(self):
+        "Hands connections to requests that were waiting for one."
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            if not deferred.called:
+                self.connection().chainDeferred(deferred)
+
+    def request(self, name, *args, **kwargs):
+        "Calls the method ``name`` of the least loaded connection."
+        def call(node_connection):
+            node, connection = node_connection
+            result = getattr(connection, name)(*args, **kwargs)
+            return result.addBoth(node.session_ended)
+
+        return self.connection().addCallback(call)
+
+    def get_direct(self, uri, sink=None, on_progress=None, **fields):
+        "See ``FreenetClientProtocol.get_direct``."
+        fetch = lambda uri, sink: self.fetch_direct(uri, sink, on_progress,
+                                                    **fields)
+        if self.cache is not None and cacheable(fields):
+            return self.cache.get_direct(uri, sink, fetch)
+        return fetch(uri, sink)
+
+    def fetch_direct(self, uri, sink=None, on_progress=None, **fields):
+        "See ``FreenetClientProtocol.fetch_direct``."
+        if sink is None and on_progress is None:
+            key = (uri, tuple(sorted(fields.iteritems())))
+            request = lambda: self.request('fetch_direct', uri, **fields)
+            return self.flights.call(key, request)
+        return self.request('fetch_direct', uri, sink, on_progress, **fields)
+
+    def put_direct(self, uri, data, length=None, on_progress=None, **fields):
+        "See ``FreenetClientProtocol.put_direct``."
+        insert = lambda: self.insert_direct(uri, data, length, on_progress,
+                                            **fields)
+        if self.dedup is not None:
+            return self.dedup.put_direct(uri, data, fields, insert)
+        return insert()
+
+    def insert_direct(self, uri, data, length=None, on_progress=None,
+                      **fields):
+        "See ``FreenetClientProtocol.insert_direct``."
+        return self.request('insert_direct', uri, data, length, on_progress,
+                            **fields)
+
+    def get_chk(self, uri, data, length=None, **fields):
+        "See ``FreenetClientProtocol.get_chk``."
+        return self.request('get_chk', uri, data, length, **fields)
+
+    def put_complex_dir(self, uri, files, default_name=None, **fields):
+        "See ``FreenetClientProtocol.put_complex_dir``."
+        return self.request('put_complex_dir', uri, files, default_name,
+                            **fields)
+
+    def get_file(self, uri, filename, on_progress=None, **fields):
+        "See ``FreenetClientProtocol.get_file``."
+        return self.request('get_file', uri, filename, on_progress, **fields)
+
+    def put_file(self, uri, filename, on_progress=None, **fields):
+        "See ``FreenetClientProtocol.put_file``."
+        return self.request('put_file', uri, filename, on_progress, **fields)
+
+    def get_ssk_keypair(self):
+        "See ``FreenetClientProtocol.get_ssk_keypair``."
+        return self.request('get_ssk_keypair')
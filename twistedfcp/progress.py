@@ -0,0 +1,70 @@
+"""
+Defines ``ProgressCoalescer``, which passes on the progress of sessions at a
+steady rate, however often the node reports it.
+
+The node sends a ``SimpleProgress`` message for a request every time a block
+of it succeeds or fails, which for a large splitfile can be hundreds of times
+a second. A coalescer only keeps the latest message of each session, and hands
+it to the session's observer once every ``interval`` seconds.
+
+"""
+import logging
+
+from twisted.internet import reactor
+
+class ProgressCoalescer(object):
+    """
+    Collects progress updates, and delivers the latest one for each session
+    every ``interval`` seconds. Recording an update is a single dictionary
+    assignment, and the coalescer only holds one delayed call (and none while
+    there is nothing to deliver), so it can be shared by many connections.
+
+    """
+    def __init__(self, interval=1.0, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.latest = {}
+        self.call = None
+
+    def __len__(self):
+        return len(self.latest)
+
+    def update(self, key, observer, message):
+        "Records ``message`` as the latest progress of session ``key``."
+        self.latest[key] = (observer, message)
+        if self.call is None:
+            self.call = self.clock.callLater(self.interval, self.deliver)
+
+    def deliver(self):
+        "Hands the latest update of every session to its observer."
+        self.call = None
+        latest, self.latest = self.latest, {}
+        for observer, message in latest.itervalues():
+            self.notify(observer, message)
+
+    def flush(self, key):
+        "Delivers the pending update of session ``key`` (if any) right away."
+        pending = self.latest.pop(key, None)
+        if not self.latest and self.call is not None:
+            self.call.cancel()
+            self.call = None
+        if pending is not None:
+            self.notify(*pending)
+
+    def notify(self, observer, message):
+        try:
+            observer(message)
+        except Exception as e:
+            text = "A progress observer failed on {0}: {1!r}"
+            logging.error(text.format(message.get('Identifier'), e))
+
+def fraction(message):
+    """
+    Returns how much of a request a ``SimpleProgress`` message reports done,
+    between 0 and 1, counting the blocks it requires.
+
+    """
+    required = int(message.get('Required', 0))
+    if not required:
+        return 0.0
+    return min(1.0, int(message.get('Succeeded', 0)) / float(required))
@@ -6,17 +6,29 @@ Similarly, defines a factory ``FCPFactory`` that produces
 ``FreenetClientProtocol`` objects when connected to a reactor.
 
 """
+import os
 import struct
+import tempfile
 import logging
 
 from collections import defaultdict
 from twisted.internet import reactor, protocol
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from batch import BatchMixin
+from cache import cacheable
+from coalesce import SingleFlight
+from dda import DirectAccess
+from core import Session, SessionRouter
 from message import Message, IdentifiedMessage, ClientHello
-from error import NodeTimeout, Failure, error_dict
+from peers import PeerTable
+from error import NodeTimeout
+from progress import ProgressCoalescer
+from stream import FileSink
+from timer import TimerWheel
 from util import MessageBasedProtocol
 
-class FreenetClientProtocol(MessageBasedProtocol):
+class FreenetClientProtocol(MessageBasedProtocol, BatchMixin):
     """
     Defines a twisted implementation of the Freenet Client Protocol. There are
     several important things to note about the internals of this class: 
@@ -37,102 +49,420 @@ class FreenetClientProtocol(MessageBasedProtocol):
       ``sessions`` variable fires, it is automatically removed, meaning that the
       callback must re-attach if it wants to receive further notifications.
 
+    - Sessions started by ``do_session`` don't use ``sessions``. They are kept
+      in ``self.router`` (a ``twistedfcp.core.SessionRouter``), which hands
+      each message straight to its session's handler. A ``Deferred`` is only
+      fired once, with the session's result.
+
     - All sessions will be forcibly ended (with a ``NodeTimeout`` errback) after
       a set period of time. This period of time is set by default to 
       ``FreenetClientProtocol.default_timeout`` and can be changed by setting
-      ``self.timeout`` for a given instance.
+      ``self.timeout`` for a given instance. These timeouts are kept on a
+      ``TimerWheel`` (``self.timers``), which expires them in batches, up to a
+      second late. Several connections can share a wheel. Unless one is set
+      before the connection is made, each connection gets its own, running on
+      ``self.clock``.
+
+    - If ``self.metrics`` is set to a ``twistedfcp.metrics.Metrics``, the number
+      of sessions in flight and the duration and outcome of every session are
+      reported to it, along with the messages and bytes sent and received.
+
+    - The progress of a session can be followed by passing an ``on_progress``
+      observer to ``do_session``, ``get_direct`` or ``put_direct``. It is
+      called with the latest ``SimpleProgress`` message of the session at most
+      once every ``self.progress.interval`` seconds (see
+      ``twistedfcp.progress``), and once more before the session ends if an
+      update is pending.
+
+    - Batches of gets and puts, with a bounded number of sessions in flight,
+      can be made with ``get_many`` and ``put_many`` (see ``twistedfcp.batch``).
+
+    - Messages without an ``Identifier`` that are about a ``Directory`` (the
+      ``TestDDA`` messages) are passed to the ``sessions`` waiter of that
+      directory. ``get_file`` and ``put_file`` use them, through ``self.dda``,
+      to let the node access files directly when it is allowed to (see
+      ``twistedfcp.dda``). A ``ProtocolError`` about neither is taken to
+      refuse the oldest of those tests still waiting for an answer.
 
     """
     default_timeout = 10 * 60
     port = 9481
+    hello = ClientHello
 
     def __init__(self):
         MessageBasedProtocol.__init__(self)
         self.deferred = defaultdict(Deferred)
+        self.listing = defaultdict(list)
         self.sessions = defaultdict(Deferred)
+        self.router = SessionRouter()
+        self.sinks = {}
+        self.cache = None
+        self.dedup = None
+        self.flights = SingleFlight()
+        self.active = {}
         self.timeout = self.default_timeout
+        self.timers = None
+        self.progress = None
+        self.peers = None
+        self.dda = DirectAccess(self)
 
     def connectionMade(self):
-        "On connection, sends a FCP ClientHello message."
-        self.sendMessage(ClientHello)
+        """
+        On connection, sends a FCP ClientHello message (``self.hello``). Any
+        other message sent before the node answers with a NodeHello is queued
+        until then.
 
-    def message_received(self, messageType, messageItems):
+        The session timers and progress coalescer are created here, if none
+        were set, so that they use the ``clock`` the protocol ended up with.
+
+        """
+        MessageBasedProtocol.connectionMade(self)
+        if self.timers is None:
+            self.timers = TimerWheel(clock=self.clock)
+        if self.progress is None:
+            self.progress = ProgressCoalescer(clock=self.clock)
+        self.sendMessage(self.hello)
+        self.hold()
+
+    def message_received(self, message):
         "Processes the received message, firing the necessary deferreds."
-        message = Message(messageType, messageItems.items())
+        if message.name == 'NodeHello':
+            self.release()
         if message.name in self.deferred:
             deferred = self.deferred[message.name]
             del self.deferred[message.name]
             deferred.callback(message)
-        if 'Identifier' in message: 
-            session_id = message['Identifier']
+        if not self.router.dispatch(message) and self.sessions:
+            session_id = message.get('Identifier', message.get('Directory'))
             if session_id in self.sessions:
                 deferred = self.sessions[session_id]
                 del self.sessions[session_id]
-                result = deferred.callback(message)
-
-    def do_session(self, msg, handler, data=None):
+                deferred.callback(message)
+            elif session_id is None and message.name == 'ProtocolError':
+                self.dda.refused(message)
+
+    def data_sink(self, message):
+        "Uses the sink registered for the message's session, if there is one."
+        sink = self.sinks.get(message.get('Identifier'))
+        if sink is None:
+            return MessageBasedProtocol.data_sink(self, message)
+        return sink
+
+    def do_session(self, msg, handler, data=None, length=None, send=True,
+                   on_progress=None):
         """
         Wraps the given message processing function ``f`` in session handling
-        code. Ends the session if it lasts longer than ``self.timeout`` seconds.
+        code. Ends the session if it lasts longer than ``self.timeout`` seconds,
+        if sending ``msg`` (and its ``data``) fails, or if the connection is
+        lost. Cancelling the returned ``Deferred`` ends the session and asks the
+        node to remove the request.
+
+        If ``send`` is false, ``msg`` is not sent, and the session waits for
+        messages about a request that the node already knows of. A message
+        with ``data`` is only sent once the connection is ``writable``, so
+        that puts don't pile up in memory faster than they can be sent. The
+        timeout only starts once the message is sent, and a session cancelled
+        before then never reaches the node.
+
+        ``SimpleProgress`` messages are not passed to ``handler`` if an
+        ``on_progress`` observer is given. They are coalesced by
+        ``self.progress`` and passed to the observer instead.
 
         """
-        done = Deferred()
-        session_id = msg.id
-
-        def timeout():
+        session_id = msg['Identifier']
+        metrics = self.metrics
+        if metrics is not None:
+            started = self.clock.seconds()
+            labels = (('message', msg.name),)
+            metrics.adjust('fcp_sessions_in_flight', labels, 1)
+
+        timers = []
+        waiting = []
+        ended = []
+
+        def end(outcome):
+            # Cancelling a waiting put fails its waiter too, which mustn't end
+            # the session a second time.
+            if ended:
+                return
+            ended.append(outcome)
+            for timer in timers:
+                timer.cancel()
+            self.router.remove(session_id)
+            self.active.pop(session_id, None)
+            if on_progress is not None:
+                self.progress.flush(session_id)
+            if metrics is not None:
+                metrics.adjust('fcp_sessions_in_flight', labels, -1)
+                metrics.observe('fcp_session_seconds',
+                                labels + (('outcome', outcome),),
+                                self.clock.seconds() - started)
+
+        def cancel(done):
+            end('cancelled')
+            if waiting:
+                # The node never got the request, so there's nothing to remove.
+                waiting.pop().cancel()
+                return
+            remove = Message("RemoveRequest", 
+                             [("Identifier", session_id),
+                              ("Global", msg.get("Global", "false"))])
+            self.sendMessage(remove)
+
+        done = Deferred(cancel)
+
+        def fail(failure):
+            if not ended:
+                timed_out = failure.check(NodeTimeout)
+                end('timeout' if timed_out else 'failed')
+                done.errback(failure)
+
+        def timed_out():
             text = 'The node timed out on session "{0}"'
             logging.error(text.format(session_id))
-            del self.sessions[session_id]
-            done.errback(NodeTimeout())
+            fail(Failure(NodeTimeout()))
 
-        timeout = reactor.callLater(self.timeout, timeout)
+        def start_timer():
+            timers.append(self.timers.schedule(self.timeout, timed_out))
 
-        def callback(a):
-            if a.name in error_dict.keys():
-                exception = error_dict[a.name]
-                timeout.cancel()
-                done.errback(exception(a))
+        def finished(outcome, result):
+            end(outcome)
+            if outcome == 'success':
+                done.callback(result)
             else:
-                result = handler(a)
-                if result:
-                    timeout.cancel()
-                    done.callback(result)
+                done.errback(result)
+
+        self.active[session_id] = fail
+        if on_progress is not None:
+            handle = handler
+            def handler(message):
+                if message.name == "SimpleProgress":
+                    self.progress.update(session_id, on_progress, message)
                 else:
-                    self.sessions[session_id].addCallback(callback) 
-
-        self.sessions[session_id].addCallback(callback)
-        self.sendMessage(msg, data)
+                    return handle(message)
+
+        self.router.add(Session(msg, handler, finished))
+        if send and data is not None:
+            def writable(_):
+                del waiting[:]
+                if not done.called:
+                    start_timer()
+                    return self.sendMessage(msg, data, length)
+
+            waiting.append(self.wait_writable())
+            waiting[0].addCallback(writable).addErrback(fail)
+        else:
+            start_timer()
+            if send:
+                self.sendMessage(msg, data, length).addErrback(fail)
 
         return done
 
-    def get_direct(self, uri):
+    def connectionLost(self, reason):
+        "Fails every ongoing session with the ``reason`` the connection ended."
+        MessageBasedProtocol.connectionLost(self, reason)
+        if self.peers is not None:
+            self.peers.stop()
+        for fail in self.active.values():
+            fail(reason)
+        listing, self.listing = self.listing, defaultdict(list)
+        for queue in listing.values():
+            for _, _, done in queue:
+                done.errback(reason)
+
+    def get_direct(self, uri, sink=None, on_progress=None, **fields):
         """
         Does a direct get of the given ``uri`` (data will be returned in the
         body of the message in the ``Data`` field. Returns a ``Deferred`` event
         that will fire when the final ``AllData`` message arrives.
 
+        If a ``sink`` (see ``twistedfcp.stream``) is given, the data is streamed
+        into it as it arrives, and the ``Data`` field holds the sink's result
+        (e.g. the file object of a ``FileSink``).
+
+        Any other keyword arguments are added as fields of the ``ClientGet``.
+
+        If ``self.cache`` is set to a ``ContentCache``, immutable keys are
+        looked up in it first, and fetched ones are stored in it (unless extra
+        fields, other than those that only affect scheduling, are given).
+
+        Concurrent gets of the same ``uri`` with the same fields (and no sink or
+        progress observer) share a single session. Each caller can cancel its
+        own ``Deferred``; the session is only cancelled once all of them have.
+
         """
-        get = IdentifiedMessage("ClientGet", [("URI", uri), ("Verbosity", 1)])
+        fetch = lambda uri, sink: self.fetch_direct(uri, sink, on_progress,
+                                                    **fields)
+        if self.cache is not None and cacheable(fields):
+            return self.cache.get_direct(uri, sink, fetch)
+        return fetch(uri, sink)
+
+    def fetch_direct(self, uri, sink=None, on_progress=None, **fields):
+        "Does the ``ClientGet`` for ``get_direct``, bypassing any cache."
+        if sink is None and on_progress is None:
+            key = (uri, tuple(sorted(fields.iteritems())))
+            return self.flights.call(key, self.start_get, uri, None, fields)
+        return self.start_get(uri, sink, fields, on_progress)
+
+    def start_get(self, uri, sink, fields, on_progress=None):
+        "Starts a new ``ClientGet`` session."
+        get = IdentifiedMessage("ClientGet", [("URI", uri), ("Verbosity", 1)]
+                                + sorted(fields.iteritems()))
         def process(message):
             if message.name == "AllData":
                 return message
 
-        return self.do_session(get, process)
+        if sink is None:
+            return self.do_session(get, process, on_progress=on_progress)
+
+        session_id = get.id
+        self.sinks[session_id] = sink
+        def unregister(result):
+            del self.sinks[session_id]
+            return result
+
+        done = self.do_session(get, process, on_progress=on_progress)
+        return done.addBoth(unregister)
 
-    def put_direct(self, uri, data):
+    def put_direct(self, uri, data, length=None, on_progress=None, **fields):
         """
         Does a direct put to the given ``uri`` (data will be sent directly in
         the body of the message in the ``Data`` field). Returns a ``Deferred``
         even that will fire when the final ``PutSuccessful`` message arrives,
-        or will errback when a ``PutFailed`` message arrives.
+        or will errback when a ``PutFailed`` message arrives. Any extra
+        keyword arguments are added as fields of the ``ClientPut``.
+
+        Instead of a string, ``data`` can be a file object, an iterable of
+        chunks (whose total ``length`` must be given) or an ``IBodyProducer``.
+        These are streamed to the node without being read into memory.
+
+        If ``self.dedup`` is set to a ``DedupIndex``, ``CHK`` puts of content
+        that was inserted before (with the same fields) return the recorded URI
+        without contacting the node, and new ones are recorded in it.
+
+        """
+        insert = lambda: self.insert_direct(uri, data, length, on_progress,
+                                            **fields)
+        if self.dedup is not None:
+            return self.dedup.put_direct(uri, data, fields, insert)
+        return insert()
+
+    def insert_direct(self, uri, data, length=None, on_progress=None,
+                      **fields):
+        "Does the ``ClientPut`` for ``put_direct``, bypassing any dedup index."
+        args = [("URI", uri), ("Verbosity", 1)] + sorted(fields.iteritems())
+        put = IdentifiedMessage("ClientPut", args)
+        def process(message):
+            if message.name == "PutSuccessful":
+                return message
+
+        return self.do_session(put, process, data, length,
+                               on_progress=on_progress)
+
+    def get_chk(self, uri, data, length=None, **fields):
+        """
+        Asks the node which key a put of ``data`` to ``uri`` would insert,
+        without inserting it (``GetCHKOnly``). Returns a ``Deferred`` that
+        fires with the ``PutSuccessful`` message, whose ``URI`` is the key.
+
+        """
+        return self.insert_direct(uri, data, length, GetCHKOnly="true",
+                                  **fields)
+
+    def put_complex_dir(self, uri, files, default_name=None, **fields):
+        """
+        Inserts a manifest at ``uri`` that redirects each name of ``files``, a
+        list of ``(name, target_uri)`` pairs, to its target (usually a ``CHK``
+        that was inserted beforehand). Returns a ``Deferred`` that fires with
+        the ``PutSuccessful`` message.
 
         """
-        put = IdentifiedMessage("ClientPut", [("URI", uri), ("Verbosity", 1)])
+        args = [("URI", uri), ("Verbosity", 1)]
+        if default_name is not None:
+            args.append(("DefaultName", default_name))
+        for i, (name, target) in enumerate(files):
+            prefix = "Files.{0}.".format(i)
+            args.extend([(prefix + "Name", name),
+                         (prefix + "UploadFrom", "redirect"),
+                         (prefix + "TargetURI", target)])
+        args.extend(sorted(fields.iteritems()))
+        put = IdentifiedMessage("ClientPutComplexDir", args)
         def process(message):
             if message.name == "PutSuccessful":
                 return message
 
-        return self.do_session(put, process, data)
+        return self.do_session(put, process)
+
+    def get_file(self, uri, filename, on_progress=None, **fields):
+        """
+        Gets ``uri`` into the file ``filename``. If the node may write to the
+        file's directory, it writes the data itself (``ReturnType=disk``), and
+        the returned ``Deferred`` fires with the ``DataFound`` message.
+        Otherwise, the data is received with ``get_direct`` and written to a
+        temporary file next to ``filename`` as it arrives, which is renamed to
+        ``filename`` once the get succeeds (and removed if it fails), and the
+        ``Deferred`` fires with the ``AllData`` message.
+
+        """
+        filename = os.path.abspath(filename)
+        def checked(allowed):
+            if not allowed:
+                directory, name = os.path.split(filename)
+                fd, partial = tempfile.mkstemp(prefix=name + '.',
+                                               suffix='.part', dir=directory)
+                f = os.fdopen(fd, 'wb')
+                def finished(result):
+                    if isinstance(result, Failure):
+                        os.remove(partial)
+                    else:
+                        os.rename(partial, filename)
+                    return result
+
+                got = self.get_direct(uri, FileSink(f), on_progress, **fields)
+                return got.addBoth(closed, f).addBoth(finished)
+            get = IdentifiedMessage("ClientGet",
+                                    [("URI", uri), ("Verbosity", 1),
+                                     ("ReturnType", "disk"),
+                                     ("Filename", filename)]
+                                    + sorted(fields.iteritems()))
+            def process(message):
+                if message.name == "DataFound":
+                    return message
+
+            return self.do_session(get, process, on_progress=on_progress)
+
+        allowed = self.dda.can_write(os.path.dirname(filename))
+        return allowed.addCallback(checked)
+
+    def put_file(self, uri, filename, on_progress=None, **fields):
+        """
+        Puts the contents of the file ``filename`` to ``uri``. If the node may
+        read from the file's directory, it reads the file itself
+        (``UploadFrom=disk``). Otherwise, the file is streamed to the node with
+        ``put_direct``. Either way, the returned ``Deferred`` fires with the
+        ``PutSuccessful`` message.
+
+        """
+        filename = os.path.abspath(filename)
+        def checked(allowed):
+            if not allowed:
+                f = open(filename, 'rb')
+                put = self.put_direct(uri, f, os.path.getsize(filename),
+                                      on_progress, **fields)
+                return put.addBoth(closed, f)
+            put = IdentifiedMessage("ClientPut",
+                                    [("URI", uri), ("Verbosity", 1),
+                                     ("UploadFrom", "disk"),
+                                     ("Filename", filename)]
+                                    + sorted(fields.iteritems()))
+            def process(message):
+                if message.name == "PutSuccessful":
+                    return message
+
+            return self.do_session(put, process, on_progress=on_progress)
+
+        allowed = self.dda.can_read(os.path.dirname(filename))
+        return allowed.addCallback(checked)
 
     def get_ssk_keypair(self):
         """
@@ -152,23 +482,86 @@ class FreenetClientProtocol(MessageBasedProtocol):
 
         return self.do_session(gen, process)
 
-    def get_all_peers(self):
-        list_msg = Message("ListPeers", [])
-        peers = []
+    def collect(self, msg, names, end):
+        """
+        Sends ``msg``, and collects every message named in ``names`` that the
+        node sends until it sends a message named ``end``. Returns a
+        ``Deferred`` that fires with the list of collected messages.
+
+        The node's answers to lists carry no identifier, so lists that end
+        with the same message are run one after the other: a list asked for
+        while another is running (say, by a ``PeerTable`` refresh) is only
+        sent once that one has ended.
+
+        """
         done = Deferred()
+        queue = self.listing[end]
+        queue.append((msg, names, done))
+        if len(queue) == 1:
+            self.start_list(end)
+        return done
 
-        def node_info(message):
-            peers.append(message.args)
-            self.deferred["Peer"].addCallback(node_info)
+    def start_list(self, end):
+        "Sends the first list queued by ``collect`` that ends with ``end``."
+        msg, names, done = self.listing[end][0]
+        collected = []
+
+        def collect(message):
+            collected.append(message)
+            self.deferred[message.name].addCallback(collect)
 
         def end_list(message):
-            del self.deferred["Peer"]
-            done.callback(peers)
+            for name in names:
+                self.deferred.pop(name, None)
+            queue = self.listing[end]
+            queue.pop(0)
+            if queue:
+                self.start_list(end)
+            else:
+                del self.listing[end]
+            if not done.called:
+                done.callback(collected)
 
-        self.deferred["Peer"].addCallback(node_info)
-        self.deferred["EndListPeers"].addCallback(end_list)
-        self.sendMessage(list_msg)
-        return done
+        for name in names:
+            self.deferred[name].addCallback(collect)
+        self.deferred[end].addCallback(end_list)
+        self.sendMessage(msg)
+
+    def get_all_peers(self):
+        list_msg = Message("ListPeers", [])
+        collected = self.collect(list_msg, ["Peer"], "EndListPeers")
+        return collected.addCallback(lambda peers: [p.args for p in peers])
+
+    def peer_table(self, interval=30.0, metadata=False, volatile=False):
+        """
+        Returns the connection's ``PeerTable`` (see ``twistedfcp.peers``),
+        starting one that refreshes every ``interval`` seconds if there is
+        none yet. Reading the table answers from the cache, instead of asking
+        the node as ``get_all_peers`` does.
+
+        """
+        if self.peers is None:
+            self.peers = PeerTable(self, interval, metadata, volatile,
+                                   clock=self.clock)
+            self.peers.start()
+        return self.peers
+
+    def list_persistent_requests(self):
+        """
+        Lists the persistent requests the node knows of (including the global
+        queue, if it is being watched). Returns a ``Deferred`` that fires with a
+        list of ``PersistentGet``, ``PersistentPut`` and ``PersistentPutDir``
+        messages.
+
+        """
+        list_msg = Message("ListPersistentRequests", [])
+        names = ["PersistentGet", "PersistentPut", "PersistentPutDir"]
+        return self.collect(list_msg, names, "EndListPersistentRequests")
+
+def closed(result, f):
+    "Closes ``f`` once a transfer from or to it ended, passing ``result`` on."
+    f.close()
+    return result
 
 class FCPFactory(protocol.Factory):
     "A protocol factory that uses FCP."
@@ -0,0 +1,206 @@
+"""
+Defines ``ResumingClient``, a client that reconnects to the node when the
+connection drops, and picks its requests up where the node left them.
+
+"""
+import itertools
+import logging
+import uuid
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.internet.protocol import ReconnectingClientFactory
+from batch import BatchMixin
+from message import Message
+from protocol import FreenetClientProtocol
+
+class PersistentRequest(object):
+    """
+    A request on the node's global queue. Outlives the connection it was made
+    on: ``done`` only fires once the request completes or fails on the node.
+
+    """
+    def __init__(self, client, message, handler, data=None, length=None,
+                 on_progress=None):
+        self.client = client
+        self.message = message
+        self.handler = handler
+        self.data = data
+        self.length = length
+        self.on_progress = on_progress
+        self.attempt = None
+        self.done = Deferred(self.cancel)
+
+    @property
+    def id(self): return self.message['Identifier']
+
+    @property
+    def replayable(self):
+        "Whether the request (and its data) can be sent again."
+        return self.data is None or isinstance(self.data, str)
+
+    def submit(self, connection, resume):
+        """
+        Starts the request on ``connection``. If ``resume`` is true, the node
+        already has the request, so it is only asked for its current status.
+
+        """
+        self.attempt = connection.do_session(self.message, self.handler,
+                                             self.data, self.length,
+                                             send=not resume,
+                                             on_progress=self.on_progress)
+        self.attempt.addCallbacks(self.succeeded, self.failed)
+        if resume:
+            connection.sendMessage(Message("GetRequestStatus",
+                                           [("Identifier", self.id),
+                                            ("Global", "true"),
+                                            ("OnlyData", "false")]))
+
+    def succeeded(self, result):
+        self.client.finished(self)
+        self.done.callback(result)
+
+    def failed(self, failure):
+        if failure.check(ConnectionDone, ConnectionLost, CancelledError):
+            return
+        self.client.finished(self)
+        self.done.errback(failure)
+
+    def cancel(self, done):
+        if self.attempt is not None and not self.attempt.called:
+            self.attempt.cancel()
+        self.client.finished(self, remove=False)
+
+class ResumingClient(ReconnectingClientFactory, BatchMixin):
+    """
+    A client factory that keeps a connection to a single node, reconnecting
+    with an exponential backoff whenever it is lost::
+
+        client = ResumingClient()
+        client.connect('localhost', 9481)
+        client.get_direct('CHK@...').addCallback(got_data)
+
+    Requests are made on the node's global queue (with ``Global=true`` and
+    ``Persistence`` set to ``persistence``) under identifiers that are stable
+    across connections. After reconnecting, the client watches the global
+    queue and lists the node's persistent requests. Requests the node still
+    has are reattached to their ``Deferred``; the others are sent again (which
+    requires their data, if any, to be a string). Requests are removed from
+    the global queue once they complete.
+
+    Requests made while disconnected are sent once the connection is back.
+    Every connection reports to ``metrics``, if it is set.
+
+    """
+    protocol = FreenetClientProtocol
+    maxDelay = 60
+    persistence = "reboot"
+
+    def __init__(self, name=None, timeout=None):
+        self.prefix = name or "twistedfcp-{0}".format(uuid.uuid4().hex)
+        self.timeout = timeout or FreenetClientProtocol.default_timeout
+        self.ids = itertools.count()
+        self.requests = OrderedDict()
+        self.client = None
+        self.metrics = None
+
+    def connect(self, host='localhost', port=FreenetClientProtocol.port):
+        "Connects to the node at ``host``:``port``."
+        return reactor.connectTCP(host, port, self)
+
+    def buildProtocol(self, addr):
+        connection = ReconnectingClientFactory.buildProtocol(self, addr)
+        connection.timeout = self.timeout
+        connection.metrics = self.metrics
+        hello = connection.deferred['NodeHello']
+        hello.addCallback(lambda _: self.connected(connection))
+        return connection
+
+    def connected(self, connection):
+        "Reattaches or resubmits all requests once ``connection`` is ready."
+        self.resetDelay()
+        connection.sendMessage(Message("WatchGlobal", [("Enabled", "true")]))
+
+        def listed(messages):
+            known = set()
+            for message in messages:
+                identifier = message.get("Identifier", "")
+                if message.get("Global") != "true":
+                    continue
+                if identifier in self.requests:
+                    known.add(identifier)
+                elif identifier.startswith(self.prefix + "-"):
+                    connection.sendMessage(Message("RemoveRequest",
+                                                   [("Identifier", identifier),
+                                                    ("Global", "true")]))
+
+            self.client = connection
+            for request in self.requests.values():
+                if request.id in known:
+                    logging.info("Resuming {0}.".format(request.id))
+                    request.submit(connection, resume=True)
+                elif request.replayable:
+                    request.submit(connection, resume=False)
+                else:
+                    text = "{0} was lost, and its data can't be sent again."
+                    self.finished(request, remove=False)
+                    request.done.errback(IOError(text.format(request.id)))
+
+        connection.list_persistent_requests().addCallback(listed)
+
+    def clientConnectionLost(self, connector, reason):
+        self.client = None
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+    def finished(self, request, remove=True):
+        "Forgets ``request``, removing it from the node's global queue."
+        self.requests.pop(request.id, None)
+        if remove and self.client is not None:
+            self.client.sendMessage(Message("RemoveRequest",
+                                            [("Identifier", request.id),
+                                             ("Global", "true")]))
+
+    def request(self, name, fields, handler, data=None, length=None,
+                on_progress=None):
+        "Makes a new persistent request. Returns its ``Deferred``."
+        identifier = "{0}-{1}".format(self.prefix, next(self.ids))
+        message = Message(name, [("Identifier", identifier), ("Verbosity", 1),
+                                 ("Persistence", self.persistence),
+                                 ("Global", "true")] + fields)
+        request = PersistentRequest(self, message, handler, data, length,
+                                    on_progress)
+        self.requests[identifier] = request
+        if self.client is not None:
+            request.submit(self.client, resume=False)
+        return request.done
+
+    def get_direct(self, uri, on_progress=None):
+        """
+        Gets ``uri``, like ``FreenetClientProtocol.get_direct``. Once the node
+        has found the data, it is asked for it with a ``GetRequestStatus``.
+
+        """
+        def process(message):
+            if message.name == "DataFound" and self.client is not None:
+                status = Message("GetRequestStatus",
+                                 [("Identifier", message["Identifier"]),
+                                  ("Global", "true"), ("OnlyData", "true")])
+                self.client.sendMessage(status)
+            elif message.name == "AllData":
+                return message
+
+        fields = [("URI", uri), ("ReturnType", "direct")]
+        return self.request("ClientGet", fields, process,
+                            on_progress=on_progress)
+
+    def put_direct(self, uri, data, length=None, on_progress=None):
+        "Puts ``data`` to ``uri``, like ``FreenetClientProtocol.put_direct``."
+        def process(message):
+            if message.name == "PutSuccessful":
+                return message
+
+        fields = [("URI", uri), ("UploadFrom", "direct")]
+        return self.request("ClientPut", fields, process, data, length,
+                            on_progress)
@@ -0,0 +1,181 @@
+"""
+Defines ``Scheduler``, which queues requests in front of a connection (or a
+pool), so that bulk work can't starve interactive requests of the node's
+attention::
+
+    scheduler = Scheduler(client, max_in_flight=8, weights={'web': 3})
+    scheduler.get_direct(uri, priority=PriorityClass.INTERACTIVE,
+                         tenant='web')
+    scheduler.put_direct('CHK@', data, priority=PriorityClass.BULK,
+                         tenant='backfill')
+
+At most ``max_in_flight`` requests run at once. The others wait in a queue
+per priority, and the most urgent queue is always served first. Within a
+priority, requests are shared between tenants in proportion to their weights,
+using weighted fair queueing: each request gets a virtual finish time, which
+is ``1 / weight`` after the previous one of its tenant (or after the current
+virtual time, if the tenant was idle), and the request with the earliest one
+is started first.
+
+The priority is also sent to the node as the request's ``PriorityClass``, so
+the node orders the requests it runs in the same way.
+
+"""
+import heapq
+import itertools
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+class PriorityClass(object):
+    "The priority classes of FCP, from the most urgent to the least."
+    MAXIMUM = 0
+    INTERACTIVE = 1
+    SEMI_INTERACTIVE = 2
+    UPDATE = 3
+    BULK = 4
+    PREFETCH = 5
+    MINIMUM = 6
+
+class Job(object):
+    "A request waiting in (or started by) a ``Scheduler``."
+    __slots__ = ('scheduler', 'start', 'priority', 'tenant', 'deferred',
+                 'running')
+
+    def __init__(self, scheduler, start, priority, tenant):
+        self.scheduler = scheduler
+        self.start = start
+        self.priority = priority
+        self.tenant = tenant
+        self.deferred = Deferred(self.cancel)
+        self.running = None
+
+    def cancel(self, deferred):
+        """
+        Called when the caller cancels ``deferred``. A job that hasn't started
+        no longer counts as waiting, and is skipped by the scheduler.
+
+        """
+        if self.running is not None:
+            self.running.cancel()
+        else:
+            self.scheduler.queued -= 1
+
+class Scheduler(object):
+    """
+    Runs requests on ``client`` (a ``FreenetClientProtocol`` or an
+    ``FCPPool``) by priority, with at most ``max_in_flight`` of them running
+    at once. ``weights`` maps tenants to their share of the requests of each
+    priority (1 by default).
+
+    """
+    def __init__(self, client, max_in_flight=8, weights=None,
+                 default_priority=PriorityClass.SEMI_INTERACTIVE):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.weights = weights or {}
+        self.default_priority = default_priority
+        self.queues = {}
+        self.finish = {}
+        self.vtime = {}
+        self.order = itertools.count()
+        self.queued = 0
+        self.in_flight = 0
+
+    def __len__(self):
+        "Returns the number of requests waiting to start."
+        return self.queued
+
+    def submit(self, start, priority=None, tenant=None):
+        """
+        Queues ``start``, a function that starts a request and returns a
+        ``Deferred``. Returns a ``Deferred`` for the request's result, which can
+        be cancelled whether or not the request has started.
+
+        """
+        if priority is None:
+            priority = self.default_priority
+        job = Job(self, start, priority, tenant)
+        weight = float(self.weights.get(tenant, 1))
+        key = (priority, tenant)
+        tag = max(self.vtime.get(priority, 0.0),
+                  self.finish.get(key, 0.0)) + 1.0 / weight
+        self.finish[key] = tag
+        queue = self.queues.setdefault(priority, [])
+        heapq.heappush(queue, (tag, next(self.order), job))
+        self.queued += 1
+        self.dispatch()
+        return job.deferred
+
+    def next_job(self):
+        "Takes the next job to start off its queue, or returns ``None``."
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                tag, _, job = heapq.heappop(queue)
+                if job.deferred.called:
+                    continue  # Cancelled (and uncounted) while it was waiting.
+                self.queued -= 1
+                self.vtime[priority] = tag
+                return job
+            del self.queues[priority]
+            self.vtime.pop(priority, None)
+            for key in [key for key in self.finish if key[0] == priority]:
+                del self.finish[key]
+
+    def dispatch(self):
+        "Starts queued jobs until ``max_in_flight`` are running."
+        while self.in_flight < self.max_in_flight and self.queued:
+            job = self.next_job()
+            if job is None:
+                break
+            self.in_flight += 1
+            job.running = maybeDeferred(job.start)
+            job.running.addBoth(self.finished, job)
+
+    def finished(self, result, job):
+        "Passes the result of a job on, and starts the next one."
+        self.in_flight -= 1
+        if not job.deferred.called:
+            if isinstance(result, Failure):
+                job.deferred.errback(result)
+            else:
+                job.deferred.callback(result)
+        self.dispatch()
+
+    def request(self, name, priority=None, tenant=None, *args, **fields):
+        """
+        Queues a call of the method ``name`` of the client, with ``args``, and
+        with the request's priority in its ``PriorityClass`` field (unless one
+        is given).
+
+        """
+        if priority is None:
+            priority = self.default_priority
+        fields.setdefault('PriorityClass', priority)
+        method = getattr(self.client, name)
+        return self.submit(lambda: method(*args, **fields), priority, tenant)
+
+    def get_direct(self, uri, sink=None, on_progress=None, priority=None,
+                   tenant=None, **fields):
+        "See ``FreenetClientProtocol.get_direct``."
+        return self.request('get_direct', priority, tenant, uri, sink,
+                            on_progress, **fields)
+
+    def put_direct(self, uri, data, length=None, on_progress=None,
+                   priority=None, tenant=None, **fields):
+        "See ``FreenetClientProtocol.put_direct``."
+        return self.request('put_direct', priority, tenant, uri, data, length,
+                            on_progress, **fields)
+
+    def get_file(self, uri, filename, on_progress=None, priority=None,
+                 tenant=None, **fields):
+        "See ``FreenetClientProtocol.get_file``."
+        return self.request('get_file', priority, tenant, uri, filename,
+                            on_progress, **fields)
+
+    def put_file(self, uri, filename, on_progress=None, priority=None,
+                 tenant=None, **fields):
+        "See ``FreenetClientProtocol.put_file``."
+        return self.request('put_file', priority, tenant, uri, filename,
+                            on_progress, **fields)
@@ -0,0 +1,310 @@
+"""
+Defines ``ShardedClient``, which spreads requests over several worker
+processes, each with its own connection to the node, so that parsing and
+dispatching messages isn't limited to a single core::
+
+    client = ShardedClient('localhost', 9481, workers=4)
+    client.start().addCallback(lambda _: client.get_direct('CHK@...'))
+
+The front end and the workers talk over the workers' standard input and output
+with AMP. Gets are hashed by URI, so that repeated gets of a key go to the
+same worker (and share its cache and coalescing). Puts go to the worker with
+the fewest requests in flight.
+
+Payloads of up to ``inline_limit`` bytes are sent inline. Larger ones are
+passed as files in ``spool_dir`` (which workers read with ``put_file``, so that
+the node may read them from disk itself), rather than as pickled strings. AMP
+values are at most 65535 bytes long, so a higher ``inline_limit`` is lowered
+to that.
+
+Each worker sends its own ``ClientHello`` name, and numbers its identifiers
+with its own prefix, so that their requests can't collide on the node.
+
+"""
+import os
+import sys
+import tempfile
+import zlib
+
+from twisted.internet import reactor, stdio
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
+from twisted.protocols import amp
+
+from batch import BatchMixin
+from error import FCPException, MessageException, NodeTimeout, error_dict
+from message import Message
+
+# The directory the package is in, which workers need on their path.
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Fields = amp.AmpList([('key', amp.String()), ('value', amp.String())])
+
+class WorkerError(FCPException):
+    "Indicates that a worker failed to run a request."
+
+class Get(amp.Command):
+    "Gets ``uri``, into ``filename`` if it is given."
+    arguments = [('uri', amp.String()), ('fields', Fields),
+                 ('filename', amp.String(optional=True))]
+    response = [('name', amp.String()), ('fields', Fields),
+                ('data', amp.String(optional=True)),
+                ('filename', amp.String(optional=True))]
+    errors = {WorkerError: 'WORKER_ERROR'}
+
+class Put(amp.Command):
+    "Puts ``data`` (or the contents of ``filename``) to ``uri``."
+    arguments = [('uri', amp.String()), ('fields', Fields),
+                 ('data', amp.String(optional=True)),
+                 ('filename', amp.String(optional=True))]
+    response = [('name', amp.String()), ('fields', Fields)]
+    errors = {WorkerError: 'WORKER_ERROR'}
+
+def pack(message):
+    "Returns the fields of ``message`` (but its data) as ``Fields``."
+    return [dict(key=key, value=str(value)) for key, value in message.args
+            if key != 'Data']
+
+def unpack(response):
+    """
+    Returns the message of a worker's ``response``, or raises the exception it
+    stands for.
+
+    """
+    args = [(field['key'], field['value']) for field in response['fields']]
+    message = Message(response['name'], args)
+    if message.name in error_dict:
+        raise error_dict[message.name](message)
+    elif message.name == 'NodeTimeout':
+        raise NodeTimeout()
+    return message
+
+class Worker(amp.AMP):
+    "The worker side: runs requests from the front end on ``client``."
+    def __init__(self, client, inline_limit, spool_dir):
+        amp.AMP.__init__(self)
+        self.client = client
+        self.inline_limit = min(inline_limit, amp.MAX_VALUE_LENGTH)
+        self.spool_dir = spool_dir
+
+    def failed(self, failure):
+        "Turns a failure into the response the front end raises it from."
+        if failure.check(MessageException):
+            error = failure.value
+            return dict(name=type(error).message,
+                        fields=[dict(key='Code', value=str(error.code)),
+                                dict(key='CodeDescription', value=error.msg)])
+        elif failure.check(NodeTimeout):
+            return dict(name='NodeTimeout', fields=[])
+        raise WorkerError(failure.getErrorMessage())
+
+    @Get.responder
+    def get(self, uri, fields, filename=None):
+        fields = dict((field['key'], field['value']) for field in fields)
+        if filename is not None:
+            got = self.client.get_file(uri, filename, **fields)
+            return got.addCallbacks(self.answer, self.failed)
+
+        def got(message):
+            response = self.answer(message)
+            data = message['Data']
+            if len(data) <= self.inline_limit:
+                response['data'] = data
+            else:
+                fd, response['filename'] = tempfile.mkstemp(dir=self.spool_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+            return response
+
+        return self.client.get_direct(uri, **fields).addCallbacks(got,
+                                                                  self.failed)
+
+    @Put.responder
+    def put(self, uri, fields, data=None, filename=None):
+        fields = dict((field['key'], field['value']) for field in fields)
+        if filename is not None:
+            put = self.client.put_file(uri, filename, **fields)
+        else:
+            put = self.client.put_direct(uri, data, **fields)
+        return put.addCallbacks(self.answer, self.failed)
+
+    def answer(self, message):
+        return dict(name=message.name, fields=pack(message))
+
+    def connectionLost(self, reason):
+        "The front end went away, so the worker exits."
+        amp.AMP.connectionLost(self, reason)
+        if reactor.running:
+            reactor.stop()
+
+class WorkerConnection(amp.AMP):
+    "The front end's side of the connection to a worker."
+    def __init__(self):
+        amp.AMP.__init__(self)
+        self.in_flight = 0
+        self.ended = Deferred()
+
+    def makeConnection(self, transport):
+        # A process has no peer or host address, which AMP would ask for.
+        self._transportPeer = self._transportHost = None
+        amp.BinaryBoxProtocol.makeConnection(self, transport)
+
+    def call(self, command, **arguments):
+        "Calls ``command`` on the worker, counting it as in flight."
+        self.in_flight += 1
+        def done(result):
+            self.in_flight -= 1
+            return result
+
+        return self.callRemote(command, **arguments).addBoth(done)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.ended.callback(None)
+
+class ShardedClient(BatchMixin):
+    """
+    Runs requests on ``workers`` processes (by default, one per core), each
+    connected to the node at ``host`` and ``port``. Offers ``get_direct``,
+    ``get_file``, ``put_direct`` and ``put_file`` (and so ``get_many`` and
+    ``put_many``) like ``FreenetClientProtocol``.
+
+    """
+    def __init__(self, host='localhost', port=9481, workers=None,
+                 inline_limit=60000, spool_dir=None, reactor=reactor):
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.host = host
+        self.port = port
+        self.count = workers
+        self.inline_limit = min(inline_limit, amp.MAX_VALUE_LENGTH)
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.reactor = reactor
+        self.workers = []
+        self.name = "Shard{0}".format(os.getpid())
+
+    def start(self):
+        """
+        Starts the workers. Returns a ``Deferred`` that fires once they are all
+        running (requests made before then are queued by the workers).
+
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [_root] + filter(None, [env.get('PYTHONPATH')]))
+        started = []
+        for index in xrange(self.count):
+            args = [sys.executable, '-m', 'twistedfcp.sharded', self.host,
+                    str(self.port), "{0}-{1}".format(self.name, index),
+                    str(self.inline_limit), self.spool_dir]
+            endpoint = ProcessEndpoint(self.reactor, sys.executable, args, env)
+            started.append(connectProtocol(endpoint, WorkerConnection()))
+
+        def running(workers):
+            self.workers = workers
+            return self
+
+        return gatherResults(started).addCallback(running)
+
+    def stop(self):
+        "Stops the workers. Returns a ``Deferred`` that fires once they exit."
+        ended = []
+        for worker in self.workers:
+            worker.transport.loseConnection()
+            ended.append(worker.ended)
+        self.workers = []
+        return gatherResults(ended)
+
+    def worker_for(self, uri):
+        "Returns the worker that gets of ``uri`` go to."
+        return self.workers[zlib.crc32(uri) % len(self.workers)]
+
+    def least_loaded(self):
+        "Returns the worker with the fewest requests in flight."
+        return min(self.workers, key=lambda worker: worker.in_flight)
+
+    def get_direct(self, uri, **fields):
+        "See ``FreenetClientProtocol.get_direct``."
+        def got(response):
+            message = unpack(response)
+            if response.get('filename') is not None:
+                with open(response['filename'], 'rb') as f:
+                    message['Data'] = f.read()
+                os.remove(response['filename'])
+            else:
+                message['Data'] = response['data']
+            return message
+
+        got_response = self.worker_for(uri).call(Get, uri=uri,
+                                                 fields=packed(fields))
+        return got_response.addCallback(got)
+
+    def get_file(self, uri, filename, **fields):
+        "See ``FreenetClientProtocol.get_file``."
+        got = self.worker_for(uri).call(Get, uri=uri, fields=packed(fields),
+                                        filename=os.path.abspath(filename))
+        return got.addCallback(unpack)
+
+    def put_direct(self, uri, data, **fields):
+        "See ``FreenetClientProtocol.put_direct``."
+        if len(data) <= self.inline_limit:
+            put = self.least_loaded().call(Put, uri=uri, data=data,
+                                           fields=packed(fields))
+            return put.addCallback(unpack)
+
+        fd, filename = tempfile.mkstemp(dir=self.spool_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        def remove(result):
+            os.remove(filename)
+            return result
+
+        put = self.least_loaded().call(Put, uri=uri, filename=filename,
+                                       fields=packed(fields))
+        return put.addBoth(remove).addCallback(unpack)
+
+    def put_file(self, uri, filename, **fields):
+        "See ``FreenetClientProtocol.put_file``."
+        put = self.least_loaded().call(Put, uri=uri, fields=packed(fields),
+                                       filename=os.path.abspath(filename))
+        return put.addCallback(unpack)
+
+def packed(fields):
+    "Returns the keyword arguments of a request as ``Fields``."
+    return [dict(key=key, value=str(value))
+            for key, value in sorted(fields.iteritems())]
+
+def main(args=None):
+    """
+    Runs a worker: ``python -m twistedfcp.sharded host port name inline_limit
+    spool_dir``. Requests are read from standard input.
+
+    """
+    from twisted.internet.protocol import ClientCreator
+    from twistedfcp.message import IdentifiedMessage
+    from twistedfcp.protocol import FreenetClientProtocol
+
+    host, port, name, inline_limit, spool_dir = (args or sys.argv[1:])
+    IdentifiedMessage.prefix = name + "-"
+    FreenetClientProtocol.hello = Message("ClientHello",
+                                          [("Name", name),
+                                           ("ExpectedVersion", "2.0")])
+
+    def connected(client):
+        worker = Worker(client, int(inline_limit), spool_dir)
+        stdio.StandardIO(worker)
+        return client.deferred['NodeHello']
+
+    def failed(failure):
+        sys.stderr.write("Connecting to the node failed: {0}\n"
+                         .format(failure.getErrorMessage()))
+        reactor.stop()
+
+    creator = ClientCreator(reactor, FreenetClientProtocol)
+    creator.connectTCP(host, int(port)).addCallbacks(connected, failed)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Defines ``SiteInsert``, which inserts a whole directory (a freesite, or a
+dataset) into Freenet::
+
+    insert = SiteInsert(client, 'USK@.../mysite/1', '/path/to/site',
+                        state='/path/to/site.state')
+    insert.run().addCallback(lambda message: message['URI'])
+
+Every file is inserted as a ``CHK`` (read from disk by the node if it is
+allowed to, see ``twistedfcp.dda``, or streamed to it otherwise), with a
+bounded number of inserts running at once. The site is then inserted as a
+``ClientPutComplexDir`` manifest that redirects each name to its ``CHK``.
+
+If a ``state`` file is given, the ``CHK`` of every file is recorded in it as
+soon as it is inserted. Running the insert again with the same state file
+only inserts the files that are missing, or that changed since.
+
+"""
+import json
+import mimetypes
+import os
+
+from twisted.internet.defer import Deferred
+from batch import ResultStream
+from error import FCPException
+
+class IncompleteInsert(FCPException):
+    "Indicates that some files of a site could not be inserted."
+    def __init__(self, failures):
+        self.failures = failures
+        text = "{0} file(s) could not be inserted: {1}"
+        FCPException.__init__(self, text.format(len(failures),
+                                                ', '.join(sorted(failures))))
+
+def manifest(directory):
+    """
+    Returns ``(name, path)`` pairs for every file under ``directory``, sorted
+    by name. Names are relative to ``directory`` and use ``/`` separators.
+
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory)
+            files.append((relative.replace(os.sep, '/'), path))
+    return sorted(files)
+
+class InsertState(object):
+    """
+    Remembers which files were inserted, under which ``CHK``, in a file that
+    gets one JSON line appended per inserted file. A file is only considered
+    inserted if its size and modification time haven't changed.
+
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.inserted = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A partly written last line.
+                    self.inserted[entry['name']] = entry
+
+    def stamp(self, path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def get(self, name, path):
+        "Returns the ``CHK`` that ``path`` was inserted as, or ``None``."
+        entry = self.inserted.get(name)
+        if entry is None or tuple(entry['stamp']) != self.stamp(path):
+            return None
+        return entry['uri']
+
+    def record(self, name, path, uri):
+        "Records that ``path`` was inserted as ``uri``."
+        entry = dict(name=name, uri=uri, stamp=self.stamp(path))
+        self.inserted[name] = entry
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+class SiteInsert(object):
+    """
+    Inserts the files of ``files`` (a directory, or a list of ``(name, path)``
+    pairs) as a site at ``uri``, using ``client`` (a ``FreenetClientProtocol``
+    or an ``FCPPool``). At most ``concurrency`` files are inserted at once.
+    ``default_name`` is the file shown for the site itself.
+
+    """
+    def __init__(self, client, uri, files, concurrency=4, state=None,
+                 default_name='index.html'):
+        self.client = client
+        self.uri = uri
+        if isinstance(files, basestring):
+            files = manifest(files)
+        self.files = list(files)
+        self.concurrency = concurrency
+        self.state = InsertState(state)
+        self.default_name = default_name
+        self.uris = {}
+        self.failures = {}
+
+    def pending(self):
+        "Yields the files that still have to be inserted."
+        for name, path in self.files:
+            uri = self.state.get(name, path)
+            if uri is None:
+                yield name, path
+            else:
+                self.uris[name] = uri
+
+    def insert_file(self, item):
+        """
+        Inserts a single file as a ``CHK``, with ``put_file`` (so the node
+        reads it from disk itself if it may).
+
+        """
+        name, path = item
+        fields = {}
+        content_type = mimetypes.guess_type(name)[0]
+        if content_type is not None:
+            fields['Metadata.ContentType'] = content_type
+        def inserted(response):
+            self.uris[name] = response["URI"]
+            self.state.record(name, path, response["URI"])
+            return response
+
+        put = self.client.put_file("CHK@", path, **fields)
+        return put.addCallback(inserted)
+
+    def run(self):
+        """
+        Inserts every file that isn't inserted yet, then the manifest. Returns
+        a ``Deferred`` that fires with the ``PutSuccessful`` message of the
+        site, or fails with ``IncompleteInsert`` if any file failed (in which
+        case the manifest isn't inserted).
+
+        """
+        done = Deferred()
+        stream = ResultStream(self.insert_file, self.pending(),
+                              lambda item: item[0], self.concurrency)
+
+        def collected(results):
+            for result in results:
+                if not result.ok:
+                    self.failures[result.key] = result.failure
+            if self.failures:
+                done.errback(IncompleteInsert(self.failures))
+                return
+            redirects = [(name, self.uris[name]) for name, _ in self.files]
+            put = self.client.put_complex_dir(self.uri, redirects,
+                                              self.default_name)
+            put.chainDeferred(done)
+
+        stream.collect().addCallback(collected).addErrback(done.errback)
+        return done
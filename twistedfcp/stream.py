@@ -0,0 +1,214 @@
+"""
+Defines helpers for streaming the binary ``Data`` payloads that can follow an
+FCP message.
+
+Incoming payloads are handed to a *sink*. A sink is opened with the length of
+the payload (taken from the ``DataLength`` field), receives the payload in
+chunks as they arrive from the network, and is finally asked for the value
+that is stored in the ``Data`` field of the received message::
+
+    sink.open(length)
+    sink.write(chunk)     # zero or more times
+    value = sink.finish()
+
+Before opening a sink, the receiving protocol sets its ``transport`` attribute
+to the transport the payload is read from. ``DataSink`` and the default
+``StringSink`` are defined in ``twistedfcp.core``.
+
+Outgoing payloads that should not be held in memory are streamed by a Twisted
+``IBodyProducer`` with a known ``length``. ``body_producer`` builds one from a
+file object or an iterable of chunks.
+
+"""
+import mmap
+import tempfile
+
+from zope.interface import implementer
+from twisted.internet import task
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.web.client import FileBodyProducer
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from core import DataSink, StringSink
+
+class BufferSink(DataSink):
+    """
+    Copies the payload into a ``bytearray`` that is preallocated to the full
+    ``DataLength``. The ``bytearray`` itself is returned, so the payload is
+    never copied again after it is read off the socket.
+
+    """
+    def open(self, length):
+        DataSink.open(self, length)
+        self.buffer = bytearray(length)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+
+    def write(self, data):
+        end = self.offset + len(data)
+        self.view[self.offset:end] = data
+        self.offset = end
+
+    def finish(self):
+        del self.view
+        return self.buffer
+
+class FileSink(DataSink):
+    """
+    Writes the payload to an open (binary) file object, which is returned once
+    the payload is complete. The file is flushed but not closed.
+
+    """
+    def __init__(self, fileobj):
+        self.file = fileobj
+
+    def write(self, data):
+        self.file.write(data)
+
+    def finish(self):
+        self.file.flush()
+        return self.file
+
+class SpoolSink(DataSink):
+    """
+    Keeps payloads of up to ``threshold`` bytes in memory (as a ``BufferSink``
+    would). Larger payloads are spooled to an anonymous temporary file, which
+    is then memory mapped read-only and returned as an ``mmap`` object.
+
+    """
+    default_threshold = 1024 * 1024
+
+    def __init__(self, threshold=None, dir=None):
+        self.threshold = threshold or self.default_threshold
+        self.dir = dir
+
+    def open(self, length):
+        DataSink.open(self, length)
+        if length > self.threshold:
+            self.sink = FileSink(tempfile.TemporaryFile(dir=self.dir))
+        else:
+            self.sink = BufferSink()
+        self.sink.open(length)
+
+    def write(self, data):
+        self.sink.write(data)
+
+    def finish(self):
+        result = self.sink.finish()
+        if isinstance(self.sink, FileSink):
+            result = mmap.mmap(result.fileno(), 0, access=mmap.ACCESS_READ)
+            self.sink.file.close()
+        return result
+
+class ConsumerSink(DataSink):
+    """
+    Forwards the payload to a Twisted ``IConsumer``. While the payload is being
+    received, the connection's transport is registered as the consumer's
+    producer, so a slow consumer pauses reading from the node. The consumer is
+    returned once the payload is complete.
+
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+
+    def open(self, length):
+        DataSink.open(self, length)
+        if self.transport is not None:
+            self.consumer.registerProducer(self.transport, True)
+
+    def write(self, data):
+        self.consumer.write(data)
+
+    def finish(self):
+        if self.transport is not None:
+            self.consumer.unregisterProducer()
+        return self.consumer
+
+@implementer(IBodyProducer)
+class IterableProducer(object):
+    """
+    Produces the chunks of an iterable (for instance, a generator) one at a
+    time. Since the iterable can't be measured up front, its total ``length``
+    in bytes must be given.
+
+    """
+    def __init__(self, iterable, length, cooperator=task):
+        self.iterator = iter(iterable)
+        self.length = length
+        self._cooperate = cooperator.cooperate
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._writeloop(consumer))
+        done = self._task.whenDone()
+        def stopped(reason):
+            if reason.check(CancelledError):
+                self.stopProducing()
+            elif not reason.check(task.TaskStopped):
+                return reason
+            return Deferred()
+
+        return done.addCallbacks(lambda _: None, stopped)
+
+    def _writeloop(self, consumer):
+        for chunk in self.iterator:
+            consumer.write(chunk)
+            yield None
+
+    def pauseProducing(self): self._task.pause()
+
+    def resumeProducing(self): self._task.resume()
+
+    def stopProducing(self): self._task.stop()
+
+class LengthCheckingConsumer(object):
+    """
+    Wraps the consumer a body is written to, failing if the producer writes
+    more than ``length`` bytes. Since the node reads exactly ``DataLength``
+    bytes, an overlong body would corrupt the rest of the connection. The
+    bytes actually passed on are counted in ``written``.
+
+    """
+    def __init__(self, consumer, length):
+        self.consumer = consumer
+        self.remaining = length
+        self.written = 0
+
+    def write(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise ValueError("The producer wrote more than its length.")
+        self.consumer.write(data)
+        self.written += len(data)
+
+    def check(self):
+        "Fails if the producer wrote less than its length."
+        if self.remaining:
+            raise ValueError("The producer wrote less than its length.")
+
+def body_producer(data, length=None):
+    """
+    Returns an ``IBodyProducer`` for the given ``data``, or ``None`` if the data
+    is a plain string that can simply be written. ``data`` can be:
+
+    - an ``IBodyProducer`` with a known ``length``, which is used as is.
+    - a file object (it is read from its current position, and closed by the
+      producer once the end is reached).
+    - any other iterable of string chunks, whose total ``length`` must then
+      be given.
+
+    """
+    if isinstance(data, str):
+        return None
+    elif IBodyProducer.providedBy(data):
+        producer = data
+    elif hasattr(data, 'read'):
+        producer = FileBodyProducer(data)
+        if length is not None:
+            producer.length = length
+    elif length is None:
+        raise ValueError("The length of an iterable body must be given.")
+    else:
+        producer = IterableProducer(data, length)
+
+    if producer.length is UNKNOWN_LENGTH:
+        raise ValueError("The length of the body could not be determined.")
+    return producer
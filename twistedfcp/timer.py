@@ -0,0 +1,111 @@
+"""
+Defines ``TimerWheel``, which schedules large numbers of coarse timeouts (like
+the ones ending FCP sessions) using a single delayed call.
+
+"""
+import math
+
+from twisted.internet import reactor
+
+class Timer(object):
+    "A single timer scheduled on a ``TimerWheel``."
+    __slots__ = ('wheel', 'tick', 'f', 'args', 'called', 'cancelled')
+
+    def __init__(self, wheel, tick, f, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.f = f
+        self.args = args
+        self.called = self.cancelled = False
+
+    def active(self):
+        "Returns whether the timer will still fire."
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        "Stops the timer from firing."
+        if self.active():
+            self.cancelled = True
+            self.wheel.remove(self)
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel. Timers are put into buckets, one per ``granularity``
+    seconds, and all the timers in a bucket are expired together. Scheduling
+    and cancelling a timer are constant time dictionary operations, and the
+    reactor only ever holds one delayed call for the wheel (and none while it
+    is empty).
+
+    Timers never fire early, but may fire up to ``granularity`` seconds late.
+
+    """
+    def __init__(self, granularity=1.0, clock=reactor):
+        self.granularity = granularity
+        self.clock = clock
+        self.buckets = {}
+        self.last_tick = self.current_tick()
+        self.call = None
+
+    def current_tick(self):
+        return int(math.floor(self.clock.seconds() / self.granularity))
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.itervalues())
+
+    def schedule(self, delay, f, *args):
+        "Calls ``f(*args)`` in ``delay`` seconds. Returns a ``Timer``."
+        if self.call is None and not self.buckets:
+            self.last_tick = self.current_tick()
+        deadline = self.clock.seconds() + delay
+        tick = max(int(math.ceil(deadline / self.granularity)),
+                   self.last_tick + 1)
+        timer = Timer(self, tick, f, args)
+        bucket = self.buckets.get(tick)
+        if bucket is None:
+            bucket = self.buckets[tick] = set()
+        bucket.add(timer)
+        if self.call is None:
+            self.start()
+        return timer
+
+    def remove(self, timer):
+        "Removes a cancelled ``timer`` from its bucket."
+        bucket = self.buckets.get(timer.tick)
+        if bucket is None:
+            return
+        bucket.discard(timer)
+        if not bucket:
+            del self.buckets[timer.tick]
+            if not self.buckets and self.call is not None:
+                self.call.cancel()
+                self.call = None
+
+    def start(self):
+        "Schedules the next turn of the wheel, at the next tick boundary."
+        now = self.clock.seconds()
+        next_tick = math.floor(now / self.granularity) + 1
+        self.call = self.clock.callLater(next_tick * self.granularity - now, 
+                                         self.advance)
+
+    def advance(self):
+        "Fires every timer whose tick has passed."
+        self.call = None
+        now = self.current_tick()
+        if now - self.last_tick <= len(self.buckets):
+            ticks = xrange(self.last_tick + 1, now + 1)
+        else:
+            ticks = sorted(t for t in self.buckets if t <= now)
+        self.last_tick = now
+
+        for tick in ticks:
+            bucket = self.buckets.pop(tick, None)
+            if bucket is None:
+                continue
+            for timer in bucket:
+                if timer.cancelled:
+                    continue
+                timer.called = True
+                timer.f(*timer.args)
+
+        if self.buckets and self.call is None:
+            self.start()
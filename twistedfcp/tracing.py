@@ -0,0 +1,148 @@
+"""
+Records the raw bytes a protocol sends and receives, so that a connection can
+be inspected, or replayed through the parser, after the fact. Tracing is off
+unless a recorder is assigned to the ``trace`` attribute of a protocol::
+
+    client.trace = RingTrace(max_frames=10000)    # the latest frames
+    client.trace = FileTrace(open('fcp.trace', 'wb'))    # every frame
+
+Each *frame* is a ``(timestamp, direction, data)`` tuple, where ``direction``
+is ``'<'`` for data received from the node and ``'>'`` for data sent to it,
+and ``data`` is exactly what went over the wire in one read or write.
+
+A trace file holds one frame after another, each as a header line
+(``<timestamp> <direction> <length>``) followed by the data and a newline.
+Running this module replays the received frames of a trace file::
+
+    python -m twistedfcp.tracing fcp.trace --gaps 5 --profile
+
+"""
+import collections
+import sys
+import time
+
+class RingTrace(object):
+    """
+    Keeps the latest ``max_frames`` frames in memory, and at most ``max_bytes``
+    bytes of data, dropping the oldest frames first.
+
+    """
+    def __init__(self, max_frames=10000, max_bytes=16 * 2 ** 20):
+        self.frames = collections.deque(maxlen=max_frames)
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def record(self, timestamp, direction, data):
+        if len(self.frames) == self.frames.maxlen:
+            self.size -= len(self.frames[0][2])
+        self.frames.append((timestamp, direction, data))
+        self.size += len(data)
+        while self.size > self.max_bytes and self.frames:
+            self.size -= len(self.frames.popleft()[2])
+
+    def dump(self, fileobj):
+        "Writes the frames to ``fileobj``, as a ``FileTrace`` would."
+        trace = FileTrace(fileobj)
+        for frame in self.frames:
+            trace.record(*frame)
+        fileobj.flush()
+
+class FileTrace(object):
+    "Writes every frame to an open (binary) file object."
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+
+    def record(self, timestamp, direction, data):
+        self.file.write("{0:.6f} {1} {2}\n".format(timestamp, direction,
+                                                    len(data)))
+        self.file.write(data)
+        self.file.write("\n")
+
+class TracingConsumer(object):
+    "Records everything written to ``consumer`` as outgoing frames."
+
+    def __init__(self, consumer, trace, clock):
+        self.consumer = consumer
+        self.trace = trace
+        self.clock = clock
+
+    def write(self, data):
+        self.trace.record(self.clock.seconds(), '>', data)
+        self.consumer.write(data)
+
+def read_trace(fileobj):
+    "Yields the frames written to ``fileobj`` by a ``FileTrace``."
+    while True:
+        header = fileobj.readline()
+        if not header:
+            return
+        timestamp, direction, length = header.split()
+        data = fileobj.read(int(length))
+        fileobj.read(1)
+        yield float(timestamp), direction, data
+
+def replay(frames, protocol):
+    """
+    Feeds the received frames among ``frames`` to ``protocol``, as if they had
+    just arrived, and returns the protocol. The protocol is connected to a
+    ``StringTransport``, so anything it sends is discarded.
+
+    """
+    from twisted.test.proto_helpers import StringTransport
+    protocol.makeConnection(StringTransport())
+    for _, direction, data in frames:
+        if direction == '<':
+            protocol.dataReceived(data)
+    return protocol
+
+def gaps(frames, seconds):
+    "Yields ``(timestamp, gap)`` for each pause longer than ``seconds``."
+    last = None
+    for timestamp, _, _ in frames:
+        if last is not None and timestamp - last > seconds:
+            yield last, timestamp - last
+        last = timestamp
+
+def main(argv=None):
+    import argparse
+    import cProfile
+    import pstats
+    from twistedfcp.util import MessageBasedProtocol
+
+    class CountingProtocol(MessageBasedProtocol):
+        count = 0
+        def message_received(self, message):
+            self.count += 1
+
+    parser = argparse.ArgumentParser(description="Replays an FCP trace.")
+    parser.add_argument('trace', help="a file written by FileTrace")
+    parser.add_argument('--gaps', type=float, metavar='SECONDS',
+                        help="list pauses in the trace longer than this")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the parser while replaying")
+    options = parser.parse_args(argv)
+    with open(options.trace, 'rb') as f:
+        frames = list(read_trace(f))
+
+    if options.gaps is not None:
+        for timestamp, gap in gaps(frames, options.gaps):
+            print("{0:.6f}: nothing for {1:.3f}s".format(timestamp, gap))
+
+    protocol = CountingProtocol()
+    profile = cProfile.Profile() if options.profile else None
+    start = time.time()
+    if profile is not None:
+        profile.runcall(replay, frames, protocol)
+    else:
+        replay(frames, protocol)
+    elapsed = time.time() - start
+    received = sum(len(d) for _, direction, d in frames if direction == '<')
+    print("Replayed {0} messages ({1} bytes) in {2:.3f}s.".format(
+        protocol.count, received, elapsed))
+    if profile is not None:
+        pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative') \
+              .print_stats(20)
+
+if __name__ == '__main__':
+    main()
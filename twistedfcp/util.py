@@ -3,9 +3,17 @@ Defines utility functions for the ``twistedfcp`` module.
 
 """
 import logging
-from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from core import MessageParser, encode_message
+from stream import LengthCheckingConsumer, body_producer
+from tracing import TracingConsumer
 
-class MessageBasedProtocol(LineReceiver):
+@implementer(IPushProducer)
+class MessageBasedProtocol(Protocol, MessageParser):
     """
     Defines a protocol that parses freenet-style messages. These messages take
     the following form::
@@ -38,90 +46,287 @@ class MessageBasedProtocol(LineReceiver):
         Data
         <37261 bytes of data>
 
+    Outgoing messages are queued and written once per reactor iteration. The
+    ``clock`` used to schedule those writes defaults to the reactor.
+
+    Parsing is done by ``twistedfcp.core.MessageParser``. The data is handed
+    to a sink (see ``twistedfcp.stream``) chunk by chunk as it arrives. The
+    sink used for a given message is chosen by ``data_sink``, which subclasses
+    can override.
+
+    Messages and bytes sent and received are counted in ``metrics``, if it is
+    set to a ``twistedfcp.metrics.Metrics``. The raw data itself is recorded
+    by ``trace``, if it is set to a recorder from ``twistedfcp.tracing``.
+
+    Writes are flow controlled. The protocol registers itself as a producer
+    on its transport, so it is paused while the transport's buffer is full,
+    and passes that on to any body being streamed. It also counts the bytes
+    queued for writing (``queued``). Once they reach ``high_water``, or while
+    the transport is paused, the protocol isn't ``writable`` until they drop
+    to ``low_water`` and the transport resumes. Callers about to send a lot
+    of data should wait for ``wait_writable`` first.
+
     """
+    high_water = 2 ** 20
+    low_water = 2 ** 18
+
     def __init__(self):
-        self.delimiter = "\n"
-        self.reset()
-
-    def reset(self):
-        "Resets this protocol to its original state (waiting for a new message)"
-        self.dataReceived = self.dataReceived
-        self.lineReceived = self.new_message
-        self.messageName = None
-        self.message = {}
-
-    def new_message(self, line):
-        "In this state, the protocol treats the line as the message name."
-        self.messageName = line
-        self.lineReceived = self.key_value
-
-    def key_value(self, line):
-        "In this state, the protocol treats the line as a ``key=value`` pair."
-        if line == "EndMessage":
-            self.end_message()
-        elif line == "Data":
-            if 'DataLength' not in self.message:
-                text = ('Encountered a "Data" ending in a message without '
-                        'a "DataLength" key')
-                raise MalformedMessageException(text)
-            else:
-                self.message['Data'] = []
-                self.dataCount = 0
-                self.setRawMode()
-        else:
-            kv = line.split('=')
-            if len(kv) != 2:
-                text = 'Bad line encountered: "{0}" (expected "key=value")'
-                raise MalformedMessageException(text.format(line))
-            self.message.update([kv])
+        MessageParser.__init__(self)
+        self.clock = reactor
+        self.outgoing = []
+        self.flushing = None
+        self.held = False
+        self.producing = None
+        self.body = None
+        self.body_paused = False
+        self.pending = []
+        self.metrics = None
+        self.trace = None
+        self.queued = 0
+        self.paused = False
+        self.throttled = False
+        self.writable_waiters = []
 
-    def rawDataReceived(self, data):
-        """
-        In this state we parse the final data in the message. 
-        
-        .. note::
-            This state can only be reached when this instance is in "raw mode".
+    def connectionMade(self):
+        "Registers the protocol as the producer of its transport's data."
+        self.transport.registerProducer(self, True)
 
-        """
-        self.dataCount += len(data)
-        self.message["Data"].append(data)
-        expected = int(self.message["DataLength"])
-        if self.dataCount >= expected:
-            all_data = ''.join(self.message["Data"])
-            self.message["Data"] = all_data[:expected]
-            self.end_message()
-            self.setLineMode(all_data[expected:])
+    def dataReceived(self, data):
+        "Parses every complete message in ``data``, see ``MessageParser``."
+        if self.trace is not None:
+            self.trace.record(self.clock.seconds(), '<', data)
+        if self.metrics is not None:
+            self.metrics.increment('fcp_bytes_received_total', (), len(data))
+        self.feed(data)
 
     def end_message(self):
         "Process a fully received message and resets state."
-        logging.info("Received {0}.".format(self.messageName))
-        logging.debug(str(self.message))
-        self.message_received(self.messageName, self.message)
-        self.reset()
+        message, self.message = self.message, None
+        if logging.root.isEnabledFor(logging.INFO):
+            log_message("Received", message)
+        if self.metrics is not None:
+            self.metrics.increment('fcp_messages_received_total',
+                                   (('message', message.name),))
+        self.message_received(message)
 
-    def sendMessage(self, message, data=None):
+    def sendMessage(self, message, data=None, length=None):
         """
         Sends a single ``message`` to the server. If ``data`` is specified, it
         gets tacked on to the end of the message and a ``DataLength`` field is
         added to the message arguments.
 
+        ``data`` is either a string, or anything ``stream.body_producer``
+        accepts (a file object, an iterable of chunks with a given ``length``
+        or an ``IBodyProducer``), in which case it is streamed to the server
+        as the transport accepts it (see ``produce``). Messages sent while a
+        body is being streamed, or while output is held (see ``hold``), are
+        queued until it is complete.
+
+        Each message is encoded into a single string and queued. All messages
+        queued during one reactor iteration are written with one call to
+        ``transport.writeSequence``.
+
+        Returns a ``Deferred`` that fires once the message has been queued for
+        writing (for a streamed body, once the body has been written). For a
+        message that was queued behind a body or held, it only fires once the
+        message is actually sent, and fails if the connection is lost first.
+
         """
-        self.transport.write(message.name)
-        self.transport.write('\n')
-        for key, value in message.args:
-            self.transport.write(str(key))
-            self.transport.write('=')
-            self.transport.write(str(value))
-            self.transport.write('\n')
+        if self.producing is not None or self.held:
+            sent = Deferred()
+            self.pending.append((message, data, length, sent))
+            if isinstance(data, str):
+                self.adjust_queued(len(data))
+            return sent
 
+        if self.metrics is not None:
+            self.metrics.increment('fcp_messages_sent_total',
+                                   (('message', message.name),))
+        producer = body_producer(data, length) if data else None
+        logged = logging.root.isEnabledFor(logging.INFO)
         if not data:
-            self.transport.write('EndMessage\n')
-            logging.info("Sent {0}".format(message.name))
-            logging.debug(message.args)
+            self.write(encode_message(message))
+            if logged:
+                log_message("Sent", message)
+        elif producer is None:
+            self.write(encode_message(message, len(data)), data)
+            if logged:
+                log_message("Sent", message, len(data))
         else:
-            self.transport.write('DataLength={0}\n'.format(len(data)))
-            self.transport.write('Data\n')
-            self.transport.write(data)
-            logging.info("Sent {0} (data length={1})".format(message.name, 
-                                                             len(data)))
-            logging.debug(message.args)
+            self.write(encode_message(message, producer.length))
+            self.flush()
+            if logged:
+                log_message("Streaming", message, producer.length)
+            return self.produce(producer)
+
+        return succeed(None)
+
+    def write(self, *strings):
+        "Queues ``strings`` to be written at the end of this reactor iteration."
+        self.outgoing.extend(strings)
+        length = sum(len(s) for s in strings)
+        self.adjust_queued(length)
+        if self.metrics is not None:
+            self.metrics.increment('fcp_bytes_sent_total', (), length)
+        if self.flushing is None:
+            self.flushing = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        "Writes all queued strings to the transport at once."
+        if self.flushing is not None:
+            if self.flushing.active():
+                self.flushing.cancel()
+            self.flushing = None
+        if self.outgoing:
+            outgoing, self.outgoing = self.outgoing, []
+            if self.trace is not None:
+                self.trace.record(self.clock.seconds(), '>', ''.join(outgoing))
+            self.transport.writeSequence(outgoing)
+            self.adjust_queued(-sum(len(s) for s in outgoing))
+
+    def hold(self):
+        "Queues all messages that are sent from now on until ``release``."
+        self.held = True
+
+    def release(self):
+        "Sends all messages queued since ``hold`` was called."
+        self.held = False
+        self.send_pending()
+
+    def send_pending(self):
+        "Sends queued messages, until one of them starts streaming a body."
+        while self.pending and self.producing is None and not self.held:
+            message, data, length, sent = self.pending.pop(0)
+            if isinstance(data, str):
+                self.adjust_queued(-len(data))
+            self.sendMessage(message, data, length).chainDeferred(sent)
+
+    @property
+    def writable(self):
+        "Whether data can be written without piling up in memory."
+        return not (self.paused or self.throttled)
+
+    def wait_writable(self):
+        "Returns a ``Deferred`` that fires once the protocol is ``writable``."
+        if self.writable:
+            return succeed(None)
+        waiter = Deferred(self.writable_waiters.remove)
+        self.writable_waiters.append(waiter)
+        return waiter
+
+    def adjust_queued(self, change):
+        "Counts ``change`` more bytes as queued, updating ``writable``."
+        self.queued += change
+        if self.queued >= self.high_water:
+            self.throttled = True
+        elif self.throttled and self.queued <= self.low_water:
+            self.throttled = False
+            self.wake_writers()
+
+    def wake_writers(self):
+        "Fires the ``wait_writable`` waiters, while the protocol is writable."
+        while self.writable_waiters and self.writable:
+            self.writable_waiters.pop(0).callback(None)
+
+    def pauseProducing(self):
+        "Called by the transport when its buffer is full."
+        self.paused = True
+        self.pause_body()
+
+    def resumeProducing(self):
+        "Called by the transport once its buffer has been written."
+        self.paused = False
+        if self.body_paused:
+            self.body_paused = False
+            self.body.resumeProducing()
+        self.wake_writers()
+
+    def pause_body(self):
+        "Pauses the body being streamed, if there is one."
+        if self.producing is not None and not self.body_paused:
+            self.body_paused = True
+            self.body.pauseProducing()
+
+    def stopProducing(self):
+        "Called by the transport when it can't be written to any more."
+        if self.producing is not None:
+            self.body.stopProducing()
+
+    def produce(self, producer):
+        """
+        Streams the body of the message that was just sent from ``producer``,
+        pausing and resuming it along with the transport (the protocol stays
+        the transport's producer, and acts as a proxy for the body's). If the
+        producer fails (or writes the wrong number of bytes) the connection is
+        dropped, as the node can no longer parse it.
+
+        """
+        target = self.transport
+        if self.trace is not None:
+            target = TracingConsumer(target, self.trace, self.clock)
+        consumer = LengthCheckingConsumer(target, producer.length)
+        self.body = producer
+        self.producing = producer.startProducing(consumer)
+        if self.paused and not self.producing.called:
+            self.pause_body()
+
+        def count(result):
+            # Only the bytes that reached the transport count as sent.
+            if self.metrics is not None:
+                self.metrics.increment('fcp_bytes_sent_total', (),
+                                       consumer.written)
+            return result
+
+        def produced(result):
+            self.producing = None
+            self.body = None
+            self.body_paused = False
+            consumer.check()
+
+        def failed(failure):
+            logging.error("Streaming a message body failed: {0}"
+                          .format(failure.getErrorMessage()))
+            self.producing = None
+            self.body = None
+            self.body_paused = False
+            pending, self.pending = self.pending, []
+            for _, data, _, sent in pending:
+                if isinstance(data, str):
+                    self.adjust_queued(-len(data))
+                sent.errback(failure)
+            self.transport.loseConnection()
+            return failure
+
+        return self.producing.addBoth(count).addCallback(produced).addCallbacks(
+            lambda _: self.send_pending(), failed)
+
+    def connectionLost(self, reason):
+        "Drops everything that is still queued for writing."
+        if self.flushing is not None and self.flushing.active():
+            self.flushing.cancel()
+        self.flushing = None
+        self.outgoing = []
+        self.queued = 0
+        pending, self.pending = self.pending, []
+        for _, _, _, sent in pending:
+            sent.errback(reason)
+        waiters, self.writable_waiters = self.writable_waiters, []
+        for waiter in waiters:
+            waiter.errback(reason)
+        Protocol.connectionLost(self, reason)
+
+def log_message(action, message, data_length=None):
+    """
+    Logs that ``message`` was ``action`` (e.g. "Sent"), and its fields at the
+    ``DEBUG`` level. Any ``Data`` field is left out. This formats the message,
+    so callers on the hot path check that ``INFO`` is enabled first.
+
+    """
+    if data_length is None:
+        logging.info("%s %s.", action, message.name)
+    else:
+        logging.info("%s %s (data length=%d).", action, message.name,
+                     data_length)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("%r", [(key, value) for key, value in message.args
+                             if key != 'Data'])